@@ -5,133 +5,52 @@ from yaml.loader import SafeLoader
 from database import (
     add_income, add_expense, set_budget, add_recurring, add_category,
     get_categories, add_subcategory, get_subcategories, add_tag, get_tags,
-    associate_tag, add_savings_goal, get_savings_goals, get_recent_transactions,
-    get_all_budgets, get_spent_per_category, get_total_income, get_total_expenses,
-    get_income_over_time, get_expenses_over_time, get_expenses_by_category,
-    get_transaction_tags, get_monthly_summary, get_yearly_summary, get_current_savings
+    set_transaction_tags, add_savings_goal, get_savings_status, mark_goals_achieved,
+    get_all_budgets, get_budget_status, BUDGET_STATUSES, BUDGET_PERIODS, get_report_bundle,
+    add_incomes_bulk, add_expenses_bulk, get_exchange_rates, get_transactions_page, query_transactions,
+    invalidate, db, to_minor,
+    backup_database, restore_database,
+    query_stats, collect_query_stats, reset_query_stats, cache_stats
 )
 import pandas as pd
-import matplotlib.pyplot as plt
-import plotly.express as px
-from datetime import datetime
-import bcrypt
-from io import BytesIO
+import numpy as np
+from datetime import datetime, timedelta
+import json
 import os
-from reportlab.platypus import SimpleDocTemplate, Table
-from reportlab.lib.pagesizes import letter
+import tempfile
+from pathlib import Path
+from exports import EXPORT_DATA_TYPES, EXPORT_FORMATS, TRANSACTION_EXPORTS, export_to_file
+from forecast import forecast_expenses
+from process_recurring import start_scheduler
 
 # =========================
-# Authentication Setup
+# Setup
 # =========================
 
-# Load configuration from config.yaml
-with open('config.yaml') as file:
-    config = yaml.load(file, Loader=SafeLoader)
-
-authenticator = stauth.Authenticate(
-    config['credentials'],
-    config['cookie']['name'],
-    config['cookie']['key'],
-    config['cookie']['expiry_days'],
-    config['preauthorized']
-)
-
-name, authentication_status, username = authenticator.login('Login', 'main')
-
-if authentication_status:
-    # Logout button
-    authenticator.logout('Logout', 'sidebar')
-    st.sidebar.title(f'Welcome *{name}*')
-
-    # =========================
-    # Streamlit App Setup
-    # =========================
-
-    # Set page configuration
-    st.set_page_config(page_title="Personal Finance App", layout="wide", page_icon="💰")
-
-    # Theme Toggle
-    def local_css(file_name):
-        with open(file_name) as f:
-            st.markdown(f'<style>{f.read()}</style>', unsafe_allow_html=True)
-
-    def toggle_dark_mode():
-        st.sidebar.header("🌙 Theme")
-        theme = st.sidebar.radio("Choose Theme", ["Light", "Dark"])
-        if theme == "Dark":
-            local_css("dark.css")
-        else:
-            local_css("light.css")
-
-    toggle_dark_mode()
-
-    # Currency Settings
-    def get_exchange_rates(base_currency='USD'):
-        # Placeholder for exchange rates API integration
-        # For demonstration, using static rates
-        return {
-            'USD': 1.0,
-            'EUR': 0.85,
-            'GBP': 0.75,
-            'JPY': 110.0,
-            'CAD': 1.25
-            # Add more currencies as needed
-        }
-
-    def set_currency(user):
-        st.sidebar.header("💱 Currency Settings")
-        rates = get_exchange_rates()
-        currency = st.sidebar.selectbox("Select your preferred currency", sorted(rates.keys()), index=0)
-        st.session_state['currency'] = currency
-        st.session_state['rates'] = rates
-
-    set_currency(username)
-
-    # Navigation Menu
-    menu = ["Dashboard", "Add Income", "Add Expense", "Add Category", "Add Subcategory",
-            "Add Tag", "Set Budget", "Add Recurring Transaction", "Set Savings Goal",
-            "Track Budget", "Savings Tracker", "Reports", "Manage Entries", "Export Data",
-            "Backup & Restore", "Expense Prediction"]
-    choice = st.sidebar.selectbox("Menu", menu)
+# Parsed once per server process instead of on every rerun
+@st.cache_resource
+def load_config():
+    with open('config.yaml') as file:
+        return yaml.load(file, Loader=SafeLoader)
 
-    if choice == "Dashboard":
-        dashboard(username)
-    elif choice == "Add Income":
-        add_income_form(username)
-    elif choice == "Add Expense":
-        add_expense_form(username)
-    elif choice == "Add Category":
-        add_category_form(username)
-    elif choice == "Add Subcategory":
-        add_subcategory_form(username)
-    elif choice == "Add Tag":
-        add_tag_form(username)
-    elif choice == "Set Budget":
-        set_budget_form(username)
-    elif choice == "Add Recurring Transaction":
-        add_recurring_form(username)
-    elif choice == "Set Savings Goal":
-        set_savings_goal_form(username)
-    elif choice == "Track Budget":
-        track_budget(username)
-    elif choice == "Savings Tracker":
-        savings_tracker(username)
-    elif choice == "Reports":
-        generate_report(username)
-    elif choice == "Manage Entries":
-        manage_entries_menu(username)
-    elif choice == "Export Data":
-        export_data(username)
-    elif choice == "Backup & Restore":
-        backup_restore(username)
-    elif choice == "Expense Prediction":
-        expense_prediction(username)
+# One-time, process-wide setup. The schema is created when database is first
+# imported, so reruns never repeat its DDL.
+@st.cache_resource
+def setup_app():
+    config = load_config()
+    # Post recurring transactions as they fall due from a background thread,
+    # when enabled, instead of relying on a cron job
+    if config.get('recurring', {}).get('scheduler', False):
+        start_scheduler()
+    # Query instrumentation: the slow-query threshold
+    instrumentation = config.get('instrumentation', {})
+    query_stats.enabled = instrumentation.get('enabled', True)
+    query_stats.slow_ms = instrumentation.get('slow_query_ms', query_stats.slow_ms)
 
-else:
-    if authentication_status == False:
-        st.error('Username/password is incorrect')
-    elif authentication_status == None:
-        st.warning('Please enter your username and password')
+@st.cache_data
+def read_css(file_name):
+    with open(file_name) as f:
+        return f.read()
 
 # =========================
 # Function Definitions
@@ -149,19 +68,9 @@ def add_income_form(user):
         submitted = st.form_submit_button("Add Income")
         if submitted:
             final_subcategory = subcategory if subcategory != "None" else None
-            success, message = add_income(user, date.strftime("%Y-%m-%d"), category, final_subcategory, amount, currency)
+            success, message = add_income(user, date.strftime("%Y-%m-%d"), category, final_subcategory, amount, currency, tags=tags)
             if success:
-                # Associate tags
-                if tags:
-                    # Fetch transaction ID
-                    c.execute("SELECT last_insert_rowid()")
-                    transaction_id = c.fetchone()[0]
-                    for tag in tags:
-                        c.execute("SELECT id FROM tags WHERE user = ? AND tag = ?", (user, tag))
-                        tag_id = c.fetchone()[0]
-                        associate_tag(transaction_id, tag_id)
                 st.success(message)
-                st.cache_data.clear()
             else:
                 st.error(message)
 
@@ -177,19 +86,9 @@ def add_expense_form(user):
         submitted = st.form_submit_button("Add Expense")
         if submitted:
             final_subcategory = subcategory if subcategory != "None" else None
-            success, message = add_expense(user, date.strftime("%Y-%m-%d"), category, final_subcategory, amount, currency)
+            success, message = add_expense(user, date.strftime("%Y-%m-%d"), category, final_subcategory, amount, currency, tags=tags)
             if success:
-                # Associate tags
-                if tags:
-                    # Fetch transaction ID
-                    c.execute("SELECT last_insert_rowid()")
-                    transaction_id = c.fetchone()[0]
-                    for tag in tags:
-                        c.execute("SELECT id FROM tags WHERE user = ? AND tag = ?", (user, tag))
-                        tag_id = c.fetchone()[0]
-                        associate_tag(transaction_id, tag_id)
                 st.success(message)
-                st.cache_data.clear()
             else:
                 st.error(message)
 
@@ -206,7 +105,6 @@ def add_category_form(user):
                 success, message = add_category(user, trans_type.lower(), category.strip())
                 if success:
                     st.success(message)
-                    st.cache_data.clear()
                 else:
                     st.error(message)
 
@@ -223,7 +121,6 @@ def add_subcategory_form(user):
                 success, message = add_subcategory(user, category, subcategory.strip())
                 if success:
                     st.success(message)
-                    st.cache_data.clear()
                 else:
                     st.error(message)
 
@@ -239,7 +136,6 @@ def add_tag_form(user):
                 success, message = add_tag(user, tag.strip())
                 if success:
                     st.success(message)
-                    st.cache_data.clear()
                 else:
                     st.error(message)
 
@@ -250,13 +146,14 @@ def set_budget_form(user):
         subcategory = st.selectbox("Subcategory", ["None"] + get_subcategories(user, category))
         amount = st.number_input("Budget Amount", min_value=0.0, format="%.2f")
         currency = st.selectbox("Currency", sorted(get_exchange_rates().keys()), index=0)
+        period = st.selectbox("Period", list(BUDGET_PERIODS), index=1, format_func=str.capitalize)
+        rollover = st.checkbox("Carry what is left (or overspent) into the next period")
         submitted = st.form_submit_button("Set Budget")
         if submitted:
             final_subcategory = subcategory if subcategory != "None" else None
-            success, message = set_budget(user, category, final_subcategory, amount, currency)
+            success, message = set_budget(user, category, final_subcategory, amount, currency, period, rollover)
             if success:
                 st.success(message)
-                st.cache_data.clear()
             else:
                 st.error(message)
 
@@ -277,7 +174,6 @@ def add_recurring_form(user):
             success, message = add_recurring(user, trans_type.lower(), date.strftime("%Y-%m-%d"), category, final_subcategory, amount, frequency.lower(), currency)
             if success:
                 st.success(message)
-                st.cache_data.clear()
             else:
                 st.error(message)
 
@@ -294,69 +190,54 @@ def set_savings_goal_form(user):
                 success, message = add_savings_goal(user, goal_amount, target_date.strftime("%Y-%m-%d"))
                 if success:
                     st.success(message)
-                    st.cache_data.clear()
                 else:
                     st.error(message)
 
+# Shown next to totals that leave out transactions without a USD rate
+def warn_unconverted(count):
+    if count:
+        st.warning(f"{count} transaction(s) use a currency without an exchange rate for their date "
+                   "and are not included in these totals.")
+
 def dashboard(user):
     st.header("📊 Dashboard")
     
-    # Fetch recent incomes
-    st.subheader("Recent Incomes")
     try:
-        income_df = get_recent_transactions(user, 'income', limit=5)
-        st.dataframe(income_df)
+        today = datetime.today()
+        report = get_report_bundle(user, today.replace(day=1).strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d"))
     except Exception as e:
-        st.error(f"Error fetching income data: {e}")
+        st.error(f"Error fetching dashboard data: {e}")
+        return
     
-    # Fetch recent expenses
+    # Recent incomes
+    st.subheader("Recent Incomes")
+    st.dataframe(report.recent_income)
+    
+    # Recent expenses
     st.subheader("Recent Expenses")
-    try:
-        expense_df = get_recent_transactions(user, 'expense', limit=5)
-        st.dataframe(expense_df)
-    except Exception as e:
-        st.error(f"Error fetching expense data: {e}")
+    st.dataframe(report.recent_expenses)
     
     # Display Current Savings
     st.subheader("Current Savings")
-    try:
-        current_savings = get_current_savings(user)
-        st.metric("Total Savings", f"${current_savings:,.2f}")
-    except Exception as e:
-        st.error(f"Error fetching savings data: {e}")
+    st.metric("Total Savings", f"${report.current_savings:,.2f}")
+    warn_unconverted(report.unconverted)
 
 def track_budget(user):
     st.header("📈 Track Budget")
     
+    # Plotly is imported by the pages that chart, not at startup
+    import plotly.express as px
+    
     try:
-        # Fetch all budgets
-        budget_df = get_all_budgets(user)
+        # Budgets against what has been spent in their current period
+        merged_df = get_budget_status(user, datetime.today().strftime("%Y-%m-%d"))
         
-        if budget_df.empty:
+        if merged_df.empty:
             st.info("No budgets set. Please set a budget first.")
             return
         
-        # Calculate spent per category
-        spent_df = get_spent_per_category(user)
-        
-        # Merge budget and spent data
-        merged_df = pd.merge(budget_df, spent_df, on=['category', 'subcategory'], how='left').fillna(0)
-        merged_df.rename(columns={'category': 'Category', 'subcategory': 'Subcategory', 'amount': 'Budgeted', 'Spent': 'Spent'}, inplace=True)
-        merged_df['Remaining'] = merged_df['Budgeted'] - merged_df['Spent']
-        
-        # Determine status
-        def determine_status(row):
-            if row['Remaining'] < 0:
-                return "Over Budget"
-            elif row['Remaining'] < 0.1 * row['Budgeted']:
-                return "Almost Over"
-            else:
-                return "Within Budget"
-        
-        merged_df['Status'] = merged_df.apply(determine_status, axis=1)
-        
         # Filters
-        status_filter = st.multiselect("Filter by Status", options=["Over Budget", "Almost Over", "Within Budget"], default=["Over Budget", "Almost Over", "Within Budget"])
+        status_filter = st.multiselect("Filter by Status", options=BUDGET_STATUSES, default=BUDGET_STATUSES)
         category_filter = st.multiselect("Filter by Category", options=merged_df['Category'].unique())
         
         if category_filter:
@@ -365,6 +246,8 @@ def track_budget(user):
         if status_filter:
             merged_df = merged_df[merged_df['Status'].isin(status_filter)]
         
+        st.caption("Spending in each budget's current period, in USD; budgets set in other currencies are "
+                   "converted at today's rate. Carried is what rollover budgets brought from their previous period.")
         st.dataframe(merged_df)
         
         # Plotting with Plotly for Interactivity
@@ -387,165 +270,74 @@ def track_budget(user):
     except Exception as e:
         st.error(f"Error tracking budget: {e}")
 
+# Record goals this render found newly reached, in one write
+def record_achieved_goals(user, goals):
+    newly = goals.loc[goals['Newly Achieved'], 'id']
+    if not newly.empty:
+        st.success(f"Congratulations! You've achieved {len(newly)} savings goal(s).")
+        success, message = mark_goals_achieved(user, newly.tolist())
+        if not success:
+            st.error(message)
+
+def show_savings_goal(goal):
+    st.write(f"**Goal Amount:** ${goal['Goal']:,.2f}")
+    st.write(f"**Target Date:** {goal['Target Date']}")
+    st.progress(int(min(max(goal['Progress'], 0), 100)))
+    st.write(f"**Current Savings:** ${goal['Saved']:,.2f} ({goal['Progress']:.2f}%)")
+    if pd.notna(goal['Projected Date']):
+        st.write(f"**Projected Completion:** {goal['Projected Date']:%Y-%m-%d}")
+    st.write(f"**Status:** {goal['Status']}")
+
 def savings_tracker(user):
     st.header("💰 Savings Tracker")
     
     try:
-        # Fetch savings goals
-        savings_goals = get_savings_goals(user)
-        if not savings_goals:
+        # Net savings and every goal, evaluated once
+        savings = get_savings_status(user)
+        if savings.goals.empty:
             st.info("No savings goals set.")
             return
         
-        # Calculate current savings
-        current_savings = get_current_savings(user)
+        col1, col2 = st.columns(2)
+        col1.metric("Net Savings", f"${savings.net_savings:,.2f}")
+        col2.metric("Saved per Month", f"${savings.monthly_rate:,.2f}")
         
-        for goal in savings_goals:
-            goal_id, goal_amount, target_date, achieved = goal
-            progress = (current_savings / goal_amount) * 100 if goal_amount > 0 else 0
-            st.subheader(f"Savings Goal ID: {goal_id}")
-            st.write(f"**Goal Amount:** ${goal_amount:,.2f}")
-            st.write(f"**Target Date:** {target_date}")
-            st.progress(min(progress, 100))
-            st.write(f"**Current Savings:** ${current_savings:,.2f} ({progress:.2f}%)")
-            
-            if progress >= 100 and not achieved:
-                st.success("Congratulations! You've achieved your savings goal.")
-                # Update the goal as achieved
-                c.execute("UPDATE savings_goals SET achieved = 1 WHERE id = ?", (goal_id,))
-                conn.commit()
+        for _, goal in savings.goals.iterrows():
+            st.subheader(f"Savings Goal ID: {goal['id']}")
+            show_savings_goal(goal)
+        record_achieved_goals(user, savings.goals)
     except Exception as e:
         st.error(f"Error tracking savings: {e}")
 
-def generate_report(user):
-    st.header("📄 Financial Report")
-    
-    try:
-        # Fetch exchange rates
-        rates = st.session_state.get('rates', get_exchange_rates())
-        preferred_currency = st.session_state.get('currency', 'USD')
-        
-        # Total Income
-        total_income = get_total_income(user)
-        total_income_converted = convert_currency(total_income, 'USD', preferred_currency, rates)
-        
-        # Total Expenses
-        total_expenses = get_total_expenses(user)
-        total_expenses_converted = convert_currency(total_expenses, 'USD', preferred_currency, rates)
-        
-        # Balance
-        balance = total_income_converted - total_expenses_converted
-        
-        # Display Metrics
-        col1, col2, col3 = st.columns(3)
-        col1.metric("Total Income", f"{preferred_currency} ${total_income_converted:,.2f}")
-        col2.metric("Total Expenses", f"{preferred_currency} ${total_expenses_converted:,.2f}")
-        col3.metric("Balance", f"{preferred_currency} ${balance:,.2f}")
-        
-        # Income and Expenses Over Time with Date Range Filter
-        st.subheader("Income and Expenses Over Time")
-        
-        with st.expander("Filter Date Range"):
-            start_date = st.date_input("Start Date", datetime.today() - pd.DateOffset(months=6))
-            end_date = st.date_input("End Date", datetime.today())
-        
-        income_over_time = get_income_over_time(user, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
-        expenses_over_time = get_expenses_over_time(user, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
-        
-        # Plotting with Plotly
-        fig = px.line(title='Income vs Expenses Over Time', width=800, height=400)
-        if not income_over_time.empty:
-            income_over_time['Amount'] = income_over_time['Amount'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-            fig.add_scatter(x=pd.to_datetime(income_over_time['date']), y=income_over_time['Amount'], mode='lines+markers', name='Income')
-        if not expenses_over_time.empty:
-            expenses_over_time['Amount'] = expenses_over_time['Amount'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-            fig.add_scatter(x=pd.to_datetime(expenses_over_time['date']), y=expenses_over_time['Amount'], mode='lines+markers', name='Expenses')
-        st.plotly_chart(fig, use_container_width=True)
-        
-        # Expenses by Category with Drill-Down
-        st.subheader("Expenses by Category")
-        
-        expenses_by_category = get_expenses_by_category(user)
-        if not expenses_by_category.empty:
-            expenses_by_category['Amount'] = expenses_by_category.apply(lambda row: convert_currency(row['Amount'], 'USD', preferred_currency, rates), axis=1)
-            fig = px.pie(expenses_by_category, names='category', values='Amount', title='Expenses by Category', hole=0.3)
-            st.plotly_chart(fig, use_container_width=True)
-            
-            # Drill-Down: Show transactions in a category when selected
-            selected_category = st.selectbox("Select a category to view transactions", [""] + expenses_by_category['category'].unique().tolist())
-            if selected_category:
-                transactions = get_transaction_tags(user, 'expense')
-                filtered_transactions = transactions[transactions['Category'] == selected_category]
-                if not filtered_transactions.empty:
-                    # Convert currency
-                    filtered_transactions['Amount'] = filtered_transactions.apply(
-                        lambda row: convert_currency(row['Amount'], row['Currency'], preferred_currency, rates), axis=1
-                    )
-                    st.subheader(f"Transactions for {selected_category}")
-                    st.dataframe(filtered_transactions[['Date', 'Category', 'Subcategory', 'Amount', 'Tags']])
-                else:
-                    st.info("No transactions found for this category.")
-        else:
-            st.info("No expenses to display.")
-        
-        # Monthly and Yearly Summaries
-        st.subheader("Monthly Summary")
-        monthly_df = get_monthly_summary(user, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
-        if not monthly_df.empty:
-            monthly_df['Total_Income'] = monthly_df['Total_Income'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-            monthly_df['Total_Expenses'] = monthly_df['Total_Expenses'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-            monthly_df['Balance'] = monthly_df['Balance'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-            fig = px.bar(monthly_df, x='Month', y=['Total_Income', 'Total_Expenses', 'Balance'], 
-                         barmode='group', title='Monthly Summary')
-            st.plotly_chart(fig, use_container_width=True)
-        else:
-            st.info("No monthly data to display.")
-        
-        st.subheader("Yearly Summary")
-        yearly_df = get_yearly_summary(user)
-        if not yearly_df.empty:
-            yearly_df['Total_Income'] = yearly_df['Total_Income'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-            yearly_df['Total_Expenses'] = yearly_df['Total_Expenses'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-            yearly_df['Balance'] = yearly_df['Balance'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-            fig = px.bar(yearly_df, x='Year', y=['Total_Income', 'Total_Expenses', 'Balance'], 
-                         barmode='group', title='Yearly Summary')
-            st.plotly_chart(fig, use_container_width=True)
-        else:
-            st.info("No yearly data to display.")
-        
-    except Exception as e:
-        st.error(f"Error generating report: {e}")
-
-def manage_entries_menu(user):
-    manage_menu = ["Manage Incomes", "Manage Expenses", "Manage Budgets", "Manage Savings Goals"]
-    manage_choice = st.selectbox("Manage Entries", manage_menu)
-    
-    if manage_choice == "Manage Incomes":
-        manage_incomes(user)
-    elif manage_choice == "Manage Expenses":
-        manage_expenses(user)
-    elif manage_choice == "Manage Budgets":
-        manage_budgets(user)
-    elif manage_choice == "Manage Savings Goals":
-        manage_savings_goals(user)
-
 def manage_incomes(user):
     st.header("📝 Manage Incomes")
     
     try:
-        # Fetch all incomes
-        income_df = get_recent_transactions(user, 'income', limit=1000)
-        if income_df.empty:
+        # Pagination settings: pages are fetched by keyset, and the cursor of
+        # each page visited is kept so Previous can step back
+        items_per_page = 10
+        cursors = st.session_state.setdefault('income_page_cursors', [None])
+        page = get_transactions_page(user, 'income', cursor=cursors[-1], page_size=items_per_page)
+        if page.rows.empty and len(cursors) > 1:
+            # The page emptied under us (e.g. its last entry was deleted)
+            st.session_state['income_page_cursors'] = [None]
+            st.experimental_rerun()
+        if page.rows.empty:
             st.info("No income entries to manage.")
             return
         
-        # Pagination settings
-        items_per_page = 10
-        total_pages = (len(income_df) // items_per_page) + 1
-        page = st.number_input("Page", min_value=1, max_value=total_pages, step=1)
-        start_idx = (page - 1) * items_per_page
-        end_idx = start_idx + items_per_page
-        paginated_df = income_df.iloc[start_idx:end_idx]
+        total_pages = max(1, -(-page.total // items_per_page))
+        col_previous, col_page, col_next = st.columns(3)
+        with col_previous:
+            if st.button("◀ Previous", disabled=len(cursors) == 1, key="previous_income_page"):
+                cursors.pop()
+                st.experimental_rerun()
+        col_page.write(f"Page {len(cursors)} of {total_pages} ({page.total} entries)")
+        with col_next:
+            if st.button("Next ▶", disabled=page.next_cursor is None, key="next_income_page"):
+                cursors.append(page.next_cursor)
+                st.experimental_rerun()
+        paginated_df = page.rows
         
         # Display paginated data with edit/delete options
         for index, row in paginated_df.iterrows():
@@ -555,27 +347,24 @@ def manage_incomes(user):
                 new_amount = st.number_input("Amount", min_value=0.0, value=row['Amount'], format="%.2f", key=f"amount_{row['id']}")
                 new_date = st.date_input("Date", pd.to_datetime(row['Date']), key=f"date_{row['id']}")
                 new_currency = st.selectbox("Currency", sorted(get_exchange_rates().keys()), index=0, key=f"currency_{row['id']}")
-                tags = st.multiselect("Tags", get_tags(user), default=row['Tags'].split(', ') if pd.notna(row['Tags']) else [])
+                tags = st.multiselect("Tags", get_tags(user), default=row['Tags'].split(', ') if pd.notna(row['Tags']) else [], key=f"tags_{row['id']}")
                 
                 col1, col2 = st.columns(2)
                 with col1:
                     if st.button("Update", key=f"update_income_{row['id']}"):
                         try:
-                            c.execute("""
-                                UPDATE income 
-                                SET date = ?, category = ?, subcategory = ?, amount = ?, currency = ?
-                                WHERE id = ?
-                            """, (new_date.strftime("%Y-%m-%d"), new_category, new_subcategory if new_subcategory else None, new_amount, new_currency, row['id']))
-                            conn.commit()
-                            
-                            # Update tags
-                            # First, delete existing associations
-                            c.execute("DELETE FROM transaction_tags WHERE transaction_id = ?", (row['id'],))
-                            # Associate new tags
-                            for tag in tags:
-                                c.execute("SELECT id FROM tags WHERE user = ? AND tag = ?", (user, tag))
-                                tag_id = c.fetchone()[0]
-                                associate_tag(row['id'], tag_id)
+                            with db.transaction() as conn:
+                                conn.execute("""
+                                    UPDATE income 
+                                    SET date = ?, category = ?, subcategory = ?, amount = ?, currency = ?
+                                    WHERE id = ?
+                                """, (new_date.strftime("%Y-%m-%d"), new_category, new_subcategory if new_subcategory else None, to_minor(new_amount, new_currency), new_currency, row['id']))
+                                invalidate(user, 'transactions')
+                                
+                                # Update tags
+                                success, message = set_transaction_tags(user, 'income', row['id'], tags)
+                                if not success:
+                                    raise RuntimeError(message)
                             
                             st.success("Income updated successfully.")
                             st.experimental_rerun()
@@ -584,10 +373,10 @@ def manage_incomes(user):
                 with col2:
                     if st.button("Delete", key=f"delete_income_{row['id']}"):
                         try:
-                            c.execute("DELETE FROM income WHERE id = ?", (row['id'],))
-                            # Also delete associated tags
-                            c.execute("DELETE FROM transaction_tags WHERE transaction_id = ?", (row['id'],))
-                            conn.commit()
+                            with db.transaction() as conn:
+                                # Its tag links are removed by the income_tags_delete trigger
+                                conn.execute("DELETE FROM income WHERE id = ?", (row['id'],))
+                                invalidate(user, 'transactions')
                             st.success("Income deleted successfully.")
                             st.experimental_rerun()
                         except Exception as e:
@@ -599,19 +388,31 @@ def manage_expenses(user):
     st.header("📝 Manage Expenses")
     
     try:
-        # Fetch all expenses
-        expense_df = get_recent_transactions(user, 'expense', limit=1000)
-        if expense_df.empty:
+        # Pagination settings: pages are fetched by keyset, and the cursor of
+        # each page visited is kept so Previous can step back
+        items_per_page = 10
+        cursors = st.session_state.setdefault('expense_page_cursors', [None])
+        page = get_transactions_page(user, 'expense', cursor=cursors[-1], page_size=items_per_page)
+        if page.rows.empty and len(cursors) > 1:
+            # The page emptied under us (e.g. its last entry was deleted)
+            st.session_state['expense_page_cursors'] = [None]
+            st.experimental_rerun()
+        if page.rows.empty:
             st.info("No expense entries to manage.")
             return
         
-        # Pagination settings
-        items_per_page = 10
-        total_pages = (len(expense_df) // items_per_page) + 1
-        page = st.number_input("Page", min_value=1, max_value=total_pages, step=1)
-        start_idx = (page - 1) * items_per_page
-        end_idx = start_idx + items_per_page
-        paginated_df = expense_df.iloc[start_idx:end_idx]
+        total_pages = max(1, -(-page.total // items_per_page))
+        col_previous, col_page, col_next = st.columns(3)
+        with col_previous:
+            if st.button("◀ Previous", disabled=len(cursors) == 1, key="previous_expense_page"):
+                cursors.pop()
+                st.experimental_rerun()
+        col_page.write(f"Page {len(cursors)} of {total_pages} ({page.total} entries)")
+        with col_next:
+            if st.button("Next ▶", disabled=page.next_cursor is None, key="next_expense_page"):
+                cursors.append(page.next_cursor)
+                st.experimental_rerun()
+        paginated_df = page.rows
         
         # Display paginated data with edit/delete options
         for index, row in paginated_df.iterrows():
@@ -621,27 +422,24 @@ def manage_expenses(user):
                 new_amount = st.number_input("Amount", min_value=0.0, value=row['Amount'], format="%.2f", key=f"amount_{row['id']}")
                 new_date = st.date_input("Date", pd.to_datetime(row['Date']), key=f"date_{row['id']}")
                 new_currency = st.selectbox("Currency", sorted(get_exchange_rates().keys()), index=0, key=f"currency_{row['id']}")
-                tags = st.multiselect("Tags", get_tags(user), default=row['Tags'].split(', ') if pd.notna(row['Tags']) else [])
+                tags = st.multiselect("Tags", get_tags(user), default=row['Tags'].split(', ') if pd.notna(row['Tags']) else [], key=f"tags_{row['id']}")
                 
                 col1, col2 = st.columns(2)
                 with col1:
                     if st.button("Update", key=f"update_expense_{row['id']}"):
                         try:
-                            c.execute("""
-                                UPDATE expense 
-                                SET date = ?, category = ?, subcategory = ?, amount = ?, currency = ?
-                                WHERE id = ?
-                            """, (new_date.strftime("%Y-%m-%d"), new_category, new_subcategory if new_subcategory else None, new_amount, new_currency, row['id']))
-                            conn.commit()
-                            
-                            # Update tags
-                            # First, delete existing associations
-                            c.execute("DELETE FROM transaction_tags WHERE transaction_id = ?", (row['id'],))
-                            # Associate new tags
-                            for tag in tags:
-                                c.execute("SELECT id FROM tags WHERE user = ? AND tag = ?", (user, tag))
-                                tag_id = c.fetchone()[0]
-                                associate_tag(row['id'], tag_id)
+                            with db.transaction() as conn:
+                                conn.execute("""
+                                    UPDATE expense 
+                                    SET date = ?, category = ?, subcategory = ?, amount = ?, currency = ?
+                                    WHERE id = ?
+                                """, (new_date.strftime("%Y-%m-%d"), new_category, new_subcategory if new_subcategory else None, to_minor(new_amount, new_currency), new_currency, row['id']))
+                                invalidate(user, 'transactions')
+                                
+                                # Update tags
+                                success, message = set_transaction_tags(user, 'expense', row['id'], tags)
+                                if not success:
+                                    raise RuntimeError(message)
                             
                             st.success("Expense updated successfully.")
                             st.experimental_rerun()
@@ -650,10 +448,10 @@ def manage_expenses(user):
                 with col2:
                     if st.button("Delete", key=f"delete_expense_{row['id']}"):
                         try:
-                            c.execute("DELETE FROM expense WHERE id = ?", (row['id'],))
-                            # Also delete associated tags
-                            c.execute("DELETE FROM transaction_tags WHERE transaction_id = ?", (row['id'],))
-                            conn.commit()
+                            with db.transaction() as conn:
+                                # Its tag links are removed by the expense_tags_delete trigger
+                                conn.execute("DELETE FROM expense WHERE id = ?", (row['id'],))
+                                invalidate(user, 'transactions')
                             st.success("Expense deleted successfully.")
                             st.experimental_rerun()
                         except Exception as e:
@@ -680,87 +478,67 @@ def manage_budgets(user):
         
         # Display paginated data with edit/delete options
         for index, row in paginated_df.iterrows():
-            with st.expander(f"Budget ID: {row['id']} - {row['category']} - ${row['amount']:.2f}"):
+            with st.expander(f"Budget ID: {row['id']} - {row['category']} - ${row['amount']:.2f} {row['period']}"):
                 new_category = st.text_input("Category", value=row['category'], key=f"category_budget_{row['id']}")
                 new_subcategory = st.text_input("Subcategory", value=row['subcategory'] if pd.notna(row['subcategory']) else "", key=f"subcategory_budget_{row['id']}")
                 new_amount = st.number_input("Budget Amount", min_value=0.0, value=row['amount'], format="%.2f", key=f"amount_budget_{row['id']}")
                 new_currency = st.selectbox("Currency", sorted(get_exchange_rates().keys()), index=0, key=f"currency_budget_{row['id']}")
+                new_period = st.selectbox("Period", list(BUDGET_PERIODS), index=list(BUDGET_PERIODS).index(row['period']),
+                                          format_func=str.capitalize, key=f"period_budget_{row['id']}")
+                new_rollover = st.checkbox("Carry over between periods", value=bool(row['rollover']), key=f"rollover_budget_{row['id']}")
                 
                 col1, col2 = st.columns(2)
                 with col1:
                     if st.button("Update", key=f"update_budget_{row['id']}"):
                         try:
-                            c.execute("""
-                                UPDATE budget 
-                                SET category = ?, subcategory = ?, amount = ?, currency = ?
-                                WHERE id = ?
-                            """, (new_category, new_subcategory if new_subcategory else None, new_amount, new_currency, row['id']))
-                            conn.commit()
+                            with db.transaction() as conn:
+                                conn.execute("""
+                                    UPDATE budget 
+                                    SET category = ?, subcategory = ?, amount = ?, currency = ?, period = ?, rollover = ?
+                                    WHERE id = ?
+                                """, (new_category, new_subcategory if new_subcategory else None, to_minor(new_amount, new_currency), new_currency,
+                                      new_period, int(new_rollover), row['id']))
+                                invalidate(user, 'budgets')
                             st.success("Budget updated successfully.")
-                            st.cache_data.clear()
                         except Exception as e:
                             st.error(f"Error updating budget: {e}")
                 with col2:
                     if st.button("Delete", key=f"delete_budget_{row['id']}"):
                         try:
-                            c.execute("DELETE FROM budget WHERE id = ?", (row['id'],))
-                            conn.commit()
+                            with db.transaction() as conn:
+                                conn.execute("DELETE FROM budget WHERE id = ?", (row['id'],))
+                                invalidate(user, 'budgets')
                             st.success("Budget deleted successfully.")
-                            st.cache_data.clear()
                         except Exception as e:
                             st.error(f"Error deleting budget: {e}")
     except Exception as e:
         st.error(f"Error managing budgets: {e}")
 
-def manage_savings_goals(user):
-    st.header("📝 Manage Savings Goals")
-    
-    try:
-        savings_goals = get_savings_goals(user)
-        if not savings_goals:
-            st.info("No savings goals set.")
-            return
-        
-        # Pagination settings
-        items_per_page = 10
-        total_pages = (len(savings_goals) // items_per_page) + 1
-        page = st.number_input("Page", min_value=1, max_value=total_pages, step=1)
-        start_idx = (page - 1) * items_per_page
-        end_idx = start_idx + items_per_page
-        paginated_goals = savings_goals[start_idx:end_idx]
-        
-        for goal in paginated_goals:
-            goal_id, goal_amount, target_date, achieved = goal
-            progress = (get_current_savings(user) / goal_amount) * 100 if goal_amount > 0 else 0
-            with st.expander(f"Savings Goal ID: {goal_id}"):
-                st.write(f"**Goal Amount:** ${goal_amount:,.2f}")
-                st.write(f"**Target Date:** {target_date}")
-                st.progress(min(progress, 100))
-                st.write(f"**Current Savings:** ${get_current_savings(user):,.2f} ({progress:.2f}%)")
-                
-                if progress >= 100 and not achieved:
-                    st.success("Congratulations! You've achieved your savings goal.")
-                    # Update the goal as achieved
-                    c.execute("UPDATE savings_goals SET achieved = 1 WHERE id = ?", (goal_id,))
-                    conn.commit()
-    except Exception as e:
-        st.error(f"Error managing savings goals: {e}")
+# Most rows the report drill-down shows at once
+DRILL_DOWN_LIMIT = 500
 
 def generate_report(user):
     st.header("📄 Financial Report")
     
+    import plotly.express as px
+    
     try:
         # Fetch exchange rates
         rates = st.session_state.get('rates', get_exchange_rates())
         preferred_currency = st.session_state.get('currency', 'USD')
         
+        with st.expander("Filter Date Range"):
+            start_date = st.date_input("Start Date", datetime.today() - timedelta(days=180))
+            end_date = st.date_input("End Date", datetime.today())
+        
+        # Every figure below comes from one consistent read of the database
+        report = get_report_bundle(user, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
+        
         # Total Income
-        total_income = get_total_income(user)
-        total_income_converted = convert_currency(total_income, 'USD', preferred_currency, rates)
+        total_income_converted = convert_currency(report.total_income, 'USD', preferred_currency, rates)
         
         # Total Expenses
-        total_expenses = get_total_expenses(user)
-        total_expenses_converted = convert_currency(total_expenses, 'USD', preferred_currency, rates)
+        total_expenses_converted = convert_currency(report.total_expenses, 'USD', preferred_currency, rates)
         
         # Balance
         balance = total_income_converted - total_expenses_converted
@@ -770,22 +548,20 @@ def generate_report(user):
         col1.metric("Total Income", f"{preferred_currency} ${total_income_converted:,.2f}")
         col2.metric("Total Expenses", f"{preferred_currency} ${total_expenses_converted:,.2f}")
         col3.metric("Balance", f"{preferred_currency} ${balance:,.2f}")
+        warn_unconverted(report.unconverted)
         
-        # Income and Expenses Over Time with Date Range Filter
+        # Income and Expenses Over Time for the selected date range
         st.subheader("Income and Expenses Over Time")
         
-        with st.expander("Filter Date Range"):
-            start_date = st.date_input("Start Date", datetime.today() - timedelta(days=180))
-            end_date = st.date_input("End Date", datetime.today())
-        
-        income_over_time = get_income_over_time(user, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
-        expenses_over_time = get_expenses_over_time(user, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
+        income_over_time = report.income_over_time
+        expenses_over_time = report.expenses_over_time
         
         # Convert amounts
-        if not income_over_time.empty:
-            income_over_time['Amount'] = income_over_time['Amount'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-        if not expenses_over_time.empty:
-            expenses_over_time['Amount'] = expenses_over_time['Amount'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
+        unknown_currency = False
+        for over_time in (income_over_time, expenses_over_time):
+            if not over_time.empty:
+                over_time['Amount'], unknown = convert_currency_array(over_time['Amount'], 'USD', preferred_currency, rates)
+                unknown_currency |= unknown.any()
         
         # Plotting with Plotly
         fig = px.line(title='Income vs Expenses Over Time', width=800, height=400)
@@ -794,28 +570,52 @@ def generate_report(user):
         if not expenses_over_time.empty:
             fig.add_scatter(x=pd.to_datetime(expenses_over_time['date']), y=expenses_over_time['Amount'], mode='lines+markers', name='Expenses')
         st.plotly_chart(fig, use_container_width=True)
-        
+
+        # Running balance at the end of each day with transactions
+        st.subheader("Running Balance")
+        balance_over_time = report.balance_over_time
+        if not balance_over_time.empty:
+            balance_over_time['Balance'], unknown = convert_currency_array(balance_over_time['Balance'], 'USD', preferred_currency, rates)
+            unknown_currency |= unknown.any()
+            balance_over_time['Date'] = pd.to_datetime(balance_over_time['Date'])
+            fig = px.line(balance_over_time, x='Date', y='Balance', line_shape='hv', title='Balance Over Time')
+            st.plotly_chart(fig, use_container_width=True)
+            warn_unconverted(int(balance_over_time['Unconverted'].iloc[-1]))
+        else:
+            st.info("No transactions in this date range.")
+
         # Expenses by Category with Drill-Down
         st.subheader("Expenses by Category")
         
-        expenses_by_category = get_expenses_by_category(user)
+        expenses_by_category = report.expenses_by_category
         if not expenses_by_category.empty:
-            expenses_by_category['Amount'] = expenses_by_category.apply(lambda row: convert_currency(row['Amount'], 'USD', preferred_currency, rates), axis=1)
+            expenses_by_category['Amount'], unknown = convert_currency_array(expenses_by_category['Amount'], 'USD', preferred_currency, rates)
+            unknown_currency |= unknown.any()
             fig = px.pie(expenses_by_category, names='category', values='Amount', title='Expenses by Category', hole=0.3)
             st.plotly_chart(fig, use_container_width=True)
             
-            # Drill-Down: Show transactions in a category when selected
+            # Drill-Down: Show transactions in a category when selected, filtered in the database
             selected_category = st.selectbox("Select a category to view transactions", [""] + expenses_by_category['category'].unique().tolist())
             if selected_category:
-                transactions = get_transaction_tags(user, 'expense')
-                filtered_transactions = transactions[transactions['Category'] == selected_category]
+                col1, col2, col3 = st.columns(3)
+                selected_subcategory = col1.selectbox("Subcategory", ["All"] + get_subcategories(user, selected_category), key="drill_down_subcategory")
+                selected_tags = col2.multiselect("Tags", get_tags(user), key="drill_down_tags")
+                tag_mode = col3.radio("Match Tags", ["any", "all"], key="drill_down_tag_mode")
+                filtered_transactions = query_transactions(
+                    user, 'expense', limit=DRILL_DOWN_LIMIT, category=selected_category,
+                    subcategory=selected_subcategory if selected_subcategory != "All" else None,
+                    tags=selected_tags, tag_mode=tag_mode,
+                )
                 if not filtered_transactions.empty:
                     # Convert currency
-                    filtered_transactions['Amount'] = filtered_transactions.apply(
-                        lambda row: convert_currency(row['Amount'], row['Currency'], preferred_currency, rates), axis=1
+                    filtered_transactions['amount'], unknown = convert_currency_array(
+                        filtered_transactions['amount'], filtered_transactions['currency'], preferred_currency, rates
                     )
+                    unknown_currency |= unknown.any()
                     st.subheader(f"Transactions for {selected_category}")
-                    st.dataframe(filtered_transactions[['Date', 'Category', 'Subcategory', 'Amount', 'Tags']])
+                    if len(filtered_transactions) == DRILL_DOWN_LIMIT:
+                        st.caption(f"Showing the {DRILL_DOWN_LIMIT} most recent matches.")
+                    st.dataframe(filtered_transactions[['date', 'category', 'subcategory', 'amount', 'Tags']].rename(columns=str.title))
                 else:
                     st.info("No transactions found for this category.")
         else:
@@ -823,11 +623,11 @@ def generate_report(user):
         
         # Monthly and Yearly Summaries
         st.subheader("Monthly Summary")
-        monthly_df = get_monthly_summary(user, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
+        monthly_df = report.monthly_summary
         if not monthly_df.empty:
-            monthly_df['Total_Income'] = monthly_df['Total_Income'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-            monthly_df['Total_Expenses'] = monthly_df['Total_Expenses'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-            monthly_df['Balance'] = monthly_df['Balance'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
+            columns = ['Total_Income', 'Total_Expenses', 'Balance']
+            monthly_df[columns], unknown = convert_currency_array(monthly_df[columns], 'USD', preferred_currency, rates)
+            unknown_currency |= unknown.any()
             fig = px.bar(monthly_df, x='Month', y=['Total_Income', 'Total_Expenses', 'Balance'], 
                          barmode='group', title='Monthly Summary')
             st.plotly_chart(fig, use_container_width=True)
@@ -835,17 +635,22 @@ def generate_report(user):
             st.info("No monthly data to display.")
         
         st.subheader("Yearly Summary")
-        yearly_df = get_yearly_summary(user)
+        yearly_df = report.yearly_summary
         if not yearly_df.empty:
-            yearly_df['Total_Income'] = yearly_df['Total_Income'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-            yearly_df['Total_Expenses'] = yearly_df['Total_Expenses'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
-            yearly_df['Balance'] = yearly_df['Balance'].apply(lambda x: convert_currency(x, 'USD', preferred_currency, rates))
+            columns = ['Total_Income', 'Total_Expenses', 'Balance']
+            yearly_df[columns], unknown = convert_currency_array(yearly_df[columns], 'USD', preferred_currency, rates)
+            unknown_currency |= unknown.any()
             fig = px.bar(yearly_df, x='Year', y=['Total_Income', 'Total_Expenses', 'Balance'], 
                          barmode='group', title='Yearly Summary')
             st.plotly_chart(fig, use_container_width=True)
         else:
             st.info("No yearly data to display.")
         
+        if unknown_currency:
+            st.warning("Some amounts use a currency without an exchange rate and were left out of the charts.")
+        
+        st.caption("Report data read in " + ", ".join(f"{section} {seconds * 1000:.1f} ms" for section, seconds in report.timings.items()))
+        
     except Exception as e:
         st.error(f"Error generating report: {e}")
 
@@ -862,162 +667,233 @@ def manage_entries_menu(user):
     elif manage_choice == "Manage Savings Goals":
         manage_savings_goals(user)
 
+# A download button for a file on disk. The file is only read when the button
+# is clicked, not on every rerun, but Streamlit then holds all of it in memory
+# while it is sent, so downloads are limited by the server's free memory.
+def download_file_button(label, path, file_name, mime):
+    st.download_button(label=label, data=Path(path).read_bytes, file_name=file_name, mime=mime)
+    st.caption("The file is read into the server's memory when you download it.")
+
 def export_data(user):
     st.header("📤 Export Data")
     
-    data_type = st.selectbox("Select Data to Export", ["Income", "Expenses", "Budget", "Tags", "Savings Goals"])
+    data_type = st.selectbox("Select Data to Export", EXPORT_DATA_TYPES)
+    export_format = st.selectbox("Select Format", list(EXPORT_FORMATS))
+    extension, mime = EXPORT_FORMATS[export_format]
+    
+    # Income and expenses can be narrowed down before exporting
+    filters = {}
+    if data_type in TRANSACTION_EXPORTS:
+        with st.expander("Filter Rows"):
+            category = st.selectbox("Category", ["All"] + get_categories(user, TRANSACTION_EXPORTS[data_type]), key="export_category")
+            if category != "All":
+                filters['category'] = category
+            tags = st.multiselect("Tags", get_tags(user), key="export_tags")
+            if tags:
+                filters['tags'] = tags
+                filters['tag_mode'] = st.radio("Match Tags", ["any", "all"], key="export_tag_mode")
+            if st.checkbox("Limit to a date range", key="export_date_range"):
+                col1, col2 = st.columns(2)
+                filters['start_date'] = col1.date_input("From", datetime.today().replace(day=1), key="export_start").strftime("%Y-%m-%d")
+                filters['end_date'] = col2.date_input("To", datetime.today(), key="export_end").strftime("%Y-%m-%d")
     
+    # Exports are written only when asked for, one format at a time, streaming
+    # rows from the database into a temporary file
     try:
-        if data_type == "Income":
-            df = get_transaction_tags(user, 'income')
-        elif data_type == "Expenses":
-            df = get_transaction_tags(user, 'expense')
-        elif data_type == "Budget":
-            df = get_all_budgets(user)
-        elif data_type == "Tags":
-            df = pd.DataFrame(get_tags(user), columns=['Tags'])
-        elif data_type == "Savings Goals":
-            df = pd.read_sql_query("SELECT * FROM savings_goals WHERE user = ?", conn, params=(user,))
-        else:
-            df = pd.DataFrame()
+        if st.button(f"Prepare {export_format} Export"):
+            previous = st.session_state.pop('export_file', None)
+            if previous and os.path.exists(previous['path']):
+                os.remove(previous['path'])
+            with st.spinner(f"Exporting {data_type.lower()} as {export_format}..."):
+                path, count = export_to_file(user, data_type, export_format, **filters)
+            st.session_state['export_file'] = {
+                'path': path, 'count': count, 'data_type': data_type, 'format': export_format, 'filters': filters,
+            }
         
-        if not df.empty:
-            # Export as CSV
-            csv = df.to_csv(index=False).encode('utf-8')
-            st.download_button(
-                label="Download CSV",
-                data=csv,
-                file_name=f"{data_type.lower()}_data_{datetime.today().strftime('%Y%m%d')}.csv",
-                mime='text/csv',
-            )
-            
-            # Export as Excel
-            try:
-                excel_buffer = BytesIO()
-                df.to_excel(excel_buffer, index=False, engine='openpyxl')
-                excel_buffer.seek(0)
-                st.download_button(
-                    label="Download Excel",
-                    data=excel_buffer,
-                    file_name=f"{data_type.lower()}_data_{datetime.today().strftime('%Y%m%d')}.xlsx",
-                    mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                )
-            except Exception as e:
-                st.warning("Excel export requires openpyxl library. Install it via pip install openpyxl.")
-            
-            # Export as JSON
-            json_data = df.to_json(orient='records')
-            st.download_button(
-                label="Download JSON",
-                data=json_data,
-                file_name=f"{data_type.lower()}_data_{datetime.today().strftime('%Y%m%d')}.json",
-                mime='application/json',
-            )
-            
-            # Export as PDF
-            try:
-                pdf_buffer = BytesIO()
-                doc = SimpleDocTemplate(pdf_buffer, pagesize=letter)
-                table_data = [df.columns.tolist()] + df.values.tolist()
-                table = Table(table_data)
-                doc.build([table])
-                pdf = pdf_buffer.getvalue()
-                pdf_buffer.close()
-                st.download_button(
-                    label="Download PDF",
-                    data=pdf,
-                    file_name=f"{data_type.lower()}_data_{datetime.today().strftime('%Y%m%d')}.pdf",
-                    mime='application/pdf',
+        prepared = st.session_state.get('export_file')
+        if (prepared and (prepared['data_type'], prepared['format'], prepared['filters']) == (data_type, export_format, filters)
+                and os.path.exists(prepared['path'])):
+            if prepared['count'] == 0:
+                st.info("No data available to export.")
+            else:
+                download_file_button(
+                    f"Download {export_format} ({prepared['count']} rows)",
+                    prepared['path'],
+                    f"{data_type.lower().replace(' ', '_')}_data_{datetime.today().strftime('%Y%m%d')}.{extension}",
+                    mime,
                 )
-            except ImportError:
-                st.warning("PDF export requires reportlab library. Install it via pip install reportlab.")
-        else:
-            st.info("No data available to export.")
+    except ImportError:
+        st.warning("Excel export requires openpyxl library. Install it via pip install openpyxl.")
+    except ValueError as e:
+        st.warning(str(e))
     except Exception as e:
         st.error(f"Error exporting data: {e}")
 
+def import_data(user):
+    st.header("📥 Import Data")
+    st.write("Upload a CSV with the same columns Export Data produces: "
+             "date, category, subcategory, amount, currency and Tags.")
+    
+    data_type = st.selectbox("Select Data to Import", ["Income", "Expenses"])
+    uploaded_file = st.file_uploader("Upload a CSV file", type=["csv"])
+    
+    if uploaded_file is not None and st.button("Import"):
+        add_bulk = add_incomes_bulk if data_type == "Income" else add_expenses_bulk
+        chunk_size = 5000
+        added, errors = 0, []
+        progress = st.progress(0)
+        try:
+            # Parse and insert one chunk at a time so memory stays bounded
+            # however long the statement is; each chunk is one transaction
+            chunks = pd.read_csv(uploaded_file, chunksize=chunk_size, dtype=str, keep_default_na=False)
+            for chunk_number, chunk in enumerate(chunks):
+                success, message, chunk_errors = add_bulk(user, chunk, row_offset=chunk_number * chunk_size)
+                if not success:
+                    st.error(message)
+                    break
+                added += len(chunk) - len(chunk_errors)
+                errors.extend(chunk_errors)
+                progress.progress(min(uploaded_file.tell() / max(uploaded_file.size, 1), 1.0))
+            st.success(f"Imported {added} {data_type.lower()} row(s).")
+            if errors:
+                st.warning(f"{len(errors)} row(s) were skipped because they are invalid.")
+                st.dataframe(pd.DataFrame(errors[:1000], columns=['Row', 'Error']))
+        except Exception as e:
+            st.error(f"Error importing data: {e}")
+
 def backup_restore(user):
     st.header("📤 Backup & Restore")
     
-    # Backup
+    # Backup: an online copy of the live database, written to a temporary file
+    # and read back into memory only when it is downloaded
     st.subheader("💾 Backup Database")
-    if st.button("Download Database Backup"):
-        try:
-            with open('finance_app.db', 'rb') as f:
-                db_data = f.read()
-            st.download_button(
-                label="Download Backup",
-                data=db_data,
-                file_name=f"finance_app_backup_{datetime.today().strftime('%Y%m%d')}.db",
-                mime='application/octet-stream',
-            )
-        except Exception as e:
-            st.error(f"Error creating backup: {e}")
+    if st.button("Create Database Backup"):
+        previous = st.session_state.pop('backup_file', None)
+        if previous and os.path.exists(previous):
+            os.remove(previous)
+        progress = st.progress(0)
+        with tempfile.NamedTemporaryFile(suffix=".db", delete=False) as f:
+            backup_path = f.name
+        success, message = backup_database(
+            backup_path, progress=lambda copied, total: progress.progress(copied / total if total else 1.0))
+        if success:
+            st.session_state['backup_file'] = backup_path
+            st.success(message)
+        else:
+            os.remove(backup_path)
+            st.error(message)
+    
+    backup_path = st.session_state.get('backup_file')
+    if backup_path and os.path.exists(backup_path):
+        download_file_button("Download Backup", backup_path,
+                             f"finance_app_backup_{datetime.today().strftime('%Y%m%d')}.db", 'application/octet-stream')
     
     # Restore
     st.subheader("🔄 Restore Database")
     uploaded_file = st.file_uploader("Upload your backup database file", type=["db"])
-    if uploaded_file is not None:
-        try:
-            with open('finance_app.db', 'wb') as f:
-                f.write(uploaded_file.getbuffer())
-            st.success("Database restored successfully. Please refresh the app.")
-            st.stop()
-        except Exception as e:
-            st.error(f"Error restoring database: {e}")
+    if uploaded_file is not None and st.button("Restore from Backup"):
+        with st.spinner("Checking and restoring backup..."):
+            success, message = restore_database(uploaded_file)
+        if success:
+            st.success(f"{message} Database restored successfully.")
+        else:
+            st.error(message)
+
+def query_stats_page(user):
+    st.header("🩺 Query Stats")
+    
+    import plotly.express as px
+    
+    if user not in admins:
+        st.error("Only admins can view query stats.")
+        return
+    
+    stats = collect_query_stats()
+    if not stats['enabled']:
+        st.info("Query instrumentation is turned off in config.yaml.")
+    
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Statements Run", sum(entry['calls'] for entry in stats['statements']))
+    col2.metric("Slow Queries", len(stats['slow_queries']))
+    col3.metric("Cache Hit Rate", f"{cache_stats()['hit_rate']:.0%}")
+    
+    columns = ['calls', 'rows', 'total_ms', 'mean_ms', 'p50_ms', 'p95_ms', 'max_ms']
+    
+    st.subheader("Statements")
+    st.dataframe(pd.DataFrame(stats['statements'], columns=['fingerprint'] + columns))
+    
+    st.subheader("Database Functions")
+    st.dataframe(pd.DataFrame(stats['functions'], columns=['function'] + columns))
+    
+    # Latency histogram of one statement
+    if stats['statements']:
+        st.subheader("Latency Histogram")
+        fingerprint = st.selectbox("Statement", [entry['fingerprint'] for entry in stats['statements']])
+        entry = next(entry for entry in stats['statements'] if entry['fingerprint'] == fingerprint)
+        bounds = stats['buckets_ms']
+        labels = [f"≤ {bound} ms" if bound is not None else f"> {bounds[-2]} ms" for bound in bounds]
+        fig = px.bar(x=labels, y=entry['histogram'], labels={'x': 'Latency', 'y': 'Calls'})
+        st.plotly_chart(fig, use_container_width=True)
+    
+    st.subheader(f"Slow Queries (over {stats['slow_ms']} ms)")
+    if stats['slow_queries']:
+        for entry in reversed(stats['slow_queries']):
+            with st.expander(f"{entry['at']} · {entry['ms']:,.1f} ms · {entry['rows']} rows"):
+                st.code(entry['sql'], language='sql')
+                st.write(f"Parameters: {entry['parameters']}")
+                st.text("\n".join(entry['plan']))
+    else:
+        st.info("No slow queries recorded.")
+    
+    col1, col2 = st.columns(2)
+    col1.download_button("Download as JSON", json.dumps(stats, indent=2),
+                         file_name="query_stats.json", mime="application/json")
+    if col2.button("Reset Stats"):
+        reset_query_stats()
+        st.success("Query stats cleared.")
 
 def expense_prediction(user):
     st.header("🔮 Expense Prediction")
     
+    import plotly.express as px
+    
+    col1, col2 = st.columns(2)
+    freq = col1.radio("Forecast", ["Daily", "Weekly"], horizontal=True).lower()
+    horizon = col2.slider("Periods Ahead", 4, 90, 30 if freq == 'daily' else 8)
+    
     try:
-        # Data Preparation
-        expense_df = pd.read_sql_query("""
-            SELECT date, amount 
-            FROM expense 
-            WHERE user = ?
-            ORDER BY date
-        """, conn, params=(user,))
-        
-        if expense_df.empty or len(expense_df) < 10:
+        forecast = forecast_expenses(user, horizon, freq)
+        if forecast is None:
             st.info("Not enough data for prediction.")
             return
         
-        # Convert dates to ordinal
-        expense_df['date'] = pd.to_datetime(expense_df['date'])
-        expense_df['date_ordinal'] = expense_df['date'].apply(lambda date: date.toordinal())
-        
-        X = expense_df[['date_ordinal']]
-        y = expense_df['amount']
-        
-        # Train-Test Split
-        from sklearn.model_selection import train_test_split
-        from sklearn.linear_model import LinearRegression
-        
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-        
-        # Train Model
-        model = LinearRegression()
-        model.fit(X_train, y_train)
-        
-        # Predict for next 30 days
-        last_date = expense_df['date'].max()
-        future_dates = [last_date + pd.Timedelta(days=i) for i in range(1, 31)]
-        future_ordinals = [[date.toordinal()] for date in future_dates]
-        predictions = model.predict(future_ordinals)
-        
-        # Convert predictions to preferred currency
+        # Convert amounts to preferred currency
         preferred_currency = st.session_state.get('currency', 'USD')
         rates = st.session_state.get('rates', get_exchange_rates())
-        predictions_converted = [convert_currency(x, 'USD', preferred_currency, rates) for x in predictions]
-        
-        prediction_df = pd.DataFrame({
-            'Date': future_dates,
-            'Predicted Expense': predictions_converted
-        })
+        history, _ = convert_currency_array(forecast.history, 'USD', preferred_currency, rates)
+        predicted, _ = convert_currency_array(forecast.forecast, 'USD', preferred_currency, rates)
         
-        fig = px.line(prediction_df, x='Date', y='Predicted Expense', title='Predicted Expenses for the Next 30 Days')
+        # The recent past next to the forecast
+        shown = min(len(history), 3 * horizon)
+        chart_df = pd.concat([
+            pd.DataFrame({'Date': forecast.history_dates[-shown:], 'Amount': history[-shown:], 'Series': 'Actual'}),
+            pd.DataFrame({'Date': forecast.dates, 'Amount': predicted, 'Series': 'Predicted'}),
+        ])
+        period = "Day" if freq == 'daily' else "Week"
+        fig = px.line(chart_df, x='Date', y='Amount', color='Series',
+                      title=f'Predicted Expenses per {period} for the Next {horizon} {period}s')
         st.plotly_chart(fig, use_container_width=True)
         
+        col1, col2, col3 = st.columns(3)
+        col1.metric(f"Predicted Total ({preferred_currency})", f"${predicted.sum():,.2f}")
+        if forecast.backtest['mae'] is not None:
+            mae, _ = convert_currency_array(forecast.backtest['mae'], 'USD', preferred_currency, rates)
+            col2.metric(f"Backtest Error per {period}", f"${float(mae):,.2f}")
+        if forecast.backtest['wape'] is not None:
+            col3.metric("Backtest Error Rate", f"{forecast.backtest['wape']:.0%}")
+        st.caption(f"Backtested over the last {forecast.backtest['folds']} windows of {horizon} {period.lower()}s. "
+                   f"Recurring rules contribute ${forecast.recurring.sum():,.2f} USD of the forecast.")
+        
     except Exception as e:
         st.error(f"Error in expense prediction: {e}")
 
@@ -1029,8 +905,8 @@ def manage_savings_goals(user):
     st.header("📝 Manage Savings Goals")
     
     try:
-        savings_goals = get_savings_goals(user)
-        if not savings_goals:
+        savings_goals = get_savings_status(user).goals
+        if savings_goals.empty:
             st.info("No savings goals set.")
             return
         
@@ -1040,23 +916,12 @@ def manage_savings_goals(user):
         page = st.number_input("Page", min_value=1, max_value=total_pages, step=1)
         start_idx = (page - 1) * items_per_page
         end_idx = start_idx + items_per_page
-        paginated_goals = savings_goals[start_idx:end_idx]
+        paginated_goals = savings_goals.iloc[start_idx:end_idx]
         
-        for goal in paginated_goals:
-            goal_id, goal_amount, target_date, achieved = goal
-            current_savings = get_current_savings(user)
-            progress = (current_savings / goal_amount) * 100 if goal_amount > 0 else 0
-            with st.expander(f"Savings Goal ID: {goal_id}"):
-                st.write(f"**Goal Amount:** ${goal_amount:,.2f}")
-                st.write(f"**Target Date:** {target_date}")
-                st.progress(min(progress, 100))
-                st.write(f"**Current Savings:** ${current_savings:,.2f} ({progress:.2f}%)")
-                
-                if progress >= 100 and not achieved:
-                    st.success("Congratulations! You've achieved your savings goal.")
-                    # Update the goal as achieved
-                    c.execute("UPDATE savings_goals SET achieved = 1 WHERE id = ?", (goal_id,))
-                    conn.commit()
+        for _, goal in paginated_goals.iterrows():
+            with st.expander(f"Savings Goal ID: {goal['id']}"):
+                show_savings_goal(goal)
+        record_achieved_goals(user, paginated_goals)
     except Exception as e:
         st.error(f"Error managing savings goals: {e}")
 
@@ -1068,9 +933,558 @@ def convert_currency(amount, from_currency, to_currency, rates):
     except KeyError:
         return amount  # If currency not found, return the original amount
 
+def convert_currency_array(amounts, from_currencies, to_currency, rates):
+    # Convert a whole array of amounts in one NumPy pass. from_currencies is a
+    # single code or one code per amount. Returns the converted array and a mask
+    # of the entries whose currency has no rate; those entries come back as NaN.
+    amounts = np.asarray(amounts, dtype=float)
+    codes = list(rates)
+    rate_vector = np.array([rates[code] for code in codes], dtype=float)
+    if isinstance(from_currencies, str):
+        positions = np.full(amounts.shape, codes.index(from_currencies) if from_currencies in rates else -1)
+    else:
+        positions = pd.Index(codes).get_indexer(np.asarray(from_currencies, dtype=object).ravel()).reshape(amounts.shape)
+    unknown = positions < 0
+    if to_currency not in rates:
+        return np.full(amounts.shape, np.nan), np.ones(amounts.shape, dtype=bool)
+    factors = np.where(unknown, np.nan, rates[to_currency] / rate_vector[positions])
+    return amounts * factors, unknown
+
 # =========================
 # Run the App
-# =========================   credentials:
+# =========================
+
+# Must be the first Streamlit call of every run
+st.set_page_config(page_title="Personal Finance App", layout="wide", page_icon="💰")
+
+config = load_config()
+setup_app()
+
+# Users allowed to see the collected query stats
+admins = config.get('instrumentation', {}).get('admins', [])
+
+# The authenticator's cookie manager is a component that has to render on
+# every run, so it is built per run from the cached config
+authenticator = stauth.Authenticate(
+    config['credentials'],
+    config['cookie']['name'],
+    config['cookie']['key'],
+    config['cookie']['expiry_days'],
+    config['preauthorized']
+)
+
+name, authentication_status, username = authenticator.login('Login', 'main')
+
+if authentication_status:
+    # Logout button
+    authenticator.logout('Logout', 'sidebar')
+    st.sidebar.title(f'Welcome *{name}*')
+
+    # Theme Toggle
+    def local_css(file_name):
+        st.markdown(f'<style>{read_css(file_name)}</style>', unsafe_allow_html=True)
+
+    def toggle_dark_mode():
+        st.sidebar.header("🌙 Theme")
+        theme = st.sidebar.radio("Choose Theme", ["Light", "Dark"])
+        if theme == "Dark":
+            local_css("dark.css")
+        else:
+            local_css("light.css")
+
+    toggle_dark_mode()
+
+    # Currency Settings
+    def set_currency(user):
+        st.sidebar.header("💱 Currency Settings")
+        rates = get_exchange_rates()
+        currency = st.sidebar.selectbox("Select your preferred currency", sorted(rates.keys()), index=0)
+        st.session_state['currency'] = currency
+        st.session_state['rates'] = rates
+
+    set_currency(username)
+
+    # Navigation Menu
+    menu = ["Dashboard", "Add Income", "Add Expense", "Add Category", "Add Subcategory",
+            "Add Tag", "Set Budget", "Add Recurring Transaction", "Set Savings Goal",
+            "Track Budget", "Savings Tracker", "Reports", "Manage Entries", "Export Data",
+            "Import Data", "Backup & Restore", "Expense Prediction"]
+    if username in admins:
+        menu.append("Query Stats")
+    choice = st.sidebar.selectbox("Menu", menu)
+
+    if choice == "Dashboard":
+        dashboard(username)
+    elif choice == "Add Income":
+        add_income_form(username)
+    elif choice == "Add Expense":
+        add_expense_form(username)
+    elif choice == "Add Category":
+        add_category_form(username)
+    elif choice == "Add Subcategory":
+        add_subcategory_form(username)
+    elif choice == "Add Tag":
+        add_tag_form(username)
+    elif choice == "Set Budget":
+        set_budget_form(username)
+    elif choice == "Add Recurring Transaction":
+        add_recurring_form(username)
+    elif choice == "Set Savings Goal":
+        set_savings_goal_form(username)
+    elif choice == "Track Budget":
+        track_budget(username)
+    elif choice == "Savings Tracker":
+        savings_tracker(username)
+    elif choice == "Reports":
+        generate_report(username)
+    elif choice == "Manage Entries":
+        manage_entries_menu(username)
+    elif choice == "Export Data":
+        export_data(username)
+    elif choice == "Import Data":
+        import_data(username)
+    elif choice == "Backup & Restore":
+        backup_restore(username)
+    elif choice == "Expense Prediction":
+        expense_prediction(username)
+    elif choice == "Query Stats":
+        query_stats_page(username)
+
+else:
+    if authentication_status == False:
+        st.error('Username/password is incorrect')
+    elif authentication_status == None:
+        st.warning('Please enter your username and password')   import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+from database import (
+    db, query_cache, _clear_exchange_rate_caches, _usd, rebuild_rollups, deferred_balances, minor_scale, to_minor,
+    get_monthly_summary, get_transaction_tags, get_budget_status, get_report_bundle,
+    get_transactions_page, query_transactions, get_savings_status, get_expenses_over_time
+)
+from exports import write_export
+from forecast import forecast_expenses
+from process_recurring import process_recurring_transactions
+
+BENCHMARK_BASELINE = 'benchmark_baseline.json'
+
+# Generated data ends on this date, so every run produces the same database
+GENERATED_UNTIL = '2025-06-30'
+
+# Categories with their subcategories and a typical amount (USD)
+EXPENSE_CATEGORIES = {
+    'Food': (['Groceries', 'Restaurants', 'Coffee'], 35),
+    'Rent': ([None], 1400),
+    'Utilities': (['Electricity', 'Water', 'Internet'], 80),
+    'Entertainment': (['Movies', 'Games', 'Concerts'], 40),
+    'Transportation': (['Fuel', 'Transit', 'Taxi'], 30),
+    'Healthcare': (['Pharmacy', 'Doctor'], 60),
+    'Other': ([None], 25),
+}
+INCOME_CATEGORIES = {
+    'Salary': ([None], 4200),
+    'Bonus': ([None], 1500),
+    'Investment': (['Dividends', 'Interest'], 120),
+    'Other': (['Gifts', 'Refunds'], 80),
+}
+TAGS = ['work', 'travel', 'family', 'subscription', 'tax', 'gift', 'reimbursable', 'vacation']
+
+# Most transactions are in USD; the rest spread over the seeded currencies,
+# with amounts scaled by their default rates and stored in minor units
+CURRENCIES = ['USD', 'EUR', 'GBP', 'JPY', 'CAD']
+CURRENCY_WEIGHTS = [0.8, 0.08, 0.05, 0.04, 0.03]
+CURRENCY_RATES = [1.0, 0.85, 0.75, 110.0, 1.25]
+
+# Months in each budget period
+BUDGET_MONTHS = {'weekly': 12 / 52, 'monthly': 1, 'quarterly': 3, 'yearly': 12}
+
+# Share of transactions that are income, and that carry tags
+INCOME_SHARE = 0.25
+TAGGED_SHARE = 0.2
+
+# =========================
+# Synthetic Data
+# =========================
+
+def _flatten(categories):
+    flat = [(category, subcategory, typical)
+            for category, (subcategories, typical) in categories.items()
+            for subcategory in subcategories]
+    return ([row[0] for row in flat], [row[1] for row in flat], np.array([row[2] for row in flat], dtype=float))
+
+# Transaction rows for one user and type: dates spread over three years up to
+# GENERATED_UNTIL, log-normal amounts around each category's typical amount
+def _transactions(rng, user, categories, count, first_id):
+    names, subcategories, typical = _flatten(categories)
+    until = np.datetime64(GENERATED_UNTIL, 'D')
+    dates = (until - rng.integers(0, 3 * 365, count)).astype(str)
+    picks = rng.integers(0, len(names), count)
+    currencies = rng.choice(len(CURRENCIES), count, p=CURRENCY_WEIGHTS)
+    scales = np.array([minor_scale(currency) for currency in CURRENCIES])
+    amounts = np.round(typical[picks] * rng.lognormal(0, 0.5, count) * np.take(CURRENCY_RATES, currencies)
+                       * scales[currencies]).astype(np.int64)
+    return [
+        (first_id + i, user, dates[i], names[picks[i]], subcategories[picks[i]], int(amounts[i]),
+         CURRENCIES[currencies[i]])
+        for i in range(count)
+    ]
+
+# One or two tags on a share of the transactions
+def _tag_links(rng, trans_type, first_id, count, tag_ids):
+    tagged = np.flatnonzero(rng.random(count) < TAGGED_SHARE)
+    links = set()
+    for offset in tagged:
+        for tag in rng.choice(len(tag_ids), rng.integers(1, 3), replace=False):
+            links.add((trans_type, first_id + int(offset), tag_ids[tag]))
+    return sorted(links)
+
+# Populate the database with users x transactions_per_user transactions, plus
+# budgets, recurring rules, savings goals, custom subcategories and tags for
+# every user. The same arguments always generate the same data. Running it
+# again adds another batch of transactions, rules and goals; budgets are
+# updated in place and existing subcategories and tags kept.
+def generate_data(users, transactions_per_user, seed=0):
+    rng = np.random.default_rng(seed)
+    incomes = int(transactions_per_user * INCOME_SHARE)
+    expenses = transactions_per_user - incomes
+    until = datetime.strptime(GENERATED_UNTIL, "%Y-%m-%d")
+    with db.transaction() as conn:
+        next_income = conn.execute("SELECT IFNULL(MAX(id), 0) + 1 FROM income").fetchone()[0]
+        next_expense = conn.execute("SELECT IFNULL(MAX(id), 0) + 1 FROM expense").fetchone()[0]
+        for number in range(users):
+            user = f"user{number}"
+            conn.execute("""
+                INSERT OR IGNORE INTO users (username, name, email, password)
+                VALUES (?, ?, ?, 'not-a-password-hash')
+            """, (user, f"User {number}", f"{user}@example.com"))
+            conn.executemany("""
+                INSERT INTO subcategories (user, category, subcategory)
+                SELECT ?1, ?2, ?3
+                WHERE NOT EXISTS (SELECT 1 FROM subcategories WHERE user = ?1 AND category = ?2 AND subcategory = ?3)
+            """, [(user, category, subcategory)
+                  for categories in (EXPENSE_CATEGORIES, INCOME_CATEGORIES)
+                  for category, (subcategories, _) in categories.items()
+                  for subcategory in subcategories if subcategory])
+            conn.executemany("""
+                INSERT INTO tags (user, tag) SELECT ?1, ?2
+                WHERE NOT EXISTS (SELECT 1 FROM tags WHERE user = ?1 AND tag = ?2)
+            """, [(user, tag) for tag in TAGS])
+            tag_ids = [row[0] for row in conn.execute("SELECT id FROM tags WHERE user = ? ORDER BY id", (user,))]
+
+            insert = "INSERT INTO {} (id, user, date, category, subcategory, amount, currency) VALUES (?, ?, ?, ?, ?, ?, ?)"
+            with deferred_balances(conn, user):
+                conn.executemany(insert.format('income'), _transactions(rng, user, INCOME_CATEGORIES, incomes, next_income))
+                conn.executemany(insert.format('expense'), _transactions(rng, user, EXPENSE_CATEGORIES, expenses, next_expense))
+            conn.executemany("INSERT INTO transaction_tags (transaction_type, transaction_id, tag_id) VALUES (?, ?, ?)",
+                             _tag_links(rng, 'income', next_income, incomes, tag_ids)
+                             + _tag_links(rng, 'expense', next_expense, expenses, tag_ids))
+            next_income += incomes
+            next_expense += expenses
+
+            # Budgets on most expense subcategories, sized around the expected
+            # spend of their period so statuses come out mixed
+            per_month = expenses / (36 * sum(len(subcategories) for subcategories, _ in EXPENSE_CATEGORIES.values()))
+            conn.executemany("""
+                INSERT INTO budget (user, category, subcategory, amount, currency, period, rollover)
+                VALUES (?, ?, ?, ?, 'USD', ?, ?)
+                ON CONFLICT(user, category, IFNULL(subcategory, ''))
+                DO UPDATE SET amount=excluded.amount, currency=excluded.currency,
+                              period=excluded.period, rollover=excluded.rollover
+            """, [(user, category, subcategory, to_minor(typical * per_month * BUDGET_MONTHS[period] * rng.uniform(0.7, 1.5)),
+                   period, int(rng.random() < 0.3))
+                  for category, (subcategories, typical) in EXPENSE_CATEGORIES.items()
+                  for subcategory in subcategories if rng.random() < 0.8
+                  for period in [list(BUDGET_MONTHS)[rng.integers(0, len(BUDGET_MONTHS))]]])
+
+            # Salary, rent and a few subscriptions, each some days behind
+            rules = [('income', 'Salary', None, 4200, 'monthly'), ('expense', 'Rent', None, 1400, 'monthly'),
+                     ('expense', 'Entertainment', 'Movies', 15, 'monthly'),
+                     ('expense', 'Utilities', 'Internet', 60, 'monthly'),
+                     ('expense', 'Food', 'Coffee', 4, 'daily'), ('expense', 'Transportation', 'Transit', 25, 'weekly')]
+            for trans_type, category, subcategory, amount, frequency in rules:
+                date = until - timedelta(days=int(rng.integers(0, 28)))
+                conn.execute("""
+                    INSERT INTO recurring (user, type, date, category, subcategory, amount, frequency, currency, anchor_day)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 'USD', ?)
+                """, (user, trans_type, date.strftime("%Y-%m-%d"), category, subcategory, to_minor(amount), frequency,
+                      date.day))
+
+            # Savings goals from a few months' to a few years' worth of saving
+            conn.executemany("INSERT INTO savings_goals (user, goal_amount, target_date) VALUES (?, ?, ?)",
+                             [(user, to_minor(rng.uniform(1000, 50000)),
+                               (until + timedelta(days=int(rng.integers(30, 1100)))).strftime("%Y-%m-%d"))
+                              for _ in range(5)])
+    # The rollup triggers already ran per row; rebuilding checks nothing drifted
+    success, message = rebuild_rollups()
+    if not success:
+        raise RuntimeError(message)
+    return users * transactions_per_user
+
+# =========================
+# Benchmark Suite
+# =========================
+
+# Peak resident set size of this process so far, in MB (ru_maxrss is KB on
+# Linux and bytes on macOS)
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+# The calls each case times, against user0. Page cases are the data loads
+# behind those pages; Streamlit itself is not rendered.
+def _benchmark_cases(user='user0'):
+    until = datetime.strptime(GENERATED_UNTIL, "%Y-%m-%d")
+    year_ago = (until - timedelta(days=365)).strftime("%Y-%m-%d")
+    half_year_ago = (until - timedelta(days=180)).strftime("%Y-%m-%d")
+    month_start = until.replace(day=1).strftime("%Y-%m-%d")
+    catch_up_to = (until + timedelta(days=30)).strftime("%Y-%m-%d")
+
+    def export_csv():
+        with open(os.devnull, 'wb') as out:
+            return write_export(user, 'Expenses', 'CSV', out)
+
+    # The user's expenses in USD per category, summed the same way from int64
+    # cents (how amounts are stored and reports add up), float64 dollars and
+    # exact Decimal objects. The rows are read once, outside the timings.
+    with db.read() as conn:
+        expenses = pd.read_sql_query(f"SELECT category, IFNULL({_usd('expense')}, 0) AS cents FROM expense WHERE user = ?",
+                                     conn, params=(user,))
+    categories = expenses['category'].to_numpy()
+    amounts = {
+        'int64': expenses['cents'].astype(np.int64),
+        'float64': expenses['cents'] / 100,
+        'object': expenses['cents'].map(lambda cents: Decimal(int(cents)).scaleb(-2)),
+    }
+
+    def recurring_catch_up():
+        success, message = process_recurring_transactions(catch_up_to)
+        if not success:
+            raise RuntimeError(message)
+        return message
+
+    return {
+        'get_monthly_summary': lambda: get_monthly_summary(user),
+        'get_monthly_summary_year': lambda: get_monthly_summary(user, year_ago, GENERATED_UNTIL),
+        'get_transaction_tags': lambda: get_transaction_tags(user, 'expense'),
+        'budget_status': lambda: get_budget_status(user, GENERATED_UNTIL),
+        'export_csv': export_csv,
+        'page_dashboard': lambda: get_report_bundle(user, month_start, GENERATED_UNTIL),
+        'page_reports': lambda: get_report_bundle(user, half_year_ago, GENERATED_UNTIL),
+        'page_manage_expenses': lambda: get_transactions_page(user, 'expense'),
+        'page_drill_down': lambda: query_transactions(user, 'expense', 500, category='Food'),
+        'page_drill_down_month': lambda: query_transactions(user, 'expense', 500, start_date=month_start,
+                                                            end_date=GENERATED_UNTIL),
+        'expenses_over_time_year': lambda: get_expenses_over_time(user, year_ago, GENERATED_UNTIL),
+        'page_expense_prediction': lambda: forecast_expenses(user, 30, 'daily'),
+        'page_savings_tracker': lambda: get_savings_status(user, GENERATED_UNTIL),
+        'sum_by_category_int64': lambda: amounts['int64'].groupby(categories).sum(),
+        'sum_by_category_float64': lambda: amounts['float64'].groupby(categories).sum(),
+        'sum_by_category_object': lambda: amounts['object'].groupby(categories).sum(),
+        # Writes, so it runs once and last
+        'process_recurring': recurring_catch_up,
+    }
+
+# Time every case on the database in the working directory: the median of
+# repeat cold runs (caches cleared), then one more under tracemalloc for the
+# peak Python allocation
+def run_cases(repeat=3):
+    results = {}
+    for name, case in _benchmark_cases().items():
+        runs = []
+        for _ in range(1 if name == 'process_recurring' else repeat):
+            query_cache.clear()
+            _clear_exchange_rate_caches()
+            started = time.perf_counter()
+            case()
+            runs.append(time.perf_counter() - started)
+        peak_mb = None
+        if name != 'process_recurring':
+            query_cache.clear()
+            _clear_exchange_rate_caches()
+            tracemalloc.start()
+            case()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+        results[name] = {'seconds': round(statistics.median(runs), 4),
+                         'peak_mb': None if peak_mb is None else round(peak_mb, 2)}
+    results['peak_rss_mb'] = round(_peak_rss_mb(), 1)
+    return results
+
+# Generate a scratch database per size (users x size / users transactions) and
+# time the cases on it from a fresh process
+def run_suite(sizes, users=10, repeat=3):
+    script = os.path.abspath(__file__)
+    suite = {}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            started = time.perf_counter()
+            subprocess.run([sys.executable, script, 'generate', '--users', str(users),
+                            '--transactions', str(max(size // users, 1))], cwd=workdir, check=True,
+                           stdout=subprocess.DEVNULL)
+            generated = time.perf_counter() - started
+            result = subprocess.run([sys.executable, script, 'cases', '--repeat', str(repeat)],
+                                    cwd=workdir, check=True, capture_output=True, text=True)
+            suite[str(size)] = json.loads(result.stdout.strip().splitlines()[-1])
+            suite[str(size)]['generate_seconds'] = round(generated, 2)
+        print(f"{size} rows done.", file=sys.stderr)
+    return suite
+
+def _environment():
+    return {
+        'recorded': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+    }
+
+# Print the suite as a table, with the ratio to the baseline's time where there
+# is one. Returns the cases slower than tolerance x their baseline; cases under
+# min_seconds in both runs are too noisy to judge.
+def report(suite, baseline=None, tolerance=1.5, min_seconds=0.005):
+    regressions = []
+    print(f"{'rows':>9} {'case':<26} {'seconds':>9} {'peak MB':>9} {'baseline':>9} {'ratio':>7}")
+    for size, cases in suite.items():
+        for name, case in cases.items():
+            if not isinstance(case, dict):
+                continue
+            before = ((baseline or {}).get('results', {}).get(size, {}).get(name) or {}).get('seconds')
+            ratio = case['seconds'] / before if before else None
+            flag = ""
+            if ratio and ratio > tolerance and max(case['seconds'], before) >= min_seconds:
+                regressions.append(f"{size} rows {name}: {before:.4f}s -> {case['seconds']:.4f}s")
+                flag = " !"
+            peak = "-" if case['peak_mb'] is None else f"{case['peak_mb']:.1f}"
+            print(f"{size:>9} {name:<26} {case['seconds']:>9.4f} {peak:>9} "
+                  f"{'-' if before is None else f'{before:.4f}':>9} {'-' if ratio is None else f'{ratio:.2f}':>7}{flag}")
+        print(f"{size:>9} {'(peak RSS MB, generate s)':<26} {cases['peak_rss_mb']:>9.1f} {cases['generate_seconds']:>9.2f}")
+    return regressions
+
+# =========================
+# Startup
+# =========================
+
+# Modules app.py imports on every cold start, and heavy ones that should only
+# load when a page needs them
+STARTUP_MODULES = ['streamlit', 'streamlit_authenticator', 'yaml', 'numpy', 'pandas',
+                   'database', 'exports', 'forecast', 'process_recurring']
+LAZY_MODULES = ['plotly.express', 'openpyxl', 'matplotlib.pyplot']
+APP_FILES = ['app.py', 'config.yaml', 'dark.css', 'light.css']
+
+_IMPORT_TIMER = """
+import time
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+"""
+
+# Runs app.py headless with Streamlit's AppTest: the first run is a cold start
+# up to the login form, the second a rerun of the same session
+_FIRST_RENDER = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+started = time.perf_counter()
+app = AppTest.from_file('app.py', default_timeout=120)
+app.run()
+first_render = time.perf_counter() - started
+started = time.perf_counter()
+app.run()
+rerun = time.perf_counter() - started
+print(json.dumps({{
+    'first_render': first_render,
+    'rerun': rerun,
+    'errors': [str(error.value) for error in app.exception],
+    'lazy_loaded': [module for module in {lazy!r} if module in sys.modules],
+}}))
+"""
+
+def _run_python(code, workdir):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.run([sys.executable, '-c', code], cwd=workdir, env=env, capture_output=True, text=True)
+
+# Import time of each module in a fresh interpreter (including its own
+# dependencies, so the times overlap), and app.py's time to first render
+def run_startup():
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in APP_FILES:
+            if os.path.exists(os.path.join(here, name)):
+                shutil.copy(os.path.join(here, name), workdir)
+        print(f"{'module':<24} {'import s':>9}")
+        for module in STARTUP_MODULES + LAZY_MODULES:
+            result = _run_python(_IMPORT_TIMER.format(module=module), workdir)
+            seconds = f"{float(result.stdout.split()[-1]):9.3f}" if result.returncode == 0 else "  missing"
+            print(f"{module:<24} {seconds}{'  (lazy)' if module in LAZY_MODULES else ''}")
+
+        result = _run_python(_FIRST_RENDER.format(lazy=LAZY_MODULES), workdir)
+        if result.returncode:
+            print(f"First render not measured: {result.stderr.strip().splitlines()[-1]}")
+            return None
+        render = json.loads(result.stdout.strip().splitlines()[-1])
+        print(f"First render {render['first_render']:.3f}s, rerun {render['rerun']:.3f}s")
+        for error in render['errors']:
+            print(f"App error: {error}")
+        if render['lazy_loaded']:
+            print(f"Loaded before any page needed them: {', '.join(render['lazy_loaded'])}")
+        return render
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Synthetic data and data-layer benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate = commands.add_parser('generate', help="Populate finance_app.db with synthetic users and transactions")
+    generate.add_argument('--users', type=int, default=10)
+    generate.add_argument('--transactions', type=int, default=1000, help="Transactions per user")
+    generate.add_argument('--seed', type=int, default=0)
+    run = commands.add_parser('run', help="Time the data layer on generated databases of each size")
+    run.add_argument('--rows', type=int, nargs='+', default=[1000, 100000, 1000000])
+    run.add_argument('--users', type=int, default=10)
+    run.add_argument('--repeat', type=int, default=3)
+    run.add_argument('--save', nargs='?', const=BENCHMARK_BASELINE, help="Save the results as the baseline")
+    run.add_argument('--compare', nargs='?', const=BENCHMARK_BASELINE,
+                     help="Compare with a saved baseline and fail on regressions")
+    run.add_argument('--tolerance', type=float, default=1.5, help="Slowdown ratio counted as a regression")
+    commands.add_parser('startup', help="Report per-module import time and the app's time to first render")
+    cases = commands.add_parser('cases')
+    cases.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        count = generate_data(args.users, args.transactions, args.seed)
+        print(f"Generated {count} transactions for {args.users} users.")
+    elif args.command == 'startup':
+        run_startup()
+    elif args.command == 'cases':
+        print(json.dumps(run_cases(args.repeat)))
+    elif args.command == 'run':
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+        suite = run_suite(args.rows, args.users, args.repeat)
+        regressions = report(suite, baseline, args.tolerance)
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump({'environment': _environment(), 'results': suite}, f, indent=2)
+            print(f"Baseline saved to {args.save}.")
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        raise SystemExit(1 if regressions else 0)   credentials:
   usernames:
     johndoe:
       name: John Doe
@@ -1085,9 +1499,18 @@ cookie:
 preauthorized:
   emails:
     - johndoe@example.com
-    - janedoe@example.com   /* dark.css */
-
-body {
+    - janedoe@example.com
+recurring:
+  # Post recurring transactions from a background thread of the app server
+  # instead of running process_recurring.py from cron
+  scheduler: false
+instrumentation:
+  # Statements slower than this many milliseconds go to the slow-query log
+  # with their query plan
+  slow_query_ms: 250
+  # Users who can open the Query Stats page
+  admins:
+    - johndoe   body {
     background-color: #2E2E2E;
     color: white;
 }
@@ -1095,280 +1518,1519 @@ body {
 .css-1d391kg {
     background-color: #2E2E2E;
     color: white;
-}   # database.py
-
-import sqlite3
+}   import sqlite3
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from collections import OrderedDict, defaultdict, deque
+from functools import lru_cache, wraps
+from bisect import bisect_left
+from pathlib import Path
 import atexit
+import inspect
+import json
+import math
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+from typing import Optional
 
-# Connect to SQLite database
-conn = sqlite3.connect('finance_app.db', check_same_thread=False)
-c = conn.cursor()
-
-# Create tables if they don't exist
-def create_tables():
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            email TEXT NOT NULL,
-            password TEXT NOT NULL
-        )
-    ''')
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS income (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT NOT NULL,
-            date TEXT NOT NULL,
-            category TEXT NOT NULL,
-            subcategory TEXT,
-            amount REAL NOT NULL,
-            currency TEXT NOT NULL DEFAULT 'USD',
-            FOREIGN KEY(user) REFERENCES users(username)
-        )
-    ''')
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS expense (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT NOT NULL,
-            date TEXT NOT NULL,
-            category TEXT NOT NULL,
-            subcategory TEXT,
-            amount REAL NOT NULL,
-            currency TEXT NOT NULL DEFAULT 'USD',
-            FOREIGN KEY(user) REFERENCES users(username)
-        )
-    ''')
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS budget (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT NOT NULL,
-            category TEXT NOT NULL,
-            subcategory TEXT,
-            amount REAL NOT NULL,
-            currency TEXT NOT NULL DEFAULT 'USD',
-            FOREIGN KEY(user) REFERENCES users(username)
-        )
-    ''')
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS recurring (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT NOT NULL,
-            type TEXT NOT NULL, -- 'income' or 'expense'
-            date TEXT NOT NULL, -- Next occurrence date
-            category TEXT NOT NULL,
-            subcategory TEXT,
-            amount REAL NOT NULL,
-            frequency TEXT NOT NULL, -- 'daily', 'weekly', 'monthly'
-            currency TEXT NOT NULL DEFAULT 'USD',
-            FOREIGN KEY(user) REFERENCES users(username)
-        )
-    ''')
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS categories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT NOT NULL,
-            type TEXT NOT NULL, -- 'income' or 'expense'
-            category TEXT NOT NULL
-        )
-    ''')
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS subcategories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT NOT NULL,
-            category TEXT NOT NULL,
-            subcategory TEXT NOT NULL
-        )
-    ''')
+DB_PATH = 'finance_app.db'
+EXCHANGE_RATES_PATH = 'exchange_rates.csv'
 
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS tags (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT NOT NULL,
-            tag TEXT NOT NULL
-        )
-    ''')
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS transaction_tags (
-            transaction_id INTEGER,
-            tag_id INTEGER,
-            FOREIGN KEY(transaction_id) REFERENCES income(id),
-            FOREIGN KEY(tag_id) REFERENCES tags(id)
-        )
-    ''')
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS savings_goals (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT NOT NULL,
-            goal_amount REAL NOT NULL,
-            target_date TEXT NOT NULL,
-            achieved INTEGER NOT NULL DEFAULT 0,
-            FOREIGN KEY(user) REFERENCES users(username)
-        )
-    ''')
-
-    # Create indexes
-    c.execute("CREATE INDEX IF NOT EXISTS idx_income_user ON income (user)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_expense_user ON expense (user)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_budget_user ON budget (user)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_recurring_user ON recurring (user)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_categories_user ON categories (user)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_subcategories_user ON subcategories (user)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_tags_user ON tags (user)")
-    conn.commit()
+# Seed rates for databases without a loaded rate history
+DEFAULT_EXCHANGE_RATES = {
+    'USD': 1.0,
+    'EUR': 0.85,
+    'GBP': 0.75,
+    'JPY': 110.0,
+    'CAD': 1.25
+}
 
-create_tables()
+# Digits after the decimal point of a currency's minor unit, where not 2.
+# Amounts are stored as integers in minor units (cents for USD).
+CURRENCY_EXPONENTS = {
+    'JPY': 0, 'KRW': 0, 'VND': 0, 'CLP': 0, 'ISK': 0,
+    'BHD': 3, 'KWD': 3, 'OMR': 3, 'JOD': 3, 'TND': 3,
+}
 
-# Close the connection when the app stops
-@atexit.register
-def close_connection():
-    conn.close()
+# =========================
+# Query Instrumentation
+# =========================
 
-# Database Interaction Functions
+# Upper bounds (ms) of the latency histogram buckets; the last is open-ended
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, math.inf)
 
-def add_income(user, date, category, subcategory, amount, currency='USD'):
-    try:
-        c.execute("""
-            INSERT INTO income (user, date, category, subcategory, amount, currency)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (user, date, category, subcategory, amount, currency))
-        conn.commit()
-        return True, "Income added successfully."
-    except Exception as e:
-        return False, f"Error adding income: {e}"
+_SQL_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SQL_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
 
-def add_expense(user, date, category, subcategory, amount, currency='USD'):
-    try:
-        c.execute("""
-            INSERT INTO expense (user, date, category, subcategory, amount, currency)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (user, date, category, subcategory, amount, currency))
-        conn.commit()
-        return True, "Expense added successfully."
-    except Exception as e:
-        return False, f"Error adding expense: {e}"
+# Normalize a statement so every call of it shares one fingerprint: literals
+# become ?, lists of placeholders collapse to (?), comments and whitespace go
+@lru_cache(maxsize=1024)
+def sql_fingerprint(sql):
+    sql = _SQL_COMMENT.sub(" ", sql)
+    sql = _SQL_STRING.sub("?", sql)
+    sql = _SQL_NUMBER.sub("?", sql)
+    sql = _SQL_LIST.sub("(?)", sql)
+    return " ".join(sql.split())
 
-def set_budget(user, category, subcategory, amount, currency='USD'):
-    try:
-        c.execute("""
-            INSERT INTO budget (user, category, subcategory, amount, currency)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(user, category, subcategory) DO UPDATE SET amount=excluded.amount
-        """, (user, category, subcategory, amount, currency))
-        conn.commit()
-        return True, "Budget set successfully."
-    except Exception as e:
-        return False, f"Error setting budget: {e}"
+def _histogram_quantile(histogram, calls, q, max_ms):
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS, histogram):
+        seen += count
+        if seen >= q * calls:
+            return min(bound, max_ms)
+    return max_ms
 
-def add_recurring(user, trans_type, date, category, subcategory, amount, frequency, currency='USD'):
+# The plan SQLite picks for a slow statement, read through a plain cursor so
+# it is not itself recorded
+def _explain(connection, sql, parameters):
+    if not sql.lstrip().upper().startswith(('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')):
+        return []
+    if parameters is None:
+        return ["not captured for executemany"]
     try:
-        c.execute("""
-            INSERT INTO recurring (user, type, date, category, subcategory, amount, frequency, currency)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (user, trans_type, date, category, subcategory, amount, frequency, currency))
-        conn.commit()
-        return True, "Recurring transaction added successfully."
-    except Exception as e:
-        return False, f"Error adding recurring transaction: {e}"
+        rows = sqlite3.Cursor(connection).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+        return [row[3] for row in rows]
+    except sqlite3.Error as e:
+        return [f"not available: {e}"]
 
-def add_category(user, trans_type, category):
-    try:
-        c.execute("""
-            INSERT INTO categories (user, type, category)
-            VALUES (?, ?, ?)
-        """, (user, trans_type, category))
-        conn.commit()
-        return True, "Category added successfully."
-    except Exception as e:
-        return False, f"Error adding category: {e}"
+# One execution of a statement; its time and rows grow as they are fetched
+class _Execution:
+    __slots__ = ('connection', 'sql', 'parameters', 'fingerprint', 'ms', 'rows', 'slow_entry')
 
-def get_categories(user, trans_type):
-    c.execute("""
-        SELECT category FROM categories 
-        WHERE user = ? AND type = ?
-    """, (user, trans_type))
-    custom_categories = [row[0] for row in c.fetchall()]
-    default_categories = {
-        'income': ["Salary", "Bonus", "Investment", "Other"],
-        'expense': ["Food", "Rent", "Utilities", "Entertainment", "Transportation", "Healthcare", "Other"]
-    }
-    return default_categories[trans_type] + custom_categories
+    def __init__(self, connection, sql, parameters):
+        self.connection = connection
+        self.sql = sql
+        self.parameters = parameters
+        self.fingerprint = sql_fingerprint(sql)
+        self.ms = 0.0
+        self.rows = 0
+        self.slow_entry = None
 
-def add_subcategory(user, category, subcategory):
-    try:
-        c.execute("""
-            INSERT INTO subcategories (user, category, subcategory)
-            VALUES (?, ?, ?)
-        """, (user, category, subcategory))
-        conn.commit()
-        return True, "Subcategory added successfully."
-    except Exception as e:
-        return False, f"Error adding subcategory: {e}"
+# Per-fingerprint and per-function call counts, time, rows and latency
+# histograms, plus a bounded log of statements slower than slow_ms with their
+# query plans. Kept in memory for the life of the process.
+class QueryStats:
+    def __init__(self, slow_ms=250, slow_log_size=200):
+        self.enabled = True
+        self.slow_ms = slow_ms
+        self._statements = {}
+        self._functions = {}
+        self._slow = deque(maxlen=slow_log_size)
+        self._lock = threading.Lock()
 
-def get_subcategories(user, category):
-    c.execute("""
-        SELECT subcategory FROM subcategories 
-        WHERE user = ? AND category = ?
-    """, (user, category))
-    return [row[0] for row in c.fetchall()]
+    # Count one call taking ms. A call counted before (previous_ms) moves to
+    # the bucket for its new time instead, and rows adds to its rows.
+    def _add(self, table, key, ms, rows, previous_ms=None):
+        with self._lock:
+            entry = table.get(key)
+            if entry is None:
+                entry = table[key] = {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0,
+                                      'histogram': [0] * len(LATENCY_BUCKETS_MS)}
+            if previous_ms is None:
+                entry['calls'] += 1
+                entry['total_ms'] += ms
+            else:
+                entry['histogram'][bisect_left(LATENCY_BUCKETS_MS, previous_ms)] -= 1
+                entry['total_ms'] += ms - previous_ms
+            entry['histogram'][bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+            entry['max_ms'] = max(entry['max_ms'], ms)
+            entry['rows'] += rows
 
-def add_tag(user, tag):
-    try:
-        c.execute("""
-            INSERT INTO tags (user, tag)
-            VALUES (?, ?)
-        """, (user, tag))
-        conn.commit()
-        return True, "Tag added successfully."
-    except Exception as e:
-        return False, f"Error adding tag: {e}"
+    def executed(self, connection, sql, parameters, seconds, rows):
+        execution = _Execution(connection, sql, parameters)
+        execution.ms = seconds * 1000
+        execution.rows = rows
+        self._add(self._statements, execution.fingerprint, execution.ms, rows)
+        self._check_slow(execution)
+        return execution
 
-def get_tags(user):
-    c.execute("""
-        SELECT tag FROM tags 
-        WHERE user = ?
-    """, (user,))
-    return [row[0] for row in c.fetchall()]
+    def fetched(self, execution, seconds, rows):
+        previous_ms = execution.ms
+        execution.ms += seconds * 1000
+        execution.rows += rows
+        self._add(self._statements, execution.fingerprint, execution.ms, rows, previous_ms)
+        self._check_slow(execution)
 
-def associate_tag(transaction_id, tag_id):
-    try:
-        c.execute("""
-            INSERT INTO transaction_tags (transaction_id, tag_id)
-            VALUES (?, ?)
-        """, (transaction_id, tag_id))
-        conn.commit()
-        return True, "Tag associated successfully."
-    except Exception as e:
-        return False, f"Error associating tag: {e}"
+    def called(self, name, seconds, rows):
+        self._add(self._functions, name, seconds * 1000, rows)
 
+    def _check_slow(self, execution):
+        if execution.ms < self.slow_ms:
+            return
+        if execution.slow_entry is None:
+            parameters = "executemany" if execution.parameters is None else repr(execution.parameters)[:200]
+            execution.slow_entry = {
+                'at': datetime.now().isoformat(timespec='seconds'),
+                'fingerprint': execution.fingerprint,
+                'sql': " ".join(execution.sql.split()),
+                'parameters': parameters,
+                'ms': round(execution.ms, 3),
+                'rows': execution.rows,
+                'plan': _explain(execution.connection, execution.sql, execution.parameters),
+            }
+            with self._lock:
+                self._slow.append(execution.slow_entry)
+        else:
+            with self._lock:
+                execution.slow_entry['ms'] = round(execution.ms, 3)
+                execution.slow_entry['rows'] = execution.rows
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._functions.clear()
+            self._slow.clear()
+
+    @staticmethod
+    def _summary(entries, key_name):
+        summary = []
+        for key, entry in entries.items():
+            calls = entry['calls']
+            summary.append({
+                key_name: key,
+                'calls': calls,
+                'rows': entry['rows'],
+                'total_ms': round(entry['total_ms'], 3),
+                'mean_ms': round(entry['total_ms'] / calls, 3) if calls else 0.0,
+                'p50_ms': round(_histogram_quantile(entry['histogram'], calls, 0.5, entry['max_ms']), 3),
+                'p95_ms': round(_histogram_quantile(entry['histogram'], calls, 0.95, entry['max_ms']), 3),
+                'max_ms': round(entry['max_ms'], 3),
+                'histogram': entry['histogram'],
+            })
+        return sorted(summary, key=lambda item: item['total_ms'], reverse=True)
+
+    # A JSON-serializable copy of everything collected, busiest first
+    def snapshot(self):
+        with self._lock:
+            statements = {key: dict(entry, histogram=list(entry['histogram'])) for key, entry in self._statements.items()}
+            functions = {key: dict(entry, histogram=list(entry['histogram'])) for key, entry in self._functions.items()}
+            slow = [dict(entry) for entry in self._slow]
+        return {
+            'enabled': self.enabled,
+            'slow_ms': self.slow_ms,
+            'buckets_ms': [None if math.isinf(bound) else bound for bound in LATENCY_BUCKETS_MS],
+            'statements': self._summary(statements, 'fingerprint'),
+            'functions': self._summary(functions, 'function'),
+            'slow_queries': slow,
+        }
+
+query_stats = QueryStats()
+
+# Cursor that reports each statement to query_stats: the time spent in execute
+# and in fetching, and the rows fetched (or changed, for writes)
+class InstrumentedCursor(sqlite3.Cursor):
+    _execution = None
+
+    def _run(self, method, sql, parameters, plan_parameters):
+        if not query_stats.enabled:
+            self._execution = None
+            return method(sql, parameters)
+        started = time.perf_counter()
+        try:
+            method(sql, parameters)
+        finally:
+            rows = max(self.rowcount, 0) if self.description is None else 0
+            self._execution = query_stats.executed(self.connection, sql, plan_parameters,
+                                                   time.perf_counter() - started, rows)
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, parameters, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(super().executemany, sql, seq_of_parameters, None)
+
+    def _fetch(self, method, *args):
+        if self._execution is None:
+            return method(*args)
+        started = time.perf_counter()
+        result = method(*args)
+        rows = len(result) if isinstance(result, list) else int(result is not None)
+        query_stats.fetched(self._execution, time.perf_counter() - started, rows)
+        return result
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __next__(self):
+        if self._execution is None:
+            return super().__next__()
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            query_stats.fetched(self._execution, time.perf_counter() - started, 0)
+            raise
+        query_stats.fetched(self._execution, time.perf_counter() - started, 1)
+        return row
+
+# Connection whose statements, including conn.execute shortcuts, run on
+# InstrumentedCursor
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# Record a database function's calls in query_stats, with the rows it returns
+def instrumented(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not query_stats.enabled:
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        rows = len(result) if isinstance(result, (pd.DataFrame, list, dict)) else 0
+        query_stats.called(func.__name__, time.perf_counter() - started, rows)
+        return result
+    return wrapper
+
+def collect_query_stats():
+    return query_stats.snapshot()
+
+def reset_query_stats():
+    query_stats.reset()
+
+# SQLite access shared by every Streamlit session thread: the database runs in
+# WAL mode so readers never block the writer, reads are served from a small
+# pool of read-only connections, and all writes go through a single writer
+# connection, one transaction at a time. A read waits at most reader_timeout
+# seconds for a pooled connection, so reads left holding theirs (an abandoned
+# iter_sql generator, a read nested inside a snapshot) fail instead of hanging.
+class ConnectionManager:
+    def __init__(self, path, readers=4, busy_timeout=5000, reader_timeout=30):
+        self.path = path
+        self.readers = readers
+        self.busy_timeout = busy_timeout
+        self.reader_timeout = reader_timeout
+        self._write_lock = threading.RLock()
+        self._write_owner = None
+        self._after_commit = []
+        self._pool = queue.Queue()
+        self.open()
+
+    def _connect(self, read_only=False):
+        if read_only:
+            uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None,
+                                         factory=InstrumentedConnection)
+        else:
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None,
+                                         factory=InstrumentedConnection)
+        connection.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        return connection
+
+    def open(self):
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        self._writer.execute("PRAGMA synchronous = NORMAL")
+        self._data_version = self._writer.execute("PRAGMA data_version").fetchone()[0]
+        self._readers = [self._connect(read_only=True) for _ in range(self.readers)]
+        for connection in self._readers:
+            self._pool.put(connection)
+
+    def close(self):
+        with self._write_lock:
+            while not self._pool.empty():
+                self._pool.get_nowait()
+            for connection in self._readers + [self._writer]:
+                connection.close()
+
+    # Swap the database file for the one at path. Waits for in-flight reads
+    # (up to reader_timeout) and writes, closes every connection, moves the file into place with
+    # os.replace (atomic when both are on one filesystem) and reopens. Threads
+    # waiting for a reader meanwhile are handed one of the new connections.
+    def replace_file(self, path):
+        with self._write_lock:
+            if self._write_owner == threading.get_ident():
+                raise RuntimeError("Cannot replace the database inside a transaction")
+            drained = []
+            try:
+                for _ in self._readers:
+                    drained.append(self._take_reader())
+            except Exception:
+                for connection in drained:
+                    self._pool.put(connection)
+                raise
+            # The writer goes last so it is the one to checkpoint the WAL
+            for connection in self._readers + [self._writer]:
+                connection.close()
+            try:
+                # Closing the last connection checkpoints and deletes the WAL.
+                # If it is still there another process has the database open,
+                # and its WAL would be replayed onto the new file.
+                if os.path.exists(self.path + "-wal"):
+                    raise RuntimeError("The database is open in another process; stop it and try again.")
+                os.replace(path, self.path)
+            finally:
+                self.open()
+
+    def connections(self):
+        return [self._writer] + self._readers
+
+    # True when another connection or process has committed since the last
+    # call; data_version on the writer only moves for commits made elsewhere.
+    # Skipped (False) rather than waiting while another thread is writing.
+    def external_changes(self):
+        if not self._write_lock.acquire(blocking=False):
+            return False
+        try:
+            data_version = self._writer.execute("PRAGMA data_version").fetchone()[0]
+            changed = data_version != self._data_version
+            self._data_version = data_version
+            return changed
+        finally:
+            self._write_lock.release()
+
+    # Run callback once the current thread's transaction commits, or right
+    # away when no transaction is open
+    def after_commit(self, callback):
+        if self._write_owner == threading.get_ident():
+            self._after_commit.append(callback)
+        else:
+            callback()
+
+    def _take_reader(self):
+        try:
+            return self._pool.get(timeout=self.reader_timeout)
+        except queue.Empty:
+            raise RuntimeError(f"No database reader free after {self.reader_timeout}s: all {self.readers} are "
+                               f"held by reads that have not finished") from None
+
+    @contextmanager
+    def read(self):
+        # Inside a write transaction, read through the writer to see its changes
+        if self._write_owner == threading.get_ident():
+            yield self._writer
+            return
+        connection = self._take_reader()
+        try:
+            yield connection
+        finally:
+            self._pool.put(connection)
+
+    # A read connection on which every statement sees the same snapshot, so
+    # figures read one after another agree with each other
+    @contextmanager
+    def snapshot(self):
+        with self.read() as connection:
+            if connection.in_transaction:
+                yield connection
+                return
+            connection.execute("BEGIN")
+            try:
+                yield connection
+            finally:
+                connection.execute("COMMIT")
+
+    @contextmanager
+    def transaction(self):
+        with self._write_lock:
+            # Nested transactions join the outermost one
+            if self._write_owner == threading.get_ident():
+                yield self._writer
+                return
+            self._writer.execute("BEGIN IMMEDIATE")
+            self._write_owner = threading.get_ident()
+            try:
+                yield self._writer
+                self._writer.execute("COMMIT")
+            except BaseException:
+                if self._writer.in_transaction:
+                    self._writer.execute("ROLLBACK")
+                raise
+            finally:
+                self._write_owner = None
+                callbacks, self._after_commit = self._after_commit, []
+            for callback in callbacks:
+                callback()
+
+db = ConnectionManager(DB_PATH)
+
+# LRU cache over the read functions. Entries are keyed by the user and that
+# user's data version for each entity kind the function reads, so a write only
+# invalidates the writing user's entries of the kinds it touched.
+class QueryCache:
+    KINDS = ('transactions', 'budgets', 'taxonomy', 'goals', 'recurring')
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def version(self, user, kinds):
+        with self._lock:
+            return tuple(self._versions[(user, kind)] for kind in kinds)
+
+    def bump(self, user, *kinds):
+        with self._lock:
+            for kind in kinds:
+                self._versions[(user, kind)] += 1
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key][0]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        size = _estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+def _estimate_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+    return sys.getsizeof(value)
+
+query_cache = QueryCache()
+
+# Lists and sets (e.g. tag filters) as cache key parts
+def _hashable(value):
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(value))
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+# Serve a get_* function from query_cache. Callers get their own copy, since
+# pages add and convert columns on the frames they receive.
+def cached(*kinds):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(user, *args, **kwargs):
+            # Writes from other processes (e.g. process_recurring.py) do not
+            # bump versions, so they drop the whole cache instead
+            if db.external_changes():
+                query_cache.clear()
+            key = (func.__name__, user, tuple(_hashable(arg) for arg in args),
+                   tuple(sorted((name, _hashable(arg)) for name, arg in kwargs.items())),
+                   query_cache.version(user, kinds))
+            found, value = query_cache.get(key)
+            if not found:
+                value = func(user, *args, **kwargs)
+                query_cache.put(key, value)
+            return value.copy() if hasattr(value, 'copy') else value
+        return instrumented(wrapper)
+    return decorator
+
+# Mark a user's cached reads of the given kinds stale once the current write commits
+def invalidate(user, *kinds):
+    db.after_commit(lambda: query_cache.bump(user, *kinds))
+
+def cache_stats():
+    return query_cache.stats()
+
+def _read_sql(query, params=()):
+    with db.read() as conn:
+        return pd.read_sql_query(query, conn, params=params)
+
+# Stream a query's rows as lists of tuples, chunk_size at a time, so results
+# larger than memory can be written out as they are read. The statement reads
+# one snapshot and holds its pooled connection until the generator finishes
+# or is closed, so callers close it in a finally block.
+def iter_sql(query, params=(), chunk_size=5000):
+    with db.read() as conn:
+        cursor = conn.execute(query, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+# =========================
+# Money
+# =========================
+
+# Minor units per major unit of a currency (100 cents to the dollar)
+def minor_scale(currency):
+    return 10 ** CURRENCY_EXPONENTS.get(currency, 2)
+
+# An amount in major units (19.99) as integer minor units (1999) of its currency
+def to_minor(amount, currency='USD'):
+    return int(round(float(amount) * minor_scale(currency)))
+
+# Integer minor-unit amounts back in major units, for the columns given, in
+# place. currency is a currency code, or the column holding each row's.
+def _to_major(frame, columns, currency='USD'):
+    if currency in frame:
+        scale = frame[currency].map(minor_scale).to_numpy(dtype=float)
+    else:
+        scale = float(minor_scale(currency))
+    for column in columns:
+        frame[column] = frame[column].to_numpy(dtype=float) / scale
+    return frame
+
+# SQL expression for minor units per major unit of the currency expression
+def _minor_scale_sql(currency):
+    cases = " ".join(f"WHEN '{code}' THEN {minor_scale(code)}" for code in CURRENCY_EXPONENTS)
+    return f"(CASE {currency} {cases} ELSE 100 END)"
+
+# SQL expression for a stored minor-unit column in major units, for selecting
+# amounts out to callers; currency is the SQL expression for its currency
+def major_units(column, currency="'USD'"):
+    return f"({column} * 1.0 / {_minor_scale_sql(currency)})"
+
+# SQL expression for the USD value, in integer cents, of a transaction row,
+# converted at the rate in force on its date, or on the date expression given
+# (rates are stored as units of currency per 1 USD). Each row is rounded to
+# the cent once, so sums of it are exact. Currencies with no rate on that date
+# evaluate to NULL; aggregates count those rows as unconverted rather than
+# adding them as 0.
+def _usd(row, date=None):
+    return f"""CAST(ROUND({row}.amount * 100.0 / {_minor_scale_sql(row + '.currency')} / (
+        SELECT rate FROM exchange_rates
+        WHERE exchange_rates.currency = {row}.currency AND exchange_rates.date <= {date or row + '.date'}
+        ORDER BY exchange_rates.date DESC LIMIT 1
+    )) AS INTEGER)"""
+
+# USD cents as dollars; None or NaN (no rows) as 0
+def _dollars(cents):
+    return 0.0 if cents is None or pd.isna(cents) else cents / 100
+
+# =========================
+# Date Keys
+# =========================
+
+# income, expense and recurring carry integer keys generated from their TEXT
+# date: day_key counts days since 1970-01-01 (numpy's datetime64[D]),
+# month_key is YYYYMM and year_key YYYY. Ranges and grouping compare these
+# integers from the (user, month_key, day_key, ...) indexes instead of
+# calling date functions on every row.
+
+# SQL expression for the day key of a date expression
+def _day_key_sql(date):
+    return f"CAST(julianday({date}) - 2440587.5 AS INTEGER)"
+
+DATE_KEY_COLUMNS = {
+    'day_key': _day_key_sql('date'),
+    'month_key': "CAST(strftime('%Y%m', date) AS INTEGER)",
+    'year_key': "CAST(strftime('%Y', date) AS INTEGER)",
+}
+
+def day_key(date):
+    return int(np.datetime64(date, 'D').astype(np.int64))
+
+def month_key(date):
+    return int(date[:4]) * 100 + int(date[5:7])
+
+# WHERE clauses (over alias) and parameters for dates from start_date to
+# end_date inclusive, either bound optional. month_key is bounded as well so
+# the (user, month_key, day_key) indexes can seek to the range.
+def _date_range(alias, start_date=None, end_date=None):
+    clauses, params = [], []
+    for date, operator in ((start_date, '>='), (end_date, '<=')):
+        if date:
+            clauses.extend([f"{alias}.month_key {operator} ?", f"{alias}.day_key {operator} ?"])
+            params.extend([month_key(date), day_key(date)])
+    return clauses, params
+
+# Amounts were once stored as REAL major units. SQLite cannot retype a
+# column, so a table still declaring column REAL is recreated from its own
+# definition with the column INTEGER and its values converted to minor units
+# of currency (a column, or None for USD). Indexes and triggers go with the
+# old table; create_tables recreates them afterwards.
+def _migrate_to_minor_units(conn, table, column, currency=None):
+    declared = {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if declared.get(column) != 'REAL':
+        return False
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+    sql = re.sub(rf"\b{column} REAL\b", f"{column} INTEGER", sql, count=1)
+    sql = re.sub(rf"^CREATE TABLE (IF NOT EXISTS )?\"?{table}\"?", f"CREATE TABLE {table}_minor", sql)
+    conn.execute(sql)
+    scale = _minor_scale_sql(currency) if currency else 100
+    values = [f"CAST(ROUND({name} * {scale}) AS INTEGER)" if name == column else name for name in declared]
+    conn.execute(f"INSERT INTO {table}_minor ({', '.join(declared)}) SELECT {', '.join(values)} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_minor RENAME TO {table}")
+    return True
+
+# Add a column to an existing table unless it is already there (table_xinfo
+# also lists generated columns)
+def _has_column(conn, table, column):
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_xinfo({table})"))
+
+def _add_column(conn, table, column, definition):
+    if _has_column(conn, table, column):
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+# Rollup maintenance statements, shared by the income and expense triggers.
+# Subcategory is stored as '' in the rollups so it can be part of the key. A
+# row without a USD rate adds nothing to amount_usd and counts as unconverted.
+def _rollup_statements(trans_type, row, sign):
+    statements = []
+    for table, period, fmt in (('monthly_rollup', 'month', '%Y-%m'), ('yearly_rollup', 'year', '%Y')):
+        if sign > 0:
+            statements.append(f"""
+                INSERT INTO {table} (user, {period}, type, category, subcategory, currency, amount, amount_usd,
+                                     unconverted, count)
+                VALUES ({row}.user, strftime('{fmt}', {row}.date), '{trans_type}', {row}.category,
+                        IFNULL({row}.subcategory, ''), {row}.currency, {row}.amount, IFNULL({_usd(row)}, 0),
+                        ({_usd(row)}) IS NULL, 1)
+                ON CONFLICT (user, {period}, type, category, subcategory, currency)
+                DO UPDATE SET amount = amount + excluded.amount, amount_usd = amount_usd + excluded.amount_usd,
+                              unconverted = unconverted + excluded.unconverted, count = count + 1;
+            """)
+        else:
+            key = f"""user = {row}.user AND {period} = strftime('{fmt}', {row}.date) AND type = '{trans_type}'
+                      AND category = {row}.category AND subcategory = IFNULL({row}.subcategory, '')
+                      AND currency = {row}.currency"""
+            statements.append(f"""
+                UPDATE {table}
+                SET amount = amount - {row}.amount, amount_usd = amount_usd - IFNULL({_usd(row)}, 0),
+                    unconverted = unconverted - (({_usd(row)}) IS NULL), count = count - 1
+                WHERE {key};
+                DELETE FROM {table} WHERE {key} AND count <= 0;
+            """)
+    return "".join(statements)
+
+# Daily balance maintenance, shared by the same triggers. A transaction opens
+# its day with the running totals of the day before if the day has no row
+# yet, then moves its own day's total and the running totals of that day and
+# every later one. A transaction without a USD rate moves the unconverted
+# counts instead of the amounts. While the user's balances are deferred (see
+# deferred_balances) it only records the earliest day touched.
+def _balance_statements(trans_type, row, sign):
+    column = 'income' if trans_type == 'income' else 'expenses'
+    change = "+" if sign > 0 else "-"
+    amount = f"{change} IFNULL({_usd(row)}, 0)"
+    live = f"NOT EXISTS (SELECT 1 FROM balance_deferred WHERE user = {row}.user)"
+    statements = []
+    if sign > 0:
+        previous = f"FROM daily_balance WHERE user = {row}.user AND date < {row}.date ORDER BY date DESC LIMIT 1"
+        statements.append(f"""
+            INSERT OR IGNORE INTO daily_balance (user, date, total_income, total_expenses, total_unconverted)
+            SELECT {row}.user, {row}.date,
+                   IFNULL((SELECT total_income {previous}), 0), IFNULL((SELECT total_expenses {previous}), 0),
+                   IFNULL((SELECT total_unconverted {previous}), 0)
+            WHERE {live};
+        """)
+    statements.append(f"""
+        UPDATE daily_balance
+        SET {column} = {column} + CASE WHEN date = {row}.date THEN 0 {amount} ELSE 0 END,
+            total_{column} = total_{column} {amount},
+            count = count {change} (date = {row}.date)
+        WHERE user = {row}.user AND date >= {row}.date AND {live};
+    """)
+    # Only rows without a rate touch the unconverted counts. The test sits in
+    # the range bound, which is evaluated once before the index seek (a NULL
+    # bound matches nothing); as a separate term it would be tested per day.
+    statements.append(f"""
+        UPDATE daily_balance
+        SET unconverted = unconverted {change} (date = {row}.date), total_unconverted = total_unconverted {change} 1
+        WHERE user = {row}.user AND date >= CASE WHEN ({_usd(row)}) IS NULL THEN {row}.date END AND {live};
+    """)
+    if sign < 0:
+        statements.append(f"""
+            DELETE FROM daily_balance WHERE user = {row}.user AND date = {row}.date AND count <= 0 AND {live};
+        """)
+    statements.append(f"""
+        UPDATE balance_deferred SET since = MIN(IFNULL(since, {row}.date), {row}.date) WHERE user = {row}.user;
+    """)
+    return "".join(statements)
+
+# Recompute daily balances from the ledgers: everyone's, one user's, or one
+# user's from since on, carrying on from their running totals before it
+def _rebuild_daily_balance(conn, user=None, since=None):
+    filters, params = [], []
+    if user:
+        filters.append("user = ?")
+        params.append(user)
+    if since:
+        filters.append("date >= ?")
+        params.append(since)
+    where = f"WHERE {' AND '.join(filters)}" if filters else ""
+    opening = (0, 0, 0)
+    if since:
+        opening = conn.execute("""
+            SELECT total_income, total_expenses, total_unconverted FROM daily_balance
+            WHERE user = ? AND date < ? ORDER BY date DESC LIMIT 1
+        """, (user, since)).fetchone() or opening
+    conn.execute(f"DELETE FROM daily_balance {where}", params)
+    # The other type's column is 0 rather than NULL, so a NULL is a row
+    # without a USD rate
+    conn.execute(f"""
+        INSERT INTO daily_balance (user, date, income, expenses, total_income, total_expenses,
+                                   unconverted, total_unconverted, count)
+        SELECT user, date, income, expenses,
+               ? + SUM(income) OVER running, ? + SUM(expenses) OVER running,
+               unconverted, ? + SUM(unconverted) OVER running, count
+        FROM (
+            SELECT user, date, IFNULL(SUM(income), 0) AS income, IFNULL(SUM(expenses), 0) AS expenses,
+                   SUM(income IS NULL OR expenses IS NULL) AS unconverted, COUNT(*) AS count
+            FROM (
+                SELECT user, date, {_usd('income')} AS income, 0 AS expenses FROM income {where}
+                UNION ALL
+                SELECT user, date, 0, {_usd('expense')} FROM expense {where}
+            )
+            GROUP BY user, date
+        )
+        WINDOW running AS (PARTITION BY user ORDER BY date)
+    """, [*opening, *params, *params])
+
+# For bulk writes of a user's transactions inside a write transaction: the
+# triggers skip per-row balance maintenance, which moves every later day, and
+# the days from the earliest one written are recomputed in one pass at the end
+@contextmanager
+def deferred_balances(conn, user):
+    conn.execute("INSERT OR REPLACE INTO balance_deferred (user, since) VALUES (?, NULL)", (user,))
+    yield
+    since = conn.execute("SELECT since FROM balance_deferred WHERE user = ?", (user,)).fetchone()[0]
+    conn.execute("DELETE FROM balance_deferred WHERE user = ?", (user,))
+    if since is not None:
+        _rebuild_daily_balance(conn, user, since)
+
+# Create tables if they don't exist
+def create_tables():
+    with db.transaction() as conn:
+        rollups_exist = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'monthly_rollup'"
+        ).fetchone() is not None
+        balances_exist = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'daily_balance'"
+        ).fetchone() is not None
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                email TEXT NOT NULL,
+                password TEXT NOT NULL
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS income (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                date TEXT NOT NULL,
+                category TEXT NOT NULL,
+                subcategory TEXT,
+                amount INTEGER NOT NULL, -- minor units of currency
+                currency TEXT NOT NULL DEFAULT 'USD',
+                FOREIGN KEY(user) REFERENCES users(username)
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS expense (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                date TEXT NOT NULL,
+                category TEXT NOT NULL,
+                subcategory TEXT,
+                amount INTEGER NOT NULL, -- minor units of currency
+                currency TEXT NOT NULL DEFAULT 'USD',
+                FOREIGN KEY(user) REFERENCES users(username)
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS budget (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                category TEXT NOT NULL,
+                subcategory TEXT,
+                amount INTEGER NOT NULL, -- minor units of currency
+                currency TEXT NOT NULL DEFAULT 'USD',
+                FOREIGN KEY(user) REFERENCES users(username)
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS recurring (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                type TEXT NOT NULL, -- 'income' or 'expense'
+                date TEXT NOT NULL, -- Next occurrence date
+                category TEXT NOT NULL,
+                subcategory TEXT,
+                amount INTEGER NOT NULL, -- minor units of currency
+                frequency TEXT NOT NULL, -- 'daily', 'weekly', 'monthly'
+                currency TEXT NOT NULL DEFAULT 'USD',
+                FOREIGN KEY(user) REFERENCES users(username)
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS categories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                type TEXT NOT NULL, -- 'income' or 'expense'
+                category TEXT NOT NULL
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS subcategories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                category TEXT NOT NULL,
+                subcategory TEXT NOT NULL
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tags (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                tag TEXT NOT NULL
+            )
+        ''')
+
+        # Tag links are keyed by transaction type as well as id, since income
+        # and expense ids overlap
+        untyped_tags = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'transaction_tags'"
+        ).fetchone() is not None and not _has_column(conn, 'transaction_tags', 'transaction_type')
+        if untyped_tags:
+            conn.execute("ALTER TABLE transaction_tags RENAME TO transaction_tags_untyped")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS transaction_tags (
+                transaction_type TEXT NOT NULL, -- 'income' or 'expense'
+                transaction_id INTEGER NOT NULL,
+                tag_id INTEGER NOT NULL,
+                PRIMARY KEY (transaction_type, transaction_id, tag_id),
+                FOREIGN KEY(tag_id) REFERENCES tags(id)
+            ) WITHOUT ROWID
+        ''')
+        if untyped_tags:
+            # An old link belongs to whichever table has that id for the tag's
+            # user; ids found in both keep the tag on both, as they showed it
+            for trans_type in ('income', 'expense'):
+                conn.execute(f"""
+                    INSERT OR IGNORE INTO transaction_tags (transaction_type, transaction_id, tag_id)
+                    SELECT '{trans_type}', tt.transaction_id, tt.tag_id
+                    FROM transaction_tags_untyped tt
+                    JOIN tags t ON t.id = tt.tag_id
+                    JOIN {trans_type} e ON e.id = tt.transaction_id AND e.user = t.user
+                """)
+            conn.execute("DROP TABLE transaction_tags_untyped")
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS savings_goals (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                goal_amount INTEGER NOT NULL, -- USD cents
+                target_date TEXT NOT NULL,
+                achieved INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY(user) REFERENCES users(username)
+            )
+        ''')
+
+        # Monthly rules recur on the day of month they were created with, so a
+        # rule from the 31st comes back to the 31st after short months
+        if _add_column(conn, 'recurring', 'anchor_day', 'INTEGER'):
+            conn.execute("UPDATE recurring SET anchor_day = CAST(strftime('%d', date) AS INTEGER)")
+
+        # One row per recurring occurrence already posted, so re-running the
+        # expansion never posts the same occurrence twice
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS recurring_postings (
+                recurring_id INTEGER NOT NULL,
+                occurrence_date TEXT NOT NULL,
+                PRIMARY KEY (recurring_id, occurrence_date),
+                FOREIGN KEY(recurring_id) REFERENCES recurring(id)
+            ) WITHOUT ROWID
+        ''')
+
+        # Exchange rates as units of currency per 1 USD, by effective date
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS exchange_rates (
+                currency TEXT NOT NULL,
+                date TEXT NOT NULL,
+                rate REAL NOT NULL,
+                PRIMARY KEY (currency, date)
+            ) WITHOUT ROWID
+        ''')
+        conn.executemany("""
+            INSERT OR IGNORE INTO exchange_rates (currency, date, rate) VALUES (?, '1970-01-01', ?)
+        """, DEFAULT_EXCHANGE_RATES.items())
+
+        # Money columns still holding REAL major units become integer minor units
+        rollups_outdated = False
+        for table in ('income', 'expense'):
+            rollups_outdated |= _migrate_to_minor_units(conn, table, 'amount', 'currency')
+        _migrate_to_minor_units(conn, 'budget', 'amount', 'currency')
+        _migrate_to_minor_units(conn, 'recurring', 'amount', 'currency')
+        _migrate_to_minor_units(conn, 'savings_goals', 'goal_amount')
+        # Aggregates are rebuilt rather than converted
+        for table, column in (('monthly_rollup', 'amount'), ('yearly_rollup', 'amount'), ('daily_balance', 'income')):
+            if any(row[1] == column and row[2] == 'REAL' for row in conn.execute(f"PRAGMA table_info({table})")):
+                conn.execute(f"DROP TABLE {table}")
+                rollups_outdated = True
+
+        # Per-user, per-period, per-category aggregates behind the summaries;
+        # amount is in minor units of the transaction currency, amount_usd in
+        # USD cents converted per date
+        for table, period in (('monthly_rollup', 'month'), ('yearly_rollup', 'year')):
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    user TEXT NOT NULL,
+                    {period} TEXT NOT NULL,
+                    type TEXT NOT NULL, -- 'income' or 'expense'
+                    category TEXT NOT NULL,
+                    subcategory TEXT NOT NULL DEFAULT '',
+                    currency TEXT NOT NULL,
+                    amount INTEGER NOT NULL DEFAULT 0,
+                    amount_usd INTEGER NOT NULL DEFAULT 0,
+                    unconverted INTEGER NOT NULL DEFAULT 0, -- rows without a USD rate, not in amount_usd
+                    count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user, {period}, type, category, subcategory, currency)
+                ) WITHOUT ROWID
+            ''')
+            rollups_outdated |= _add_column(conn, table, 'amount_usd', 'INTEGER NOT NULL DEFAULT 0')
+            rollups_outdated |= _add_column(conn, table, 'unconverted', 'INTEGER NOT NULL DEFAULT 0')
+
+        # Per-user days with transactions: the day's income and expenses and
+        # the running totals up to and including it, all in USD cents, so a balance
+        # on any date is the row at or before it. The unconverted counts are the
+        # transactions without a USD rate left out of those amounts.
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS daily_balance (
+                user TEXT NOT NULL,
+                date TEXT NOT NULL,
+                income INTEGER NOT NULL DEFAULT 0,
+                expenses INTEGER NOT NULL DEFAULT 0,
+                total_income INTEGER NOT NULL DEFAULT 0,
+                total_expenses INTEGER NOT NULL DEFAULT 0,
+                unconverted INTEGER NOT NULL DEFAULT 0,
+                total_unconverted INTEGER NOT NULL DEFAULT 0,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user, date)
+            ) WITHOUT ROWID
+        ''')
+        for column in ('unconverted', 'total_unconverted'):
+            rollups_outdated |= _add_column(conn, 'daily_balance', column, 'INTEGER NOT NULL DEFAULT 0')
+        # Users whose balances are being bulk-written (deferred_balances); only
+        # ever has rows inside that write transaction
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS balance_deferred (
+                user TEXT PRIMARY KEY,
+                since TEXT
+            )
+        ''')
+
+        # Keep the rollups and daily balances current on every insert, update and delete,
+        # whichever connection (app, process_recurring.py, ...) writes the row.
+        # Triggers are recreated so their bodies follow schema changes.
+        for trans_type in ('income', 'expense'):
+            for action in ('insert', 'delete', 'update'):
+                conn.execute(f"DROP TRIGGER IF EXISTS {trans_type}_rollup_{action}")
+            conn.execute(f'''
+                CREATE TRIGGER {trans_type}_rollup_insert AFTER INSERT ON {trans_type}
+                BEGIN {_rollup_statements(trans_type, 'NEW', 1)} {_balance_statements(trans_type, 'NEW', 1)} END
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER {trans_type}_rollup_delete AFTER DELETE ON {trans_type}
+                BEGIN {_rollup_statements(trans_type, 'OLD', -1)} {_balance_statements(trans_type, 'OLD', -1)} END
+            ''')
+            # A deleted transaction takes its tag links with it
+            conn.execute(f"DROP TRIGGER IF EXISTS {trans_type}_tags_delete")
+            conn.execute(f'''
+                CREATE TRIGGER {trans_type}_tags_delete AFTER DELETE ON {trans_type}
+                BEGIN
+                    DELETE FROM transaction_tags
+                    WHERE transaction_type = '{trans_type}' AND transaction_id = OLD.id;
+                END
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER {trans_type}_rollup_update
+                AFTER UPDATE OF user, date, category, subcategory, amount, currency ON {trans_type}
+                BEGIN
+                    {_rollup_statements(trans_type, 'OLD', -1)} {_balance_statements(trans_type, 'OLD', -1)}
+                    {_rollup_statements(trans_type, 'NEW', 1)} {_balance_statements(trans_type, 'NEW', 1)}
+                END
+            ''')
+
+        # Integer date keys, generated from date (see DATE_KEY_COLUMNS). They
+        # are virtual, so they take no space in the rows, only in the indexes
+        for table in ('income', 'expense', 'recurring'):
+            for column, expression in DATE_KEY_COLUMNS.items():
+                _add_column(conn, table, column, f"INTEGER GENERATED ALWAYS AS ({expression}) VIRTUAL")
+
+        # Create indexes
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_income_user ON income (user)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_expense_user ON expense (user)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_recurring_user ON recurring (user)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_recurring_day ON recurring (day_key)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_savings_goals_user ON savings_goals (user)")
+
+        # Covering indexes for the date-range and per-category aggregates;
+        # (user) alone still serves the ORDER BY id DESC listings via the rowid.
+        # date comes last for the exchange rate lookup.
+        for trans_type in ('income', 'expense'):
+            conn.execute(f"""
+                CREATE INDEX IF NOT EXISTS idx_{trans_type}_user_month_day
+                ON {trans_type} (user, month_key, day_key, currency, amount, date)
+            """)
+            conn.execute(f"""
+                CREATE INDEX IF NOT EXISTS idx_{trans_type}_user_category_day
+                ON {trans_type} (user, category, subcategory, day_key, currency, amount, date)
+            """)
+        # Budgets cover a period and may carry the previous period's
+        # remainder; created bounds the carry for budgets set mid-period
+        _add_column(conn, 'budget', 'period', "TEXT NOT NULL DEFAULT 'monthly'")
+        _add_column(conn, 'budget', 'rollover', "INTEGER NOT NULL DEFAULT 0")
+        _add_column(conn, 'budget', 'created', "TEXT")
+        # One budget per category and subcategory, a missing subcategory
+        # counting as one value. Duplicates left from before the index existed
+        # keep their latest row.
+        budget_unique = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'idx_budget_user_category'"
+        ).fetchone() is not None
+        if not budget_unique:
+            conn.execute('''
+                DELETE FROM budget WHERE id NOT IN (
+                    SELECT MAX(id) FROM budget GROUP BY user, category, IFNULL(subcategory, '')
+                )
+            ''')
+        conn.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_budget_user_category
+            ON budget (user, category, IFNULL(subcategory, ''))
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_categories_user_type ON categories (user, type, category)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_subcategories_user_category ON subcategories (user, category, subcategory)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tags_user_tag ON tags (user, tag)")
+        # The primary key serves lookups by transaction; this one serves tag
+        # filters and carries the typed key with it
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_transaction_tags_tag ON transaction_tags (tag_id)")
+
+        # Superseded by the composite indexes above
+        for trans_type in ('income', 'expense'):
+            conn.execute(f"DROP INDEX IF EXISTS idx_{trans_type}_user_date")
+            conn.execute(f"DROP INDEX IF EXISTS idx_{trans_type}_user_category")
+            # Replaced by the date key indexes
+            conn.execute(f"DROP INDEX IF EXISTS idx_{trans_type}_user_date_currency")
+            conn.execute(f"DROP INDEX IF EXISTS idx_{trans_type}_user_category_date")
+        conn.execute("DROP INDEX IF EXISTS idx_recurring_date")
+        conn.execute("DROP INDEX IF EXISTS idx_budget_user")
+        # Budgets are evaluated per period by get_budget_status now
+        conn.execute("DROP VIEW IF EXISTS budget_status")
+        conn.execute("DROP INDEX IF EXISTS idx_yearly_rollup_category")
+        conn.execute("DROP INDEX IF EXISTS idx_categories_user")
+        conn.execute("DROP INDEX IF EXISTS idx_subcategories_user")
+        conn.execute("DROP INDEX IF EXISTS idx_tags_user")
+
+        # Existing databases get their rollups populated the first time round
+        if not rollups_exist or not balances_exist or rollups_outdated:
+            rebuild_rollups()
+
+# Recompute the rollup tables and daily balances from the income and expense
+# ledgers; also the backfill for databases that predate them
+@instrumented
+def rebuild_rollups(user=None):
+    try:
+        user_filter = "WHERE user = ?" if user else ""
+        params = (user,) if user else ()
+        with db.transaction() as conn:
+            for table, period, fmt in (('monthly_rollup', 'month', '%Y-%m'), ('yearly_rollup', 'year', '%Y')):
+                conn.execute(f"DELETE FROM {table} {user_filter}", params)
+                for trans_type in ('income', 'expense'):
+                    # LIMIT keeps the subquery from being flattened, which
+                    # would look each rate up twice
+                    conn.execute(f"""
+                        INSERT INTO {table} (user, {period}, type, category, subcategory, currency,
+                                             amount, amount_usd, unconverted, count)
+                        SELECT user, strftime('{fmt}', date), '{trans_type}', category, IFNULL(subcategory, ''),
+                               currency, SUM(amount), IFNULL(SUM(usd), 0), SUM(usd IS NULL), COUNT(*)
+                        FROM (
+                            SELECT user, date, category, subcategory, currency, amount, {_usd(trans_type)} AS usd
+                            FROM {trans_type}
+                            {user_filter}
+                            LIMIT -1
+                        )
+                        GROUP BY 1, 2, 4, 5, 6
+                    """, params)
+            _rebuild_daily_balance(conn, user)
+            if user:
+                invalidate(user, 'transactions')
+            else:
+                db.after_commit(query_cache.clear)
+        return True, "Rollups rebuilt successfully."
+    except Exception as e:
+        return False, f"Error rebuilding rollups: {e}"
+
+create_tables()
+
+# Close the connections when the app stops
+@atexit.register
+def close_connection():
+    db.close()
+
+# Database Interaction Functions
+
+@instrumented
+def add_income(user, date, category, subcategory, amount, currency='USD', tags=()):
+    try:
+        with db.transaction() as conn:
+            transaction_id = conn.execute("""
+                INSERT INTO income (user, date, category, subcategory, amount, currency)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (user, date, category, subcategory, to_minor(amount, currency), currency)).lastrowid
+            if tags:
+                set_transaction_tags(user, 'income', transaction_id, tags)
+            invalidate(user, 'transactions')
+        return True, "Income added successfully."
+    except Exception as e:
+        return False, f"Error adding income: {e}"
+
+@instrumented
+def add_expense(user, date, category, subcategory, amount, currency='USD', tags=()):
+    try:
+        with db.transaction() as conn:
+            transaction_id = conn.execute("""
+                INSERT INTO expense (user, date, category, subcategory, amount, currency)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (user, date, category, subcategory, to_minor(amount, currency), currency)).lastrowid
+            if tags:
+                set_transaction_tags(user, 'expense', transaction_id, tags)
+            invalidate(user, 'transactions')
+        return True, "Expense added successfully."
+    except Exception as e:
+        return False, f"Error adding expense: {e}"
+
+# Turn one incoming row (a dict with the columns export_data produces) into
+# insert values; raises ValueError describing the first problem found.
+# currencies are the codes that have an exchange rate.
+def _validate_transaction_row(row, currencies):
+    row = {str(key).strip().lower(): value for key, value in row.items()}
+
+    def text(key):
+        value = row.get(key)
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return ""
+        return str(value).strip()
+
+    date = row.get('date')
+    if hasattr(date, 'strftime'):
+        date = date.strftime("%Y-%m-%d")
+    else:
+        try:
+            date = datetime.strptime(text('date')[:10], "%Y-%m-%d").strftime("%Y-%m-%d")
+        except ValueError:
+            raise ValueError(f"invalid date {text('date')!r}, expected YYYY-MM-DD")
+
+    category = text('category')
+    if not category:
+        raise ValueError("category is empty")
+
+    try:
+        amount = float(row.get('amount'))
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid amount {text('amount')!r}")
+    if not math.isfinite(amount) or amount < 0:
+        raise ValueError(f"amount must be a non-negative number, got {text('amount')!r}")
+
+    currency = text('currency').upper() or 'USD'
+    if currency not in currencies:
+        raise ValueError(f"unknown currency {currency!r}, no exchange rate for it")
+    amount = to_minor(amount, currency)
+
+    tags = row.get('tags')
+    if isinstance(tags, (list, tuple, set)):
+        tags = [str(tag).strip() for tag in tags]
+    else:
+        tags = text('tags').split(',')
+    tags = sorted({tag.strip() for tag in tags if tag.strip()})
+
+    return (date, category, text('subcategory') or None, amount, currency), tags
+
+# Insert many rows in one transaction. Invalid rows are skipped and reported as
+# (row number, message) pairs instead of aborting the whole batch.
+def _add_transactions_bulk(user, trans_type, rows, row_offset=0):
+    if isinstance(rows, pd.DataFrame):
+        rows = rows.to_dict('records')
+
+    currencies = _known_currencies()
+    valid_rows, row_tags, errors = [], [], []
+    for row_number, row in enumerate(rows, start=row_offset + 1):
+        try:
+            values, tags = _validate_transaction_row(row, currencies)
+        except ValueError as e:
+            errors.append((row_number, str(e)))
+            continue
+        valid_rows.append((user,) + values)
+        row_tags.append(tags)
+
+    insert = f"""
+        INSERT INTO {trans_type} (user, date, category, subcategory, amount, currency)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """
+    try:
+        with db.transaction() as conn, deferred_balances(conn, user):
+            conn.executemany(insert, valid_rows)
+            if any(row_tags):
+                # Rows go in file order in one statement under the write lock,
+                # so they take consecutive ids ending at last_insert_rowid
+                last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                first_id = last_id - len(valid_rows) + 1
+                tag_ids = _resolve_tags(conn, user, {tag for tags in row_tags for tag in tags})
+                conn.executemany("""
+                    INSERT OR IGNORE INTO transaction_tags (transaction_type, transaction_id, tag_id)
+                    VALUES (?, ?, ?)
+                """, [(trans_type, first_id + index, tag_ids[tag])
+                      for index, tags in enumerate(row_tags) for tag in tags])
+            invalidate(user, 'transactions')
+    except Exception as e:
+        return False, f"Error importing {trans_type} rows: {e}", errors
+
+    added = len(valid_rows)
+    message = f"{added} {trans_type} row(s) added."
+    if errors:
+        message += f" {len(errors)} invalid row(s) skipped."
+    return True, message, errors
+
+@instrumented
+def add_incomes_bulk(user, rows, row_offset=0):
+    return _add_transactions_bulk(user, 'income', rows, row_offset)
+
+@instrumented
+def add_expenses_bulk(user, rows, row_offset=0):
+    return _add_transactions_bulk(user, 'expense', rows, row_offset)
+
+@instrumented
+def set_budget(user, category, subcategory, amount, currency='USD', period='monthly', rollover=False):
+    if period not in BUDGET_PERIODS:
+        return False, f"Unknown budget period: {period}"
+    try:
+        with db.transaction() as conn:
+            conn.execute("""
+                INSERT INTO budget (user, category, subcategory, amount, currency, period, rollover, created)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user, category, IFNULL(subcategory, ''))
+                DO UPDATE SET amount=excluded.amount, currency=excluded.currency,
+                              period=excluded.period, rollover=excluded.rollover
+            """, (user, category, subcategory, to_minor(amount, currency), currency, period, int(rollover),
+                  datetime.today().strftime("%Y-%m-%d")))
+            invalidate(user, 'budgets')
+        return True, "Budget set successfully."
+    except Exception as e:
+        return False, f"Error setting budget: {e}"
+
+# Callbacks run with (rule id, next date) once a new recurring rule commits
+_recurring_listeners = []
+
+def on_recurring_added(callback):
+    _recurring_listeners.append(callback)
+
+@instrumented
+def add_recurring(user, trans_type, date, category, subcategory, amount, frequency, currency='USD'):
+    try:
+        with db.transaction() as conn:
+            cursor = conn.execute("""
+                INSERT INTO recurring (user, type, date, category, subcategory, amount, frequency, currency, anchor_day)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (user, trans_type, date, category, subcategory, to_minor(amount, currency), frequency, currency,
+                  datetime.strptime(date, "%Y-%m-%d").day))
+            rule_id = cursor.lastrowid
+            invalidate(user, 'recurring')
+            for listener in _recurring_listeners:
+                db.after_commit(lambda listener=listener: listener(rule_id, date))
+        return True, "Recurring transaction added successfully."
+    except Exception as e:
+        return False, f"Error adding recurring transaction: {e}"
+
+@instrumented
+def add_category(user, trans_type, category):
+    try:
+        with db.transaction() as conn:
+            conn.execute("""
+                INSERT INTO categories (user, type, category)
+                VALUES (?, ?, ?)
+            """, (user, trans_type, category))
+            invalidate(user, 'taxonomy')
+        return True, "Category added successfully."
+    except Exception as e:
+        return False, f"Error adding category: {e}"
+
+@cached('taxonomy')
+def get_categories(user, trans_type):
+    with db.read() as conn:
+        rows = conn.execute("""
+            SELECT category FROM categories 
+            WHERE user = ? AND type = ?
+        """, (user, trans_type)).fetchall()
+    custom_categories = [row[0] for row in rows]
+    default_categories = {
+        'income': ["Salary", "Bonus", "Investment", "Other"],
+        'expense': ["Food", "Rent", "Utilities", "Entertainment", "Transportation", "Healthcare", "Other"]
+    }
+    return default_categories[trans_type] + custom_categories
+
+@instrumented
+def add_subcategory(user, category, subcategory):
+    try:
+        with db.transaction() as conn:
+            conn.execute("""
+                INSERT INTO subcategories (user, category, subcategory)
+                VALUES (?, ?, ?)
+            """, (user, category, subcategory))
+            invalidate(user, 'taxonomy')
+        return True, "Subcategory added successfully."
+    except Exception as e:
+        return False, f"Error adding subcategory: {e}"
+
+@cached('taxonomy')
+def get_subcategories(user, category):
+    with db.read() as conn:
+        rows = conn.execute("""
+            SELECT subcategory FROM subcategories 
+            WHERE user = ? AND category = ?
+        """, (user, category)).fetchall()
+    return [row[0] for row in rows]
+
+@instrumented
+def add_tag(user, tag):
+    try:
+        with db.transaction() as conn:
+            conn.execute("""
+                INSERT INTO tags (user, tag)
+                VALUES (?, ?)
+            """, (user, tag))
+            invalidate(user, 'taxonomy')
+        return True, "Tag added successfully."
+    except Exception as e:
+        return False, f"Error adding tag: {e}"
+
+@cached('taxonomy')
+def get_tags(user):
+    with db.read() as conn:
+        rows = conn.execute("""
+            SELECT tag FROM tags 
+            WHERE user = ?
+        """, (user,)).fetchall()
+    return [row[0] for row in rows]
+
+# The user's tags as a name -> id map, held in the query cache
+@cached('taxonomy')
+def get_tag_ids(user):
+    with db.read() as conn:
+        return dict(conn.execute("""
+            SELECT tag, id FROM tags
+            WHERE user = ?
+        """, (user,)).fetchall())
+
+# Map tag names to ids within an open transaction, creating the ones the user
+# doesn't have yet. Known names come from the cached map; only new ones touch
+# the table.
+def _resolve_tags(conn, user, tags):
+    tag_ids = get_tag_ids(user)
+    missing = sorted(set(tags) - tag_ids.keys())
+    if missing:
+        conn.executemany("""
+            INSERT INTO tags (user, tag)
+            SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM tags WHERE user = ? AND tag = ?)
+        """, [(user, tag, user, tag) for tag in missing])
+        tag_ids.update(conn.execute("""
+            SELECT tag, id FROM tags
+            WHERE user = ? AND tag IN (SELECT value FROM json_each(?))
+        """, (user, json.dumps(missing))).fetchall())
+        invalidate(user, 'taxonomy')
+    return tag_ids
+
+# Make a transaction's tags exactly tags: one statement drops the links not
+# in the new set, one adds those missing from the current set
+@instrumented
+def set_transaction_tags(user, trans_type, transaction_id, tags):
+    try:
+        with db.transaction() as conn:
+            tag_ids = _resolve_tags(conn, user, tags)
+            wanted = json.dumps(sorted({tag_ids[tag] for tag in tags}))
+            conn.execute("""
+                DELETE FROM transaction_tags
+                WHERE transaction_type = ? AND transaction_id = ?
+                  AND tag_id NOT IN (SELECT value FROM json_each(?))
+            """, (trans_type, transaction_id, wanted))
+            conn.execute("""
+                INSERT OR IGNORE INTO transaction_tags (transaction_type, transaction_id, tag_id)
+                SELECT ?, ?, value FROM json_each(?)
+            """, (trans_type, transaction_id, wanted))
+            invalidate(user, 'transactions')
+        return True, "Tags updated successfully."
+    except Exception as e:
+        return False, f"Error updating tags: {e}"
+
+@instrumented
 def add_savings_goal(user, goal_amount, target_date):
     try:
-        c.execute("""
-            INSERT INTO savings_goals (user, goal_amount, target_date)
-            VALUES (?, ?, ?)
-        """, (user, goal_amount, target_date))
-        conn.commit()
+        with db.transaction() as conn:
+            conn.execute("""
+                INSERT INTO savings_goals (user, goal_amount, target_date)
+                VALUES (?, ?, ?)
+            """, (user, to_minor(goal_amount), target_date))
+            invalidate(user, 'goals')
         return True, "Savings goal set successfully."
     except Exception as e:
         return False, f"Error setting savings goal: {e}"
 
+@cached('goals')
 def get_savings_goals(user):
-    c.execute("""
-        SELECT id, goal_amount, target_date, achieved 
-        FROM savings_goals 
-        WHERE user = ?
-    """, (user,))
-    return c.fetchall()
+    with db.read() as conn:
+        return conn.execute("""
+            SELECT id, goal_amount / 100.0, target_date, achieved
+            FROM savings_goals 
+            WHERE user = ?
+        """, (user,)).fetchall()
 
+@cached('transactions')
 def get_recent_transactions(user, trans_type, limit=5):
     query = f"""
         SELECT date AS Date, category AS Category, subcategory AS Subcategory, amount AS Amount, currency AS Currency
@@ -1377,156 +3039,1484 @@ def get_recent_transactions(user, trans_type, limit=5):
         ORDER BY id DESC
         LIMIT ?
     """
-    return pd.read_sql_query(query, conn, params=(user, limit))
+    return _to_major(_read_sql(query, (user, limit)), ['Amount'], 'Currency')
 
+@cached('budgets')
 def get_all_budgets(user):
     query = """
-        SELECT category, subcategory, amount, currency 
+        SELECT id, category, subcategory, amount, currency, period, rollover
         FROM budget 
         WHERE user = ?
     """
-    return pd.read_sql_query(query, conn, params=(user,))
+    return _to_major(_read_sql(query, (user,)), ['amount'], 'currency')
 
+@cached('transactions')
 def get_spent_per_category(user):
-    query = """
-        SELECT category, subcategory, SUM(amount) AS Spent 
+    query = f"""
+        SELECT category, subcategory, SUM({_usd('expense')}) AS Spent 
         FROM expense 
         WHERE user = ? 
         GROUP BY category, subcategory
     """
-    return pd.read_sql_query(query, conn, params=(user,))
+    return _to_major(_read_sql(query, (user,)), ['Spent'])
 
-def get_total_income(user):
+# Budget statuses, from most to least urgent
+BUDGET_STATUSES = ["Over Budget", "Almost Over", "Within Budget", "Unknown Currency"]
+
+# SQLite date modifiers giving the start of the period containing a date, and
+# the start of the period before
+BUDGET_PERIODS = {
+    'weekly': ("'-6 days', 'weekday 1'", "'-7 days'"),
+    'monthly': ("'start of month'", "'-1 month'"),
+    'quarterly': ("'start of month', printf('-%d months', (CAST(strftime('%m', :today) AS INTEGER) - 1) % 3)",
+                  "'-3 months'"),
+    'yearly': ("'start of year'", "'-1 year'"),
+}
+
+def _period_start(modifiers, date=':today'):
+    cases = " ".join(f"WHEN '{period}' THEN date({date}, {modifiers(period)})" for period in BUDGET_PERIODS)
+    return f"CASE b.period {cases} END"
+
+# USD spent against budget row b from window_start up to (not including)
+# window_end, read from the (user, category, subcategory, day_key) index
+def _budget_spent(window_start, window_end):
+    return f"""IFNULL((
+        SELECT SUM({_usd('e')}) FROM expense e
+        WHERE e.user = b.user AND e.category = b.category AND e.subcategory IS b.subcategory
+          AND e.day_key >= {_day_key_sql(window_start)} AND e.day_key < {_day_key_sql(window_end)}
+    ), 0)"""
+
+# Each budget against the spend of its current period (week, month, quarter or
+# year containing today), in USD. Budgets with rollover add what was left of
+# the previous period, or subtract what it overspent, unless they were set
+# during the current one. Status is within, almost over (under 10% left) or
+# over budget; budgets in a currency without a rate cannot be compared. One
+# query answers every budget, touching only expenses of the periods involved.
+@cached('budgets', 'transactions')
+def get_budget_status(user, today=None):
+    today = today or datetime.today().strftime("%Y-%m-%d")
+    current = _period_start(lambda period: BUDGET_PERIODS[period][0])
+    previous = _period_start(lambda period: BUDGET_PERIODS[period][1], date=current)
+    query = f"""
+        SELECT id, category AS Category, subcategory AS Subcategory, period AS Period,
+               period_start AS "Period Start", Budgeted,
+               CASE WHEN rollover AND (created IS NULL OR created < period_start) THEN Budgeted - previous_spent
+                    ELSE 0 END AS Carried,
+               Spent
+        FROM (
+            SELECT b.id, b.category, b.subcategory, b.period, b.rollover, b.created,
+                   {current} AS period_start,
+                   {_usd('b', ':today')} AS Budgeted,
+                   {_budget_spent(current, "date(:today, '+1 day')")} AS Spent,
+                   {_budget_spent(previous, current)} AS previous_spent
+            FROM budget b
+            WHERE b.user = :user
+        )
+    """
+    budget_df = _to_major(_read_sql(query, {'user': user, 'today': today}), ['Budgeted', 'Carried', 'Spent'])
+    budget_df['Remaining'] = budget_df['Budgeted'] + budget_df['Carried'] - budget_df['Spent']
+    available = (budget_df['Budgeted'] + budget_df['Carried']).to_numpy(dtype=float)
+    remaining = budget_df['Remaining'].to_numpy(dtype=float)
+    budget_df['Status'] = np.select(
+        [np.isnan(available), remaining < 0, remaining < 0.1 * available],
+        ["Unknown Currency", "Over Budget", "Almost Over"],
+        "Within Budget",
+    )
+    return budget_df
+
+# A user's recurring rules of one type, with the next date each falls due
+@cached('recurring')
+def get_recurring_rules(user, trans_type):
     query = """
-        SELECT SUM(amount) AS Total_Income 
+        SELECT id, date, frequency, anchor_day, amount, currency
+        FROM recurring
+        WHERE user = ? AND type = ?
+    """
+    return _to_major(_read_sql(query, (user, trans_type)), ['amount'], 'currency')
+
+# Occurrences of a user's recurring rules already posted, in USD at the rate
+# on each occurrence's date
+@cached('transactions', 'recurring')
+def get_recurring_postings(user, trans_type):
+    query = f"""
+        SELECT p.occurrence_date AS date, {_usd('r', 'p.occurrence_date')} AS amount
+        FROM recurring r
+        JOIN recurring_postings p ON p.recurring_id = r.id
+        WHERE r.user = ? AND r.type = ?
+    """
+    return _to_major(_read_sql(query, (user, trans_type)), ['amount'])
+
+@cached('transactions')
+def get_total_income(user):
+    query = f"""
+        SELECT SUM({_usd('income')}) AS Total_Income 
         FROM income 
         WHERE user = ?
     """
-    total = pd.read_sql_query(query, conn, params=(user,))['Total_Income'][0]
-    return 0.0 if pd.isna(total) else total
+    return _dollars(_read_sql(query, (user,))['Total_Income'][0])
 
+@cached('transactions')
 def get_total_expenses(user):
-    query = """
-        SELECT SUM(amount) AS Total_Expenses 
+    query = f"""
+        SELECT SUM({_usd('expense')}) AS Total_Expenses 
         FROM expense 
         WHERE user = ?
     """
-    total = pd.read_sql_query(query, conn, params=(user,))['Total_Expenses'][0]
-    return 0.0 if pd.isna(total) else total
+    return _dollars(_read_sql(query, (user,))['Total_Expenses'][0])
 
-def get_income_over_time(user, start_date=None, end_date=None):
-    query = """
-        SELECT date, SUM(amount) AS Amount 
-        FROM income 
-        WHERE user = ?
+# USD per day with transactions, optionally from start_date to end_date, in
+# date order straight off the (user, month_key, day_key) index
+def _over_time(user, trans_type, start_date=None, end_date=None):
+    clauses, params = _date_range('e', start_date, end_date) if start_date and end_date else ([], [])
+    query = f"""
+        SELECT e.date, SUM({_usd('e')}) AS Amount
+        FROM {trans_type} e
+        WHERE {" AND ".join(["e.user = ?"] + clauses)}
+        GROUP BY e.month_key, e.day_key
+        ORDER BY e.month_key, e.day_key
     """
-    params = [user]
-    if start_date and end_date:
-        query += " AND date BETWEEN ? AND ?"
-        params.extend([start_date, end_date])
-    query += " GROUP BY date ORDER BY date"
-    return pd.read_sql_query(query, conn, params=tuple(params))
+    return _to_major(_read_sql(query, tuple([user] + params)), ['Amount'])
+
+@cached('transactions')
+def get_income_over_time(user, start_date=None, end_date=None):
+    return _over_time(user, 'income', start_date, end_date)
 
+@cached('transactions')
 def get_expenses_over_time(user, start_date=None, end_date=None):
-    query = """
-        SELECT date, SUM(amount) AS Amount 
-        FROM expense 
-        WHERE user = ?
-    """
-    params = [user]
-    if start_date and end_date:
-        query += " AND date BETWEEN ? AND ?"
-        params.extend([start_date, end_date])
-    query += " GROUP BY date ORDER BY date"
-    return pd.read_sql_query(query, conn, params=tuple(params))
+    return _over_time(user, 'expense', start_date, end_date)
 
+@cached('transactions')
 def get_expenses_by_category(user):
-    query = """
-        SELECT category, subcategory, SUM(amount) AS Amount 
+    query = f"""
+        SELECT category, subcategory, SUM({_usd('expense')}) AS Amount 
         FROM expense 
         WHERE user = ?
         GROUP BY category, subcategory
     """
-    return pd.read_sql_query(query, conn, params=(user,))
+    return _to_major(_read_sql(query, (user,)), ['Amount'])
 
+@cached('transactions', 'taxonomy')
 def get_transaction_tags(user, trans_type):
     query = f"""
         SELECT e.id, e.date, e.category, e.subcategory, e.amount, e.currency, GROUP_CONCAT(t.tag, ', ') AS Tags
         FROM {trans_type} e
-        LEFT JOIN transaction_tags tt ON e.id = tt.transaction_id
+        LEFT JOIN transaction_tags tt ON tt.transaction_type = '{trans_type}' AND tt.transaction_id = e.id
         LEFT JOIN tags t ON tt.tag_id = t.id
         WHERE e.user = ?
         GROUP BY e.id
         ORDER BY e.id DESC
     """
-    return pd.read_sql_query(query, conn, params=(user,))
+    return _to_major(_read_sql(query, (user,)), ['amount'], 'currency')
 
-def get_monthly_summary(user, start_date=None, end_date=None):
-    query = """
-        SELECT strftime('%Y-%m', date) AS Month, 
-               SUM(amount) AS Total_Income 
-        FROM income 
-        WHERE user = ?
+# One page of a user's incomes or expenses, newest first
+@dataclass
+class TransactionPage:
+    rows: pd.DataFrame
+    next_cursor: Optional[int]  # pass back as cursor for the next page; None on the last page
+    total: int  # matching rows across all pages
+
+    def copy(self):
+        return replace(self, rows=self.rows.copy())
+
+# Keyset pagination: rows older than the cursor id, served from the (user)
+# index, which SQLite keys by (user, rowid). Every page costs the same however
+# deep it is, unlike OFFSET or slicing a large frame.
+@cached('transactions', 'taxonomy')
+def get_transactions_page(user, trans_type, cursor=None, page_size=10, category=None, start_date=None, end_date=None):
+    where, params = transaction_filters(user, trans_type, category=category, start_date=start_date, end_date=end_date)
+    filtered = len(params) > 1
+    if cursor is not None:
+        where += " AND e.id < ?"
+        params.append(cursor)
+
+    query = f"""
+        SELECT e.id, e.date AS Date, e.category AS Category, e.subcategory AS Subcategory,
+               e.amount AS Amount, e.currency AS Currency, {_tags_column(trans_type)}
+        FROM {trans_type} e
+        WHERE {where}
+        ORDER BY e.id DESC
+        LIMIT ?
     """
-    params = [user]
-    if start_date and end_date:
-        query += " AND date BETWEEN ? AND ?"
-        params.extend([start_date, end_date])
-    query += " GROUP BY Month ORDER BY Month"
-    income = pd.read_sql_query(query, conn, params=tuple(params))
-    
+    rows = _to_major(_read_sql(query, tuple(params + [page_size + 1])), ['Amount'], 'Currency')
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows.iloc[:page_size]
+        next_cursor = int(rows['id'].iloc[-1])
+
+    with db.read() as conn:
+        if filtered:
+            where, params = transaction_filters(user, trans_type, category=category, start_date=start_date, end_date=end_date)
+            total = conn.execute(f"SELECT COUNT(*) FROM {trans_type} e WHERE {where}", params).fetchone()[0]
+        else:
+            # The rollups already count every row
+            total = conn.execute("SELECT IFNULL(SUM(count), 0) FROM yearly_rollup WHERE user = ? AND type = ?",
+                                 (user, trans_type)).fetchone()[0]
+    return TransactionPage(rows, next_cursor, total)
+
+# A transaction's tag names as one comma-separated Tags column, for a select
+# list over {trans_type} e
+def _tags_column(trans_type):
+    return f"""(SELECT GROUP_CONCAT(t.tag, ', ')
+                FROM transaction_tags tt JOIN tags t ON t.id = tt.tag_id
+                WHERE tt.transaction_type = '{trans_type}' AND tt.transaction_id = e.id) AS Tags"""
+
+# WHERE clause (over {trans_type} e) and parameters for the optional
+# transaction filters. Each is pushed into SQL: equality and range filters
+# ride the (user, category, ...) and (user, date, ...) indexes, and tags are
+# matched from the tag side through idx_tags_user_tag and
+# idx_transaction_tags_tag. tag_mode 'any' keeps rows with at least one of the
+# tags, 'all' rows with every one. Amounts are in major units of the
+# transaction's currency.
+def transaction_filters(user, trans_type, category=None, subcategory=None, tags=None, tag_mode='any',
+                        start_date=None, end_date=None, min_amount=None, max_amount=None, currency=None):
+    if tag_mode not in ('any', 'all'):
+        raise ValueError(f"tag_mode must be 'any' or 'all', got {tag_mode!r}")
+    clauses, params = ["e.user = ?"], [user]
+    for column, operator, value in (('category', '=', category), ('subcategory', '=', subcategory),
+                                    ('currency', '=', currency)):
+        if value is not None and value != "":
+            clauses.append(f"e.{column} {operator} ?")
+            params.append(value)
+    date_clauses, date_params = _date_range('e', start_date, end_date)
+    clauses.extend(date_clauses)
+    params.extend(date_params)
+    for operator, value in (('>=', min_amount), ('<=', max_amount)):
+        if value is not None and value != "":
+            clauses.append(f"e.amount {operator} ? * {_minor_scale_sql('e.currency')}")
+            params.append(value)
+    if tags:
+        tagged = f"""e.id IN (
+            SELECT tt.transaction_id
+            FROM tags t
+            JOIN transaction_tags tt ON tt.tag_id = t.id AND tt.transaction_type = '{trans_type}'
+            WHERE t.user = ? AND t.tag {{}})"""
+        if tag_mode == 'all':
+            for tag in sorted(set(tags)):
+                clauses.append(tagged.format("= ?"))
+                params.extend([user, tag])
+        else:
+            clauses.append(tagged.format("IN (SELECT value FROM json_each(?))"))
+            params.extend([user, json.dumps(sorted(set(tags)))])
+    return " AND ".join(clauses), params
+
+# SELECT for a user's incomes or expenses with their tags, newest first,
+# narrowed by transaction_filters
+def transaction_query(user, trans_type, limit=None, **filters):
+    where, params = transaction_filters(user, trans_type, **filters)
+    query = f"""
+        SELECT e.id, e.date, e.category, e.subcategory, {major_units('e.amount', 'e.currency')} AS amount, e.currency,
+               {_tags_column(trans_type)}
+        FROM {trans_type} e
+        WHERE {where}
+        ORDER BY e.id DESC
+    """
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    return query, tuple(params)
+
+@cached('transactions', 'taxonomy')
+def query_transactions(user, trans_type, limit=None, **filters):
+    return _read_sql(*transaction_query(user, trans_type, limit, **filters))
+
+# Split [start_date, end_date] into the whole months the rollups can answer
+# and the partial months at either edge that have to be summed from the ledgers
+def _split_months(start_date, end_date):
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    full_months, partial_months = [], []
+    month_start = start.replace(day=1)
+    while month_start <= end:
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        month_end = next_month - timedelta(days=1)
+        if start <= month_start and month_end <= end:
+            full_months.append(month_start.strftime("%Y-%m"))
+        else:
+            partial_months.append((month_start.strftime("%Y-%m"),
+                                   max(start, month_start).strftime("%Y-%m-%d"),
+                                   min(end, month_end).strftime("%Y-%m-%d")))
+        month_start = next_month
+    return full_months, partial_months
+
+@cached('transactions')
+def get_monthly_summary(user, start_date=None, end_date=None):
     query = """
-        SELECT strftime('%Y-%m', date) AS Month, 
-               SUM(amount) AS Total_Expenses 
-        FROM expense 
+        SELECT month AS Month,
+               SUM(CASE WHEN type = 'income' THEN amount_usd ELSE 0 END) AS Total_Income,
+               SUM(CASE WHEN type = 'expense' THEN amount_usd ELSE 0 END) AS Total_Expenses
+        FROM monthly_rollup
         WHERE user = ?
     """
     params = [user]
+    partial_months = []
     if start_date and end_date:
-        query += " AND date BETWEEN ? AND ?"
-        params.extend([start_date, end_date])
-    query += " GROUP BY Month ORDER BY Month"
-    expenses = pd.read_sql_query(query, conn, params=tuple(params))
-    
-    monthly_df = pd.merge(income, expenses, on='Month', how='outer').fillna(0)
+        full_months, partial_months = _split_months(start_date, end_date)
+        if full_months:
+            query += " AND month BETWEEN ? AND ?"
+            params.extend([full_months[0], full_months[-1]])
+        else:
+            query += " AND 0"
+    query += " GROUP BY month ORDER BY month"
+    monthly_df = _read_sql(query, tuple(params))
+
+    # Partially covered months at the edges of the range
+    for month, first_day, last_day in partial_months:
+        clauses, params = _date_range('e', first_day, last_day)
+        where = " AND ".join(["e.user = ?"] + clauses)
+        with db.read() as conn:
+            total_income, total_expenses = conn.execute(f"""
+                SELECT (SELECT SUM({_usd('e')}) FROM income e WHERE {where}),
+                       (SELECT SUM({_usd('e')}) FROM expense e WHERE {where})
+            """, [user, *params] * 2).fetchone()
+        if total_income is not None or total_expenses is not None:
+            edge = pd.DataFrame({'Month': [month], 'Total_Income': [total_income or 0],
+                                 'Total_Expenses': [total_expenses or 0]})
+            monthly_df = edge if monthly_df.empty else pd.concat([monthly_df, edge], ignore_index=True)
+
+    monthly_df = monthly_df.sort_values('Month', ignore_index=True)
     monthly_df['Balance'] = monthly_df['Total_Income'] - monthly_df['Total_Expenses']
-    return monthly_df
+    return _to_major(monthly_df, ['Total_Income', 'Total_Expenses', 'Balance'])
 
+@cached('transactions')
 def get_yearly_summary(user):
     query = """
-        SELECT strftime('%Y', date) AS Year, 
-               SUM(amount) AS Total_Income 
-        FROM income 
-        WHERE user = ?
-        GROUP BY Year 
-        ORDER BY Year
-    """
-    income = pd.read_sql_query(query, conn, params=(user,))
-    
-    query = """
-        SELECT strftime('%Y', date) AS Year, 
-               SUM(amount) AS Total_Expenses 
-        FROM expense 
+        SELECT year AS Year,
+               SUM(CASE WHEN type = 'income' THEN amount_usd ELSE 0 END) AS Total_Income,
+               SUM(CASE WHEN type = 'expense' THEN amount_usd ELSE 0 END) AS Total_Expenses
+        FROM yearly_rollup
         WHERE user = ?
-        GROUP BY Year 
-        ORDER BY Year
+        GROUP BY year
+        ORDER BY year
     """
-    expenses = pd.read_sql_query(query, conn, params=(user,))
-    
-    yearly_df = pd.merge(income, expenses, on='Year', how='outer').fillna(0)
+    yearly_df = _read_sql(query, (user,))
     yearly_df['Balance'] = yearly_df['Total_Income'] - yearly_df['Total_Expenses']
-    return yearly_df
+    return _to_major(yearly_df, ['Total_Income', 'Total_Expenses', 'Balance'])
+
+# Balance (income less expenses to date, USD) at the end of a day, from the
+# last daily_balance row on or before it
+@cached('transactions')
+def get_balance_as_of(user, date):
+    with db.read() as conn:
+        row = conn.execute("""
+            SELECT total_income - total_expenses
+            FROM daily_balance
+            WHERE user = ? AND date <= ?
+            ORDER BY date DESC
+            LIMIT 1
+        """, (user, date)).fetchone()
+    return _dollars(None if row is None else row[0])
+
+# Daily income, expenses and running balance (USD) for every day with
+# transactions in [start_date, end_date], or all of them. Unconverted is the
+# running count of transactions without a USD rate, left out of the balance.
+_BALANCE_OVER_TIME_QUERY = """
+    SELECT date AS Date, income AS Income, expenses AS Expenses, total_income - total_expenses AS Balance,
+           total_unconverted AS Unconverted
+    FROM daily_balance
+    WHERE user = ?{}
+    ORDER BY date
+"""
 
+@cached('transactions')
+def get_balance_over_time(user, start_date=None, end_date=None):
+    if start_date and end_date:
+        balance = _read_sql(_BALANCE_OVER_TIME_QUERY.format(" AND date BETWEEN ? AND ?"), (user, start_date, end_date))
+    else:
+        balance = _read_sql(_BALANCE_OVER_TIME_QUERY.format(""), (user,))
+    return _to_major(balance, ['Income', 'Expenses', 'Balance'])
+
+# Net savings: everything earned less everything spent, in USD
+@cached('transactions')
 def get_current_savings(user):
     query = """
-        SELECT SUM(amount) AS Current_Savings 
-        FROM income 
+        SELECT SUM(CASE WHEN type = 'income' THEN amount_usd ELSE -amount_usd END) AS Current_Savings
+        FROM yearly_rollup
         WHERE user = ?
     """
-    total = pd.read_sql_query(query, conn, params=(user,))['Current_Savings'][0]
-    return 0.0 if pd.isna(total) else total   # hash_passwords.py
+    return _dollars(_read_sql(query, (user,))['Current_Savings'][0])
+
+# Savings goal statuses, from done to furthest off
+SAVINGS_STATUSES = ["Achieved", "On Track", "Behind", "Not Saving"]
+
+# Whole months of net flow the savings rate is fitted on
+SAVINGS_TREND_MONTHS = 12
+
+# Net savings and every goal of a user against them, in USD. history is the
+# net flow (income less expenses) per month up to today's, months without
+# transactions included, and its running total. monthly_rate is the slope of
+# that running total over the last SAVINGS_TREND_MONTHS whole months.
+@dataclass
+class SavingsStatus:
+    net_savings: float
+    monthly_rate: float
+    history: pd.DataFrame
+    goals: pd.DataFrame
+
+    def copy(self):
+        return replace(self, history=self.history.copy(), goals=self.goals.copy())
+
+# Every goal evaluated in one pass: progress towards it, the date the savings
+# rate reaches it and its status. Goals stay achieved once reached; Newly
+# Achieved marks those reached but not yet recorded, for
+# mark_goals_achieved. Goals cannot be projected while net flow is flat or
+# negative.
+@cached('goals', 'transactions')
+def get_savings_status(user, today=None):
+    today = np.datetime64(today or datetime.today().strftime("%Y-%m-%d"), 'D')
+    with db.snapshot() as conn:
+        goals = pd.read_sql_query("""
+            SELECT id, goal_amount AS Goal, target_date AS "Target Date", achieved
+            FROM savings_goals
+            WHERE user = ?
+        """, conn, params=(user,))
+        flows = pd.read_sql_query("""
+            SELECT month, SUM(CASE WHEN type = 'income' THEN amount_usd ELSE -amount_usd END) AS net
+            FROM monthly_rollup
+            WHERE user = ?
+            GROUP BY month
+            ORDER BY month
+        """, conn, params=(user,))
+
+    # Monthly net flow from the first transaction to this month
+    current = today.astype('datetime64[M]')
+    flow_months = flows['month'].to_numpy().astype('datetime64[M]')
+    keep = flow_months <= current
+    first = flow_months[keep].min() if keep.any() else current
+    months = np.arange(first, current + 1)
+    net = np.zeros(len(months), dtype=np.int64)
+    net[(flow_months[keep] - first).astype(np.int64)] = flows['net'].to_numpy(dtype=np.int64)[keep]
+    cumulative = np.cumsum(net)
+    net_savings = int(cumulative[-1])
+
+    # This month is still running, so only whole months before it are fitted
+    whole = max(len(months) - 1, 1)
+    window = cumulative[max(whole - SAVINGS_TREND_MONTHS, 0):whole]
+    monthly_rate = float(np.polyfit(np.arange(len(window)), window, 1)[0]) if len(window) > 1 else float(window[0])
+
+    goal = goals['Goal'].to_numpy(dtype=np.int64)
+    target = pd.to_datetime(goals['Target Date'], errors='coerce').to_numpy().astype('datetime64[D]')
+    reached = net_savings >= goal
+    recorded = goals['achieved'].to_numpy(dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        progress = np.where(goal > 0, net_savings / goal * 100, 100.0)
+        days_needed = np.ceil((goal - net_savings) / monthly_rate * 30.4375) if monthly_rate > 0 else np.full(len(goal), np.nan)
+    projectable = ~reached & np.isfinite(days_needed)
+    projected = np.full(len(goal), np.datetime64('NaT'), dtype='datetime64[D]')
+    projected[projectable] = today + days_needed[projectable].astype(np.int64)
+
+    goals['Saved'] = net_savings
+    _to_major(goals, ['Goal', 'Saved'])
+    goals['Progress'] = progress
+    goals['Projected Date'] = projected
+    goals['Achieved'] = reached | recorded
+    goals['Newly Achieved'] = reached & ~recorded
+    goals['Status'] = np.select(
+        [goals['Achieved'].to_numpy(), ~projectable, projected <= target],
+        ["Achieved", "Not Saving", "On Track"],
+        "Behind",
+    )
+    history = _to_major(pd.DataFrame({'Month': months.astype(str), 'Net Flow': net, 'Savings': cumulative}),
+                        ['Net Flow', 'Savings'])
+    return SavingsStatus(net_savings / 100, monthly_rate / 100, history, goals.drop(columns='achieved'))
+
+# Record goals as achieved in one statement. Goals already recorded are left
+# alone, and the goals cache is only invalidated when a row changed.
+@instrumented
+def mark_goals_achieved(user, goal_ids):
+    try:
+        with db.transaction() as conn:
+            changed = conn.execute("""
+                UPDATE savings_goals SET achieved = 1
+                WHERE user = ? AND achieved = 0 AND id IN (SELECT value FROM json_each(?))
+            """, (user, json.dumps([int(goal_id) for goal_id in goal_ids]))).rowcount
+            if changed:
+                invalidate(user, 'goals')
+        return True, f"{changed} savings goals achieved."
+    except Exception as e:
+        return False, f"Error updating savings goals: {e}"
+
+# Income, expenses and balance in int64 cents per distinct key, from amounts
+# (cents) flagged income or expense
+def _income_and_expenses(keys, is_expense, cents, key_name):
+    unique, index = np.unique(keys, return_inverse=True)
+    totals = np.zeros((len(unique), 2), dtype=np.int64)
+    np.add.at(totals, (index, is_expense.astype(np.int64)), cents)
+    return pd.DataFrame({key_name: unique, 'Total_Income': totals[:, 0], 'Total_Expenses': totals[:, 1],
+                         'Balance': totals[:, 0] - totals[:, 1]})
+
+# Every dataset the Reports page and dashboard show, read from one snapshot.
+# Amounts are in USD. timings holds seconds spent per section.
+@dataclass
+class ReportBundle:
+    total_income: float
+    total_expenses: float
+    current_savings: float
+    unconverted: int  # transactions left out of the totals for want of a USD rate
+    income_over_time: pd.DataFrame
+    expenses_over_time: pd.DataFrame
+    expenses_by_category: pd.DataFrame
+    monthly_summary: pd.DataFrame
+    yearly_summary: pd.DataFrame
+    recent_income: pd.DataFrame
+    recent_expenses: pd.DataFrame
+    balance_over_time: pd.DataFrame
+    timings: dict
+
+    @property
+    def balance(self):
+        return self.total_income - self.total_expenses
+
+    def copy(self):
+        return replace(self, **{name: value.copy() for name, value in vars(self).items()
+                                if isinstance(value, (pd.DataFrame, dict))})
+
+# Four statements in one read transaction: the yearly rollup grouped by
+# category gives the totals, the yearly summary and the category breakdown;
+# one pass over the ledgers' (user, month_key, day_key) indexes gives the daily series for
+# [start_date, end_date], which also sums to the monthly summary (edge months
+# included), and daily_balance the running balance over it; and the latest
+# transactions come from the (user) indexes.
+@cached('transactions')
+def get_report_bundle(user, start_date, end_date, recent=5):
+    timings = {}
+    started = time.perf_counter()
+    with db.snapshot() as conn:
+        rollup = pd.read_sql_query("""
+            SELECT year, type, category, NULLIF(subcategory, '') AS subcategory, SUM(amount_usd) AS Amount,
+                   SUM(unconverted) AS unconverted
+            FROM yearly_rollup
+            WHERE user = ?
+            GROUP BY year, type, category, subcategory
+        """, conn, params=(user,))
+        timings['rollups'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        clauses, params = _date_range('e', start_date, end_date)
+        where = " AND ".join(["e.user = ?"] + clauses)
+        daily = pd.read_sql_query(f"""
+            SELECT 'income' AS type, e.month_key, e.date, IFNULL(SUM({_usd('e')}), 0) AS Amount
+            FROM income e
+            WHERE {where}
+            GROUP BY e.month_key, e.day_key
+            UNION ALL
+            SELECT 'expense' AS type, e.month_key, e.date, IFNULL(SUM({_usd('e')}), 0) AS Amount
+            FROM expense e
+            WHERE {where}
+            GROUP BY e.month_key, e.day_key
+        """, conn, params=[user, *params] * 2)
+        balance = pd.read_sql_query(_BALANCE_OVER_TIME_QUERY.format(" AND date BETWEEN ? AND ?"), conn,
+                                    params=(user, start_date, end_date))
+        timings['daily'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        recent_rows = {
+            trans_type: pd.read_sql_query(f"""
+                SELECT date AS Date, category AS Category, subcategory AS Subcategory, amount AS Amount, currency AS Currency
+                FROM {trans_type}
+                WHERE user = ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, conn, params=(user, recent)).pipe(_to_major, ['Amount'], 'Currency')
+            for trans_type in ('income', 'expense')
+        }
+        timings['recent'] = time.perf_counter() - started
+
+    # Everything is summed as int64 cents and turned into dollars last
+    started = time.perf_counter()
+    cents = rollup['Amount'].to_numpy(dtype=np.int64)
+    is_expense = (rollup['type'] == 'expense').to_numpy()
+    total_income = int(cents[~is_expense].sum())
+    total_expenses = int(cents[is_expense].sum())
+    yearly = _income_and_expenses(rollup['year'].to_numpy(), is_expense, cents, 'Year')
+    by_category = (rollup[is_expense].groupby(['category', 'subcategory'], dropna=False, sort=False)['Amount'].sum()
+                   .reset_index())
+
+    daily_cents = daily['Amount'].to_numpy(dtype=np.int64)
+    daily_expense = (daily['type'] == 'expense').to_numpy()
+    monthly = _income_and_expenses(daily['month_key'].to_numpy(dtype=np.int64), daily_expense, daily_cents, 'Month')
+    monthly['Month'] = [f"{key // 100:04d}-{key % 100:02d}" for key in monthly['Month']]
+    over_time = {trans_type: daily.loc[mask, ['date', 'Amount']].reset_index(drop=True)
+                 for trans_type, mask in (('income', ~daily_expense), ('expense', daily_expense))}
+
+    for frame in (yearly, monthly):
+        _to_major(frame, ['Total_Income', 'Total_Expenses', 'Balance'])
+    for frame in (by_category, *over_time.values()):
+        _to_major(frame, ['Amount'])
+    _to_major(balance, ['Income', 'Expenses', 'Balance'])
+    timings['shaping'] = time.perf_counter() - started
+
+    return ReportBundle(
+        total_income=total_income / 100,
+        total_expenses=total_expenses / 100,
+        current_savings=(total_income - total_expenses) / 100,
+        unconverted=int(rollup['unconverted'].sum()),
+        income_over_time=over_time['income'],
+        expenses_over_time=over_time['expense'],
+        expenses_by_category=by_category,
+        monthly_summary=monthly,
+        yearly_summary=yearly,
+        recent_income=recent_rows['income'],
+        recent_expenses=recent_rows['expense'],
+        balance_over_time=balance,
+        timings=timings,
+    )
+
+# =========================
+# Exchange Rates
+# =========================
+
+# Rate of one currency (units per 1 USD) in force on a given date, or None
+@lru_cache(maxsize=4096)
+def get_exchange_rate(currency, as_of):
+    with db.read() as conn:
+        row = conn.execute("""
+            SELECT rate FROM exchange_rates
+            WHERE currency = ? AND date <= ?
+            ORDER BY date DESC LIMIT 1
+        """, (currency, as_of)).fetchone()
+    return None if row is None else row[0]
+
+@lru_cache(maxsize=256)
+def _exchange_rates_as_of(as_of):
+    # Bare columns next to MAX() come from the row holding the maximum
+    with db.read() as conn:
+        rows = conn.execute("""
+            SELECT currency, rate, MAX(date)
+            FROM exchange_rates
+            WHERE date <= ?
+            GROUP BY currency
+        """, (as_of,)).fetchall()
+    return {currency: rate for currency, rate, _ in rows}
+
+# Currencies with any rate in the history
+@lru_cache(maxsize=1)
+def _known_currencies():
+    with db.read() as conn:
+        return frozenset(currency for currency, in conn.execute("SELECT DISTINCT currency FROM exchange_rates"))
+
+# All rates in force on a date (default today), as {currency: units per 1 USD}
+def get_exchange_rates(as_of=None):
+    as_of = as_of or datetime.today().strftime("%Y-%m-%d")
+    return dict(_exchange_rates_as_of(as_of))
+
+def _clear_exchange_rate_caches():
+    get_exchange_rate.cache_clear()
+    _exchange_rates_as_of.cache_clear()
+    _known_currencies.cache_clear()
+
+# Load a CSV of date, currency, rate rows into the rate history. The rollups
+# store converted amounts, so they are rebuilt when any rate changes.
+@instrumented
+def load_exchange_rates(path=EXCHANGE_RATES_PATH):
+    try:
+        rates = pd.read_csv(path, dtype={'date': str, 'currency': str})
+        rates['date'] = pd.to_datetime(rates['date'], format="%Y-%m-%d").dt.strftime("%Y-%m-%d")
+        rates['currency'] = rates['currency'].str.strip().str.upper()
+        rates['rate'] = pd.to_numeric(rates['rate'])
+        if (rates['rate'] <= 0).any():
+            return False, "Error loading exchange rates: rates must be positive."
+        with db.transaction() as conn:
+            changes_before = conn.total_changes
+            conn.executemany("""
+                INSERT INTO exchange_rates (currency, date, rate) VALUES (?, ?, ?)
+                ON CONFLICT (currency, date) DO UPDATE SET rate = excluded.rate
+                WHERE rate <> excluded.rate
+            """, rates[['currency', 'date', 'rate']].itertuples(index=False, name=None))
+            changed = conn.total_changes - changes_before
+            if changed:
+                success, message = rebuild_rollups()
+                if not success:
+                    raise RuntimeError(message)
+        _clear_exchange_rate_caches()
+        query_cache.clear()
+        return True, f"{len(rates)} exchange rate(s) read, {changed} new or changed."
+    except Exception as e:
+        return False, f"Error loading exchange rates: {e}"
+
+if os.path.exists(EXCHANGE_RATES_PATH):
+    load_exchange_rates()
+
+# =========================
+# Backup and Restore
+# =========================
+
+# Tables a restored file must have to be taken for one of our databases
+_REQUIRED_TABLES = {'users', 'income', 'expense', 'budget', 'recurring', 'categories',
+                    'subcategories', 'tags', 'transaction_tags', 'savings_goals'}
+
+# Copy the live database to path with SQLite's online backup API, a few
+# pages per step. Each step takes only a short read snapshot and under WAL
+# readers never block writers, so the app keeps writing during a backup;
+# SQLite restarts the copy if a step sees pages change underneath it, so the
+# file is always one consistent snapshot. progress is called with
+# (pages copied, total pages) after each step.
+@instrumented
+def backup_database(path, pages_per_step=256, progress=None):
+    started = time.perf_counter()
+    copied = [0]
+
+    def report(status, remaining, total):
+        copied[0] = total - remaining
+        if progress:
+            progress(total - remaining, total)
+
+    try:
+        source = db._connect(read_only=True)
+        target = sqlite3.connect(path)
+        try:
+            source.backup(target, pages=pages_per_step, progress=report, sleep=0.001)
+            # The copy inherits WAL mode; switch back so the file stands alone
+            target.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            target.close()
+            source.close()
+        return True, f"Backed up {copied[0]} pages in {time.perf_counter() - started:.2f}s."
+    except sqlite3.Error as e:
+        return False, f"Error backing up database: {e}"
+
+# Restore from a file-like backup: it is written to a staging file beside the
+# live database, integrity-checked, swapped in atomically and brought up to the
+# current schema. On any failure the live database is left untouched.
+@instrumented
+def restore_database(backup_file):
+    started = time.perf_counter()
+    staged = db.path + ".restore"
+    try:
+        with open(staged, 'wb') as f:
+            shutil.copyfileobj(backup_file, f, 1024 * 1024)
+        check = sqlite3.connect(staged)
+        try:
+            problems = [row[0] for row in check.execute("PRAGMA integrity_check").fetchall()]
+            if problems != ['ok']:
+                raise ValueError(f"Backup failed its integrity check: {'; '.join(problems[:5])}")
+            tables = {row[0] for row in check.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            missing = _REQUIRED_TABLES - tables
+            if missing:
+                raise ValueError(f"Backup is missing tables: {', '.join(sorted(missing))}")
+            pages = check.execute("PRAGMA page_count").fetchone()[0]
+        finally:
+            check.close()
+
+        db.replace_file(staged)
+        create_tables()
+        query_cache.clear()
+        _clear_exchange_rate_caches()
+        return True, f"Restored {pages} pages in {time.perf_counter() - started:.2f}s."
+    except (sqlite3.Error, OSError, RuntimeError, ValueError) as e:
+        return False, f"Error restoring database: {e}"
+    finally:
+        if os.path.exists(staged):
+            os.remove(staged)
+
+# =========================
+# Query Plan Checks
+# =========================
+
+# Representative calls used to capture the SQL behind every get_* and query_*
+# function. A new one has to be registered here or the check fails.
+def _query_plan_cases(user='__plan_check__', start_date='2024-01-15', end_date='2024-06-15'):
+    return {
+        'get_categories': [(user, 'income'), (user, 'expense')],
+        'get_subcategories': [(user, 'Food')],
+        'get_tags': [(user,)],
+        'get_tag_ids': [(user,)],
+        'get_savings_goals': [(user,)],
+        'get_recent_transactions': [(user, 'income', 5), (user, 'expense', 5)],
+        'get_all_budgets': [(user,)],
+        'get_spent_per_category': [(user,)],
+        'get_budget_status': [(user,)],
+        'get_recurring_rules': [(user, 'expense')],
+        'get_recurring_postings': [(user, 'expense')],
+        'get_total_income': [(user,)],
+        'get_total_expenses': [(user,)],
+        'get_income_over_time': [(user,), (user, start_date, end_date)],
+        'get_expenses_over_time': [(user,), (user, start_date, end_date)],
+        'get_expenses_by_category': [(user,)],
+        'get_transaction_tags': [(user, 'income'), (user, 'expense')],
+        'get_transactions_page': [(user, 'income'), (user, 'expense', 1000, 10),
+                                  (user, 'expense', 1000, 10, 'Food'),
+                                  (user, 'expense', 1000, 10, None, start_date, end_date)],
+        'get_monthly_summary': [(user,), (user, start_date, end_date)],
+        'get_yearly_summary': [(user,)],
+        'get_balance_as_of': [(user, end_date)],
+        'get_balance_over_time': [(user,), (user, start_date, end_date)],
+        'get_current_savings': [(user,)],
+        'get_savings_status': [(user,), (user, start_date)],
+        'get_report_bundle': [(user, start_date, end_date)],
+        'get_exchange_rate': [('EUR', start_date)],
+        'get_exchange_rates': [(start_date,)],
+        'query_transactions': [
+            (user, 'expense'),
+            (user, 'expense', 100, {'category': 'Food'}),
+            (user, 'expense', 100, {'category': 'Food', 'subcategory': 'Groceries', 'start_date': start_date}),
+            (user, 'income', None, {'start_date': start_date, 'end_date': end_date, 'currency': 'USD'}),
+            (user, 'expense', 100, {'min_amount': 10, 'max_amount': 100}),
+            (user, 'expense', None, {'tags': ['travel', 'work']}),
+            (user, 'expense', None, {'category': 'Food', 'tags': ['travel', 'work'], 'tag_mode': 'all'}),
+        ],
+    }
+
+# Small reference tables that are read whole on purpose, and json_each over a
+# list parameter
+_FULL_SCAN_TABLES = ('exchange_rates', 'json_each')
+
+# Plan steps accepted for particular functions. Ad-hoc filter combinations
+# narrow rows through whichever index fits best and then sort the matches.
+_PLAN_ALLOWANCES = {
+    'query_transactions': ('USE TEMP B-TREE FOR ORDER BY',),
+}
+
+# A plan regresses when it walks a whole table or index, or sorts/groups in a temp B-tree
+def _plan_problems(detail):
+    if detail.startswith('SCAN ') and not detail.startswith(('SCAN CONSTANT ROW', 'SCAN (subquery')):
+        return detail.split()[1] not in _FULL_SCAN_TABLES
+    return 'TEMP B-TREE' in detail
+
+# A trailing dict in a case holds keyword arguments
+def _split_case(args):
+    if isinstance(args[-1], dict):
+        return args[:-1], args[-1]
+    return args, {}
+
+# Run EXPLAIN QUERY PLAN over the statements every get_*/query_* function issues
+def check_query_plans():
+    cases = _query_plan_cases()
+    problems = []
+    for name, func in sorted(globals().items()):
+        if not name.startswith(('get_', 'query_')) or not callable(func):
+            continue
+        if name not in cases:
+            problems.append(f"{name}: no query plan case registered")
+            continue
+        for args in cases[name]:
+            args, kwargs = _split_case(args)
+            # Make sure the call reaches the database instead of a cache
+            _clear_exchange_rate_caches()
+            statements = []
+            for connection in db.connections():
+                connection.set_trace_callback(statements.append)
+            try:
+                inspect.unwrap(func)(*args, **kwargs)
+            finally:
+                for connection in db.connections():
+                    connection.set_trace_callback(None)
+            for sql in statements:
+                if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+                    continue
+                with db.read() as conn:
+                    plan = conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+                for row in plan:
+                    if _plan_problems(row[3]) and row[3] not in _PLAN_ALLOWANCES.get(name, ()):
+                        problems.append(f"{name}{args[1:]}{kwargs or ''}: {row[3]}")
+    return problems
+
+# Call every get_*/query_* function with its plan-check arguments for user,
+# repeat times and past the caches, so query_stats reflects that user's data
+def profile_queries(user, repeat=3):
+    for _ in range(repeat):
+        for name, calls in sorted(_query_plan_cases(user).items()):
+            for args in calls:
+                args, kwargs = _split_case(args)
+                query_cache.clear()
+                _clear_exchange_rate_caches()
+                globals()[name](*args, **kwargs)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Finance app database maintenance")
+    commands = parser.add_subparsers(dest='command', required=True)
+    rebuild = commands.add_parser('rebuild-rollups',
+                                  help="Recompute the monthly/yearly rollups and daily balances (backfills them)")
+    rebuild.add_argument('--user', help="Only rebuild this user's rollups")
+    commands.add_parser('check-plans', help="Fail if any get_*/query_* query scans a table or uses a temp B-tree")
+    load_rates = commands.add_parser('load-rates', help="Load a CSV of date, currency, rate rows")
+    load_rates.add_argument('path', nargs='?', default=EXCHANGE_RATES_PATH)
+    backup = commands.add_parser('backup', help="Copy the live database to a file")
+    backup.add_argument('path')
+    restore = commands.add_parser('restore', help="Replace the database with a checked backup")
+    restore.add_argument('path')
+    stats = commands.add_parser('query-stats',
+                                help="Profile every get_*/query_* function for a user and print the stats as JSON")
+    stats.add_argument('--user', required=True)
+    stats.add_argument('--repeat', type=int, default=3)
+    stats.add_argument('--slow-ms', type=float, default=query_stats.slow_ms,
+                       help="Log statements slower than this, with their query plans")
+    args = parser.parse_args()
+
+    if args.command == 'rebuild-rollups':
+        success, message = rebuild_rollups(args.user)
+        print(message)
+        raise SystemExit(0 if success else 1)
+    elif args.command == 'check-plans':
+        problems = check_query_plans()
+        for problem in problems:
+            print(problem)
+        print(f"{len(problems)} query plan problem(s) found.")
+        raise SystemExit(1 if problems else 0)
+    elif args.command == 'load-rates':
+        success, message = load_exchange_rates(args.path)
+        print(message)
+        raise SystemExit(0 if success else 1)
+    elif args.command == 'backup':
+        success, message = backup_database(args.path)
+        print(message)
+        raise SystemExit(0 if success else 1)
+    elif args.command == 'restore':
+        with open(args.path, 'rb') as f:
+            success, message = restore_database(f)
+        print(message)
+        raise SystemExit(0 if success else 1)
+    elif args.command == 'query-stats':
+        query_stats.slow_ms = args.slow_ms
+        profile_queries(args.user, args.repeat)
+        print(json.dumps(collect_query_stats(), indent=2))   import csv
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from database import iter_sql, transaction_query, add_expenses_bulk, major_units
+
+EXPORT_CHUNK_SIZE = 5000
+
+# Excel's sheet limit, less the header row
+EXCEL_MAX_ROWS = 1048575
+
+# Income and expenses come from the shared transaction query, so exports
+# accept the same filters as the report drill-down
+TRANSACTION_EXPORTS = {'Income': 'income', 'Expenses': 'expense'}
+TRANSACTION_COLUMNS = ['id', 'date', 'category', 'subcategory', 'amount', 'currency', 'Tags']
+
+# Column headers and query, taking the user, for the other data types. Amounts
+# leave the database in major units.
+EXPORT_QUERIES = {
+    'Budget': (
+        ['category', 'subcategory', 'amount', 'currency', 'period', 'rollover'],
+        f"""
+            SELECT category, subcategory, {major_units('amount', 'currency')}, currency, period, rollover
+            FROM budget
+            WHERE user = ?
+        """,
+    ),
+    'Tags': (
+        ['Tags'],
+        """
+            SELECT tag FROM tags
+            WHERE user = ?
+        """,
+    ),
+    'Savings Goals': (
+        ['id', 'user', 'goal_amount', 'target_date', 'achieved'],
+        f"""
+            SELECT id, user, {major_units('goal_amount')}, target_date, achieved
+            FROM savings_goals
+            WHERE user = ?
+        """,
+    ),
+}
+
+EXPORT_DATA_TYPES = list(TRANSACTION_EXPORTS) + list(EXPORT_QUERIES)
+
+# File extension and MIME type of each export format
+EXPORT_FORMATS = {
+    'CSV': ('csv', 'text/csv'),
+    'Excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'JSON Lines': ('jsonl', 'application/x-ndjson'),
+    'PDF': ('pdf', 'application/pdf'),
+}
+
+# Column headers and a generator of row chunks; filters (see
+# transaction_filters) apply to income and expenses
+def iter_export_rows(user, data_type, chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    if data_type in TRANSACTION_EXPORTS:
+        query, params = transaction_query(user, TRANSACTION_EXPORTS[data_type], **filters)
+        return TRANSACTION_COLUMNS, iter_sql(query, params, chunk_size)
+    columns, query = EXPORT_QUERIES[data_type]
+    return columns, iter_sql(query, (user,), chunk_size)
+
+# =========================
+# Format Writers
+# =========================
+
+# Each writer consumes the row chunks once and never holds more than one
+# chunk, so memory stays flat however many rows are exported.
+
+def iter_csv(columns, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue().encode('utf-8')
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+
+def iter_jsonl(columns, chunks):
+    for rows in chunks:
+        yield "".join(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in rows).encode('utf-8')
+
+# openpyxl's write-only workbook spools rows to a temporary file as they are
+# appended instead of keeping a cell object per value
+def write_excel(columns, chunks, out):
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Export")
+    sheet.append(columns)
+    count = 0
+    for rows in chunks:
+        count += len(rows)
+        if count > EXCEL_MAX_ROWS:
+            raise ValueError(f"Excel sheets hold at most {EXCEL_MAX_ROWS:,} rows; export as CSV or JSON Lines instead.")
+        for row in rows:
+            sheet.append(row)
+    workbook.save(out)
+
+# Letter, landscape, in points
+PDF_PAGE_SIZE = (792, 612)
+PDF_FONT_SIZE = 7
+PDF_ROW_HEIGHT = 12
+PDF_MARGIN = 36
+PDF_CELL_PADDING = 6
+# Height of the text baseline above the bottom of its row
+PDF_BASELINE = 3.5
+# Helvetica advance widths, in thousandths of the font size, of "Page " and of
+# a digit, to right-align page numbers
+HELVETICA_PAGE_WIDTH = 2613
+HELVETICA_DIGIT_WIDTH = 556
+
+def _pdf_cell(value, max_chars):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        value = f"{value:.2f}"
+    value = str(value)
+    return value if len(value) <= max_chars else value[:max_chars - 1] + "…"
+
+# A PDF string literal in the standard fonts' WinAnsi encoding
+def _pdf_string(text):
+    text = text.encode('cp1252', errors='replace')
+    return b"(" + text.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+# Writes a PDF's objects to out as each one is complete. Only the byte offset
+# of every object and the list of pages are kept, for the page tree and the
+# cross-reference table written at the end.
+class PdfWriter:
+    CATALOG, PAGES, FONT, BOLD_FONT = 1, 2, 3, 4
+
+    def __init__(self, out, page_size):
+        self.out = out
+        self.page_size = page_size
+        self.position = 0
+        self.offsets = {}
+        self.pages = []
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self._object(self.CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % self.PAGES)
+        for number, font in [(self.FONT, b"Helvetica"), (self.BOLD_FONT, b"Helvetica-Bold")]:
+            self._object(number, b"<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>" % font)
+
+    def _write(self, data):
+        self.out.write(data)
+        self.position += len(data)
+
+    def _object(self, number, body):
+        self.offsets[number] = self.position
+        self._write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+
+    # Add a page drawn by content, a content stream using /F1 (Helvetica) and
+    # /F2 (Helvetica-Bold)
+    def add_page(self, content):
+        stream = zlib.compress(content)
+        contents = max(self.offsets) + 1
+        self._object(contents, b"<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream" % (len(stream), stream))
+        self._object(contents + 1, b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] "
+                                   b"/Resources << /Font << /F1 %d 0 R /F2 %d 0 R >> >> /Contents %d 0 R >>"
+                     % (self.PAGES, *self.page_size, self.FONT, self.BOLD_FONT, contents))
+        self.pages.append(contents + 1)
+
+    def close(self):
+        kids = b" ".join(b"%d 0 R" % page for page in self.pages)
+        self._object(self.PAGES, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.pages)))
+        xref = self.position
+        size = max(self.offsets) + 1
+        self._write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+        self._write(b"".join(b"%010d 00000 n \n" % self.offsets[number] for number in range(1, size)))
+        self._write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, self.CATALOG, xref))
+
+# Rows are laid out a page at a time as a fixed-size table with the header
+# repeated, and each page is compressed and written out before the next one is
+# started, so only one page of rows is ever held.
+def write_pdf(columns, chunks, out, title=None):
+    width, height = PDF_PAGE_SIZE
+    pdf = PdfWriter(out, PDF_PAGE_SIZE)
+    title_height = PDF_ROW_HEIGHT * 2 if title else 0
+    rows_per_page = int((height - 2 * PDF_MARGIN - title_height) // PDF_ROW_HEIGHT) - 1
+    table_width = width - 2 * PDF_MARGIN
+    column_width = table_width / len(columns)
+    max_chars = max(4, int(column_width / (PDF_FONT_SIZE * 0.55)))
+    header = [_pdf_cell(column, max_chars) for column in columns]
+
+    def draw_page(page_rows):
+        top = height - PDF_MARGIN
+        content = []
+        if title:
+            content.append(b"BT /F2 %d Tf %d %.2f Td %s Tj ET"
+                           % (PDF_FONT_SIZE + 3, PDF_MARGIN, top - PDF_ROW_HEIGHT, _pdf_string(title)))
+            top -= title_height
+        bottom = top - PDF_ROW_HEIGHT * (len(page_rows) + 1)
+        # Light grey header, then a grey grid over the whole table
+        content.append(b"0.827 g %d %.2f %.2f %d re f 0 g" % (PDF_MARGIN, top - PDF_ROW_HEIGHT, table_width, PDF_ROW_HEIGHT))
+        content.append(b"0.5 G 0.25 w")
+        for line in range(len(page_rows) + 2):
+            y = top - line * PDF_ROW_HEIGHT
+            content.append(b"%d %.2f m %.2f %.2f l" % (PDF_MARGIN, y, PDF_MARGIN + table_width, y))
+        for line in range(len(columns) + 1):
+            x = PDF_MARGIN + line * column_width
+            content.append(b"%.2f %.2f m %.2f %.2f l" % (x, top, x, bottom))
+        content.append(b"S BT /F2 %d Tf" % PDF_FONT_SIZE)
+        for line, cells in enumerate([header] + page_rows):
+            if line == 1:
+                content.append(b"/F1 %d Tf" % PDF_FONT_SIZE)
+            y = top - (line + 1) * PDF_ROW_HEIGHT + PDF_BASELINE
+            for column, cell in enumerate(cells):
+                if cell:
+                    x = PDF_MARGIN + column * column_width + PDF_CELL_PADDING
+                    content.append(b"1 0 0 1 %.2f %.2f Tm %s Tj" % (x, y, _pdf_string(cell)))
+        number = len(pdf.pages) + 1
+        label_width = (HELVETICA_PAGE_WIDTH + HELVETICA_DIGIT_WIDTH * len(str(number))) * PDF_FONT_SIZE / 1000
+        content.append(b"/F1 %d Tf 1 0 0 1 %.2f %.2f Tm (Page %d) Tj ET"
+                       % (PDF_FONT_SIZE, width - PDF_MARGIN - label_width, PDF_MARGIN / 2, number))
+        pdf.add_page(b"\n".join(content))
+
+    page_rows = []
+    for rows in chunks:
+        for row in rows:
+            page_rows.append([_pdf_cell(value, max_chars) for value in row])
+            if len(page_rows) == rows_per_page:
+                draw_page(page_rows)
+                page_rows = []
+    if page_rows or not pdf.pages:
+        draw_page(page_rows)
+    pdf.close()
+
+# Write one data type in one format to the binary file out and return the
+# number of data rows written
+def write_export(user, data_type, export_format, out, chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    columns, chunks = iter_export_rows(user, data_type, chunk_size, **filters)
+    count = 0
+
+    def counted(chunks):
+        nonlocal count
+        for rows in chunks:
+            count += len(rows)
+            yield rows
+
+    try:
+        if export_format == 'CSV':
+            out.writelines(iter_csv(columns, counted(chunks)))
+        elif export_format == 'JSON Lines':
+            out.writelines(iter_jsonl(columns, counted(chunks)))
+        elif export_format == 'Excel':
+            write_excel(columns, counted(chunks), out)
+        elif export_format == 'PDF':
+            write_pdf(columns, counted(chunks), out, title=f"{data_type} - {datetime.today().strftime('%Y-%m-%d')}")
+        else:
+            raise ValueError(f"Unknown export format {export_format!r}")
+    finally:
+        chunks.close()
+    return count
+
+# Write an export to a named temporary file and return its path and row count.
+# The caller owns the file and removes it once it has been served.
+def export_to_file(user, data_type, export_format, **filters):
+    extension, _ = EXPORT_FORMATS[export_format]
+    with tempfile.NamedTemporaryFile(suffix=f".{extension}", delete=False) as out:
+        try:
+            count = write_export(user, data_type, export_format, out, **filters)
+        except Exception:
+            out.close()
+            os.remove(out.name)
+            raise
+    return out.name, count
+
+# =========================
+# Benchmark
+# =========================
+
+BENCHMARK_USER = '__export_benchmark__'
+
+# Peak resident set size of this process so far, in MB (ru_maxrss is KB on
+# Linux and bytes on macOS)
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _seed_benchmark(rows, batch_size=50000):
+    categories = ['Food', 'Rent', 'Travel', 'Utilities', 'Health', 'Entertainment']
+    currencies = ['USD', 'EUR', 'GBP', 'JPY', 'CAD']
+    start = datetime(2015, 1, 1)
+    for offset in range(0, rows, batch_size):
+        batch = [
+            {
+                'date': (start + timedelta(days=i % 3650)).strftime("%Y-%m-%d"),
+                'category': categories[i % len(categories)],
+                'subcategory': f"Sub {i % 17}",
+                'amount': round(5 + (i * 7919 % 50000) / 100, 2),
+                'currency': currencies[i % len(currencies)],
+                'tags': f"tag{i % 5}, tag{i % 7}" if i % 20 == 0 else "",
+            }
+            for i in range(offset, min(offset + batch_size, rows))
+        ]
+        success, message, _ = add_expenses_bulk(BENCHMARK_USER, batch, offset)
+        if not success:
+            raise RuntimeError(message)
+
+def _run_benchmark_case(export_format, path):
+    baseline = _peak_rss_mb()
+    started = time.perf_counter()
+    with open(path, 'wb') as out:
+        count = write_export(BENCHMARK_USER, 'Expenses', export_format, out)
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        'rows': count,
+        'seconds': round(elapsed, 3),
+        'baseline_rss_mb': round(baseline, 1),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'bytes': os.path.getsize(path),
+    }))
+
+# The download of a prepared export: the app's download button reads the whole
+# file into memory when it is clicked
+def _run_download_case(path):
+    baseline = _peak_rss_mb()
+    data = Path(path).read_bytes()
+    print(json.dumps({
+        'bytes': len(data),
+        'baseline_rss_mb': round(baseline, 1),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    }))
+
+# Seed a scratch database per size, then export it in each format and download
+# the result, each from a fresh process so every case reports its own peak RSS
+def run_benchmark(sizes, formats):
+    script = os.path.abspath(__file__)
+    print(f"{'format':<11} {'rows':>9} {'seconds':>9} {'peak MB':>9} {'delta MB':>9} {'size MB':>9} {'dl delta MB':>12}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            subprocess.run([sys.executable, script, 'benchmark-seed', str(size)], cwd=workdir, check=True)
+            for export_format in formats:
+                extension, _ = EXPORT_FORMATS[export_format]
+                output = os.path.join(workdir, f"export.{extension}")
+                result = subprocess.run([sys.executable, script, 'benchmark-case', export_format, output],
+                                        cwd=workdir, capture_output=True, text=True)
+                if result.returncode:
+                    print(f"{export_format:<11} {size:>9} failed: {result.stderr.strip().splitlines()[-1]}")
+                    continue
+                case = json.loads(result.stdout.strip().splitlines()[-1])
+                result = subprocess.run([sys.executable, script, 'benchmark-download', output],
+                                        cwd=workdir, capture_output=True, text=True, check=True)
+                download = json.loads(result.stdout.strip().splitlines()[-1])
+                print(f"{export_format:<11} {case['rows']:>9} {case['seconds']:>9.2f} {case['peak_rss_mb']:>9.1f} "
+                      f"{case['peak_rss_mb'] - case['baseline_rss_mb']:>9.1f} {case['bytes'] / 1e6:>9.1f} "
+                      f"{download['peak_rss_mb'] - download['baseline_rss_mb']:>12.1f}")
+                os.remove(output)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Finance app data exports")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help="Export one user's data to a file")
+    export.add_argument('user')
+    export.add_argument('data_type', choices=EXPORT_DATA_TYPES)
+    export.add_argument('format', choices=list(EXPORT_FORMATS))
+    export.add_argument('path')
+    benchmark = commands.add_parser('benchmark', help="Time each format and report peak RSS at several row counts")
+    benchmark.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    benchmark.add_argument('--formats', nargs='+', choices=list(EXPORT_FORMATS), default=list(EXPORT_FORMATS))
+    seed = commands.add_parser('benchmark-seed')
+    seed.add_argument('rows', type=int)
+    case = commands.add_parser('benchmark-case')
+    case.add_argument('format', choices=list(EXPORT_FORMATS))
+    case.add_argument('path')
+    download = commands.add_parser('benchmark-download')
+    download.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        with open(args.path, 'wb') as out:
+            count = write_export(args.user, args.data_type, args.format, out)
+        print(f"Exported {count} rows to {args.path}.")
+    elif args.command == 'benchmark':
+        run_benchmark(args.rows, args.formats)
+    elif args.command == 'benchmark-seed':
+        _seed_benchmark(args.rows)
+    elif args.command == 'benchmark-case':
+        _run_benchmark_case(args.format, args.path)
+    elif args.command == 'benchmark-download':
+        _run_download_case(args.path)
+   from dataclasses import dataclass, replace
+
+import numpy as np
+
+from database import (
+    cached, get_expenses_over_time, get_recurring_postings, get_recurring_rules, get_exchange_rates
+)
+from process_recurring import expand_occurrences
+
+# Days per period of each forecast frequency
+FREQUENCIES = {'daily': 1, 'weekly': 7}
+
+# Ridge penalty on everything but the intercept, which keeps the seasonal
+# coefficients finite on histories too short to cover every weekday or month
+RIDGE = 1.0
+
+# Backtest windows tried before the forecast origin
+BACKTEST_FOLDS = 4
+
+@dataclass
+class ExpenseForecast:
+    freq: str
+    history_dates: np.ndarray  # datetime64[D] period starts
+    history: np.ndarray  # USD spent per period
+    dates: np.ndarray
+    forecast: np.ndarray  # USD per period, recurring included
+    recurring: np.ndarray  # the part of forecast scheduled by recurring rules
+    backtest: dict
+
+    def copy(self):
+        return replace(self)
+
+# =========================
+# Series and Features
+# =========================
+
+# Sum amounts dated on days into per-period totals over periods starting at
+# start (a datetime64[D] array of period starts)
+def _bucket(starts, step, days, amounts):
+    index = (days - starts[0]).astype(np.int64) // step
+    keep = (index >= 0) & (index < len(starts))
+    return np.bincount(index[keep], weights=amounts[keep], minlength=len(starts))
+
+# Spending per period from the first expense to the last: total and the part
+# posted by recurring rules. Daily totals are summed in SQL; weekly periods
+# are whole Monday-to-Sunday weeks.
+def _series(user, freq):
+    daily = get_expenses_over_time(user)
+    if daily.empty:
+        return None
+    days = daily['date'].to_numpy().astype('datetime64[D]')
+    first, last = days.min(), days.max()
+    step = FREQUENCIES[freq]
+    if freq == 'weekly':
+        # Monday of the first whole week and Sunday of the last
+        first = first + (7 - (first.astype(np.int64) + 3) % 7) % 7
+        last = last - (last.astype(np.int64) + 4) % 7
+    starts = np.arange(first, last + 1, step)
+    if len(starts) == 0:
+        return None
+    total = _bucket(starts, step, days, daily['Amount'].fillna(0).to_numpy())
+    postings = get_recurring_postings(user, 'expense')
+    recurring = _bucket(starts, step, postings['date'].to_numpy().astype('datetime64[D]'),
+                        postings['amount'].fillna(0).to_numpy())
+    return starts, total, recurring
+
+# Design matrix: intercept, trend in years since origin, weekday dummies (daily
+# series only) and month dummies, each against Monday / January
+def _features(starts, origin, freq):
+    days = starts.astype(np.int64)
+    columns = [np.ones(len(starts)), (days - origin) / 365.25]
+    if freq == 'daily':
+        weekday = (days + 3) % 7
+        columns.extend(weekday == day for day in range(1, 7))
+    month = starts.astype('datetime64[M]').astype(np.int64) % 12
+    columns.extend(month == number for number in range(1, 12))
+    return np.column_stack(columns).astype(float)
+
+def _solve(gram, moment):
+    penalty = np.full(len(gram), RIDGE)
+    penalty[0] = 0.0
+    return np.linalg.solve(gram + np.diag(penalty), moment)
+
+# Rolling-origin backtest: refit on everything before each of the last folds
+# windows of horizon periods and forecast that window. Recurring amounts are
+# known ahead, so the error is that of the fitted part.
+def _backtest(starts, target, total, freq, horizon, folds):
+    features = _features(starts, starts[0].astype(np.int64), freq)
+    errors, actuals = [], []
+    for fold in range(folds, 0, -1):
+        cut = len(target) - fold * horizon
+        if cut < 2 * features.shape[1]:
+            continue
+        window = slice(cut, cut + horizon)
+        coefficients = _solve(features[:cut].T @ features[:cut], features[:cut].T @ target[:cut])
+        predicted = np.maximum(features[window] @ coefficients, 0)
+        errors.append(np.abs(predicted - target[window]))
+        actuals.append(total[window])
+    if not errors:
+        return {'folds': 0, 'mae': None, 'wape': None}
+    errors, actuals = np.concatenate(errors), np.concatenate(actuals)
+    return {
+        'folds': len(actuals) // horizon,
+        'mae': float(errors.mean()),
+        'wape': float(errors.sum() / actuals.sum()) if actuals.sum() else None,
+    }
+
+# USD due per future period from the user's recurring expense rules
+def _scheduled(user, starts, step):
+    rules = get_recurring_rules(user, 'expense')
+    end = starts[-1] + step - 1
+    rules = rules[rules['date'].to_numpy().astype('datetime64[D]') <= end]
+    if rules.empty:
+        return np.zeros(len(starts))
+    rule, dates, _ = expand_occurrences(rules, end)
+    rates = get_exchange_rates()
+    usd = (rules['amount'] / rules['currency'].map(rates)).fillna(0).to_numpy()
+    return _bucket(starts, step, dates, usd[rule])
+
+# =========================
+# Forecast
+# =========================
+
+# Forecast a user's spending in USD for the next horizon days or weeks after
+# their last expense. Spending outside recurring rules is fitted by least
+# squares on trend and weekday/month seasonality; the rules' scheduled
+# occurrences are added on top. Cached until the user's transactions or rules
+# change. Returns None without enough history to fit.
+@cached('transactions', 'recurring')
+def forecast_expenses(user, horizon=30, freq='daily'):
+    series = _series(user, freq)
+    if series is None:
+        return None
+    starts, total, recurring = series
+    target = total - recurring
+    step = FREQUENCIES[freq]
+    if len(starts) < 2 * _features(starts[:1], 0, freq).shape[1]:
+        return None
 
-import bcrypt
+    features = _features(starts, starts[0].astype(np.int64), freq)
+    coefficients = _solve(features.T @ features, features.T @ target)
+    future = starts[-1] + step * np.arange(1, horizon + 1)
+    fitted = np.maximum(_features(future, starts[0].astype(np.int64), freq) @ coefficients, 0)
+    scheduled = _scheduled(user, future, step)
+    return ExpenseForecast(
+        freq=freq,
+        history_dates=starts,
+        history=total,
+        dates=future,
+        forecast=fitted + scheduled,
+        recurring=scheduled,
+        backtest=_backtest(starts, target, total, freq, horizon, BACKTEST_FOLDS),
+    )   import bcrypt
 
 def hash_password(plain_text_password):
     return bcrypt.hashpw(plain_text_password.encode(), bcrypt.gensalt()).decode()
@@ -1540,9 +4530,7 @@ if __name__ == "__main__":
     
     for username, password in users.items():
         hashed = hash_password(password)
-        print(f"{username}: {hashed}")   /* light.css */
-
-body {
+        print(f"{username}: {hashed}")   body {
     background-color: #FFFFFF;
     color: black;
 }
@@ -1550,86 +4538,279 @@ body {
 .css-1d391kg {
     background-color: #FFFFFF;
     color: black;
-}   # process_recurring.py
-
-import sqlite3
-from datetime import datetime, timedelta
+}   from datetime import datetime
+import heapq
+import json
+import os
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 
-def process_recurring_transactions():
-    # Connect to the database
-    conn = sqlite3.connect('finance_app.db')
-    c = conn.cursor()
-    
-    today = datetime.today().strftime("%Y-%m-%d")
-    
-    # Fetch all recurring transactions due today or earlier
-    c.execute("""
-        SELECT id, user, type, date, category, subcategory, amount, frequency, currency
-        FROM recurring
-        WHERE date <= ?
-    """, (today,))
-    
-    recurrings = c.fetchall()
-    
-    for recurring in recurrings:
-        rec_id, user, type_, date, category, subcategory, amount, frequency, currency = recurring
-        # Insert into income or expense
-        if type_ == 'income':
-            c.execute("""
-                INSERT INTO income (user, date, category, subcategory, amount, currency)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (user, date, category, subcategory, amount, currency))
-        elif type_ == 'expense':
-            c.execute("""
-                INSERT INTO expense (user, date, category, subcategory, amount, currency)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (user, date, category, subcategory, amount, currency))
-        
-        # Calculate next date based on frequency
-        last_date = datetime.strptime(date, "%Y-%m-%d")
-        if frequency == 'daily':
-            next_date = last_date + timedelta(days=1)
-        elif frequency == 'weekly':
-            next_date = last_date + timedelta(weeks=1)
-        elif frequency == 'monthly':
-            month = last_date.month
-            year = last_date.year
-            if month == 12:
-                month = 1
-                year += 1
-            else:
-                month += 1
-            try:
-                next_date = last_date.replace(year=year, month=month)
-            except ValueError:
-                # Handle end-of-month issues
-                next_date = last_date + timedelta(days=31)
-                next_date = next_date.replace(day=1) - timedelta(days=1)
-        else:
-            # Default to monthly if frequency is unknown
-            month = last_date.month
-            year = last_date.year
-            if month == 12:
-                month = 1
-                year += 1
-            else:
-                month += 1
-            try:
-                next_date = last_date.replace(year=year, month=month)
-            except ValueError:
-                next_date = last_date + timedelta(days=31)
-                next_date = next_date.replace(day=1) - timedelta(days=1)
-        
-        c.execute("""
-            UPDATE recurring
-            SET date = ?
-            WHERE id = ?
-        """, (next_date.strftime("%Y-%m-%d"), rec_id))
-    
-    conn.commit()
-    conn.close()
+import numpy as np
+import pandas as pd
+
+from database import db, invalidate, on_recurring_added, to_minor, day_key
+
+# Date of the k-th occurrence of monthly rules: day anchor_day of the month k
+# months after start, clamped to that month's last day (Jan 31, Feb 28,
+# Mar 31, ...)
+def _monthly_dates(start_month, k, anchor_day):
+    month = start_month + k
+    first = month.astype('datetime64[D]')
+    days_in_month = ((month + 1).astype('datetime64[D]') - first).astype(np.int64)
+    return first + (np.minimum(anchor_day, days_in_month) - 1)
+
+# Expand due rules (a frame with date, frequency and anchor_day, date <= today)
+# into every occurrence from their next date up to today in one vectorized
+# pass. Returns the rule positions and dates of the occurrences, and each
+# rule's next date after them. Unknown frequencies recur monthly.
+def expand_occurrences(rules, today):
+    today = np.datetime64(today, 'D')
+    start = rules['date'].to_numpy().astype('datetime64[D]')
+    frequency = rules['frequency'].to_numpy()
+    start_day = (start - start.astype('datetime64[M]')).astype(np.int64) + 1
+    anchor_day = np.where(rules['anchor_day'].isna(), start_day, rules['anchor_day'].fillna(0)).astype(np.int64)
+    monthly = ~np.isin(frequency, ['daily', 'weekly'])
+    step = np.where(frequency == 'weekly', 7, 1)
+
+    day_counts = (today - start).astype(np.int64) // step + 1
+    start_month = start.astype('datetime64[M]')
+    months = (today.astype('datetime64[M]') - start_month).astype(np.int64)
+    month_counts = months + (_monthly_dates(start_month, months, anchor_day) <= today)
+    counts = np.where(monthly, month_counts, day_counts)
+
+    rule = np.repeat(np.arange(len(rules)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    dates = np.where(monthly[rule],
+                     _monthly_dates(start_month[rule], k, anchor_day[rule]),
+                     start[rule] + k * step[rule])
+    next_dates = np.where(monthly,
+                          _monthly_dates(start_month, counts, anchor_day),
+                          start + counts * step)
+    return rule, dates, next_dates
+
+# Post every occurrence missed up to today, across all due rules (or only
+# those in rule_ids), in a single transaction. Occurrences already in
+# recurring_postings are skipped, so an interrupted or repeated run never
+# posts twice.
+def process_recurring_transactions(today=None, rule_ids=None):
+    today = today or datetime.today().strftime("%Y-%m-%d")
+    try:
+        with db.transaction() as conn:
+            rules = pd.read_sql_query(f"""
+                SELECT id, user, type, date, frequency, anchor_day
+                FROM recurring
+                WHERE day_key <= ?{" AND id IN (SELECT value FROM json_each(?))" if rule_ids is not None else ""}
+            """, conn, params=(day_key(today),) if rule_ids is None else (day_key(today), json.dumps(list(rule_ids))))
+            if rules.empty:
+                return True, "No recurring transactions due."
+
+            rule, dates, next_dates = expand_occurrences(rules, today)
+            rule_ids = rules['id'].to_numpy()
+            conn.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS recurring_due (
+                    recurring_id INTEGER NOT NULL,
+                    occurrence_date TEXT NOT NULL
+                )
+            """)
+            conn.execute("DELETE FROM recurring_due")
+            conn.executemany("INSERT INTO recurring_due (recurring_id, occurrence_date) VALUES (?, ?)",
+                             zip(rule_ids[rule].tolist(), dates.astype(str).tolist()))
+
+            posted = 0
+            for trans_type in ('income', 'expense'):
+                posted += conn.execute(f"""
+                    INSERT INTO {trans_type} (user, date, category, subcategory, amount, currency)
+                    SELECT r.user, d.occurrence_date, r.category, r.subcategory, r.amount, r.currency
+                    FROM recurring_due d
+                    JOIN recurring r ON r.id = d.recurring_id
+                    WHERE r.type = ?
+                      AND NOT EXISTS (
+                          SELECT 1 FROM recurring_postings p
+                          WHERE p.recurring_id = d.recurring_id AND p.occurrence_date = d.occurrence_date
+                      )
+                    ORDER BY d.recurring_id, d.occurrence_date
+                """, (trans_type,)).rowcount
+            conn.execute("""
+                INSERT OR IGNORE INTO recurring_postings (recurring_id, occurrence_date)
+                SELECT recurring_id, occurrence_date FROM recurring_due
+            """)
+            conn.execute("DELETE FROM recurring_due")
+
+            conn.executemany("UPDATE recurring SET date = ? WHERE id = ?",
+                             zip(next_dates.astype(str).tolist(), rule_ids.tolist()))
+            for user in rules['user'].unique():
+                invalidate(user, 'transactions', 'recurring')
+        return True, f"Posted {posted} occurrences of {len(rules)} recurring transactions."
+    except Exception as e:
+        return False, f"Error processing recurring transactions: {e}"
+
+# =========================
+# Scheduler
+# =========================
+
+# Posts recurring transactions as they fall due from inside a long-running
+# process. Next due dates sit in a min-heap of (date, rule id) loaded once
+# from the recurring(day_key) index; the thread sleeps until the earliest is due
+# and posts only those rules. An entry whose date no longer matches
+# _next_due has been superseded and is dropped when it reaches the top.
+class RecurringScheduler:
+    def __init__(self, max_sleep=300, retry_delay=60):
+        self.max_sleep = max_sleep
+        self.retry_delay = retry_delay
+        self._heap = []
+        self._next_due = {}
+        self._last_id = 0
+        self._wakeup = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def load(self):
+        with db.read() as conn:
+            rows = conn.execute("SELECT date, id FROM recurring ORDER BY day_key").fetchall()
+        with self._wakeup:
+            # Rows sorted by date already satisfy the heap invariant
+            self._heap = rows
+            self._next_due = {rule_id: date for date, rule_id in rows}
+            self._last_id = max(self._next_due, default=0)
+            self._wakeup.notify()
+
+    def push(self, rule_id, date):
+        with self._wakeup:
+            self._next_due[rule_id] = date
+            self._last_id = max(self._last_id, rule_id)
+            heapq.heappush(self._heap, (date, rule_id))
+            self._wakeup.notify()
+
+    # Rules added by other processes, found by id rather than a rescan
+    def _pull_new_rules(self):
+        with db.read() as conn:
+            rows = conn.execute("SELECT id, date FROM recurring WHERE id > ?", (self._last_id,)).fetchall()
+        for rule_id, date in rows:
+            self.push(rule_id, date)
+
+    def run_pending(self, today=None):
+        today = today or datetime.today().strftime("%Y-%m-%d")
+        self._pull_new_rules()
+        due = []
+        with self._wakeup:
+            while self._heap and self._heap[0][0] <= today:
+                date, rule_id = heapq.heappop(self._heap)
+                if self._next_due.get(rule_id) == date:
+                    del self._next_due[rule_id]
+                    due.append(rule_id)
+        if not due:
+            return True, "No recurring transactions due."
+
+        success, message = process_recurring_transactions(today, due)
+        # Requeue at the new next dates (or the old ones, to retry a failure)
+        with db.read() as conn:
+            rows = conn.execute("SELECT id, date FROM recurring WHERE id IN (SELECT value FROM json_each(?))",
+                                (json.dumps(due),)).fetchall()
+        for rule_id, date in rows:
+            self.push(rule_id, date)
+        return success, message
+
+    # Seconds until the earliest rule is due (midnight of its date), capped at
+    # max_sleep so rules added by other processes are picked up
+    def _seconds_until_due(self):
+        while self._heap and self._next_due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return self.max_sleep
+        due = datetime.strptime(self._heap[0][0], "%Y-%m-%d")
+        return min(max((due - datetime.now()).total_seconds(), 0), self.max_sleep)
+
+    def run(self):
+        self.load()
+        while not self._stopped.is_set():
+            success, message = self.run_pending()
+            if not success or not message.startswith("No "):
+                print(f"{datetime.now():%Y-%m-%d %H:%M:%S} {message}", flush=True)
+            with self._wakeup:
+                timeout = self._seconds_until_due() if success else self.retry_delay
+                if timeout > 0 and not self._stopped.is_set():
+                    self._wakeup.wait(timeout)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="recurring-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._wakeup:
+            self._wakeup.notify()
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+# Start the process-wide scheduler thread once; rules added through
+# add_recurring in this process are pushed onto its heap as they commit
+def start_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RecurringScheduler()
+            on_recurring_added(_scheduler.push)
+            _scheduler.start()
+        return _scheduler
+
+# =========================
+# Benchmark
+# =========================
+
+def _seed_benchmark(rules, today):
+    # Rules spread over the three frequencies, each up to 30 days behind
+    rng = np.random.default_rng(0)
+    start = np.datetime64(today, 'D') - rng.integers(0, 30, rules)
+    frequencies = np.array(['daily', 'weekly', 'monthly'])[rng.integers(0, 3, rules)]
+    with db.transaction() as conn:
+        conn.executemany("""
+            INSERT INTO recurring (user, type, date, category, subcategory, amount, frequency, currency, anchor_day)
+            VALUES (?, ?, ?, 'Benchmark', NULL, ?, ?, 'USD', ?)
+        """, (
+            (f"user{i % 1000}", 'expense' if i % 4 else 'income', str(date), to_minor(i % 500 + 1), frequency,
+             date.astype(object).day)
+            for i, (date, frequency) in enumerate(zip(start, frequencies))
+        ))
+
+def _run_benchmark(rules, today):
+    _seed_benchmark(rules, today)
+    for attempt in ("first run", "re-run"):
+        started = time.perf_counter()
+        success, message = process_recurring_transactions(today)
+        print(f"{attempt}: {message} ({time.perf_counter() - started:.2f}s)")
+        if not success:
+            raise SystemExit(1)
 
 if __name__ == "__main__":
-    process_recurring_transactions()
-    sys.exit()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Post due recurring transactions")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Keep running and post recurring transactions as they fall due")
+    parser.add_argument('--benchmark', type=int, metavar='RULES',
+                        help="Time a catch-up run over this many rules in a scratch database")
+    parser.add_argument('--today', help=argparse.SUPPRESS)
+    parser.add_argument('--benchmark-run', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.daemon:
+        scheduler = RecurringScheduler()
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            scheduler.stop()
+    elif args.benchmark:
+        # Run in a scratch directory so the benchmark gets its own database
+        with tempfile.TemporaryDirectory() as workdir:
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--benchmark-run', str(args.benchmark)],
+                           cwd=workdir, check=True)
+    elif args.benchmark_run:
+        _run_benchmark(args.benchmark_run, args.today or datetime.today().strftime("%Y-%m-%d"))
+    else:
+        success, message = process_recurring_transactions(args.today)
+        print(message)
+        sys.exit(0 if success else 1)
\ No newline at end of file